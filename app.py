@@ -1,9 +1,10 @@
 import streamlit as st
-import db_utils, rag_core, os, config
+import db_utils, rag_core, config, upload_staging
 import extra_streamlit_components as stx
-import time
+import time, datetime
 
 st.set_page_config(page_title="RAG DataRoom", layout="wide")
+db_utils.init_db()
 
 # --- MENEDŻER CIASTECZEK ---
 cookie_manager = stx.CookieManager()
@@ -58,6 +59,31 @@ def login_view():
         st.markdown('</div>', unsafe_allow_html=True)
 
 
+# --- STATUS INDEKSOWANIA (odpytywany co INGEST_POLL_INTERVAL s) ---
+@st.fragment(run_every=config.INGEST_POLL_INTERVAL)
+def jobs_panel(user):
+    jobs = db_utils.get_user_jobs(user)
+    active = {j["id"] for j in jobs if j["status"] in ('queued', 'running')}
+    # Gdy coś się skończyło, przerysuj cały dashboard, żeby pokazać nowe pliki w kolekcjach
+    if st.session_state.get('active_jobs', set()) - active:
+        st.session_state.active_jobs = active
+        # Worker dopisał pliki w innym procesie - cache odczytów tego procesu o tym nie wie
+        db_utils.invalidate_read_cache()
+        st.rerun()
+    st.session_state.active_jobs = active
+    if not jobs: return
+
+    with st.expander(f"⏳ Indeksowanie plików ({len(active)} w toku)", expanded=bool(active)):
+        labels = {'queued': "w kolejce", 'running': "przetwarzanie", 'done': "gotowe", 'failed': "błąd"}
+        for j in jobs:
+            st.progress(j["progress"], text=f"{j['file_name']} - {labels.get(j['status'], j['status'])}")
+            if j["status"] == 'failed': st.caption(f"⚠️ {j['error']}")
+            elif j["status"] == 'queued' and j["error"]: st.caption(f"Ponowna próba ({j['attempts']}/{j['max_attempts']}): {j['error']}")
+        if len(active) < len(jobs) and st.button("Wyczyść zakończone", key="clear_jobs"):
+            db_utils.clear_finished_jobs(user)
+            st.rerun()
+
+
 # --- WIDOK DASHBOARD ---
 def dashboard_view(user):
     st.title("Centrum Projektów")
@@ -70,10 +96,18 @@ def dashboard_view(user):
         time.sleep(0.5)
         st.rerun()
 
-    all_cols = db_utils.get_accessible_collections(user)
-    # Krotki: (id, name, owner_username)
-    owned_cols = [c for c in all_cols if c[2] == user]
-    shared_cols = [c for c in all_cols if c[2] != user]
+    jobs_panel(user)
+
+    # Liczniki cache odpowiedzi są per proces aplikacji (od startu serwera Streamlit)
+    ac = rag_core.get_answer_cache_stats()
+    if ac["hits"] + ac["misses"]:
+        st.caption(f"⚡ Cache odpowiedzi: {ac['hits']}/{ac['hits'] + ac['misses']} pytań ({ac['hit_rate']:.0%}), "
+                   f"zaoszczędzono ~{ac['saved_generation_s']:.0f} s generowania")
+
+    # Jeden snapshot (kolekcje + pliki + uprawnienia) na render zamiast zapytań per kolekcja
+    all_cols = db_utils.get_dashboard_snapshot(user)
+    owned_cols = [c for c in all_cols if c["owner"] == user]
+    shared_cols = [c for c in all_cols if c["owner"] != user]
 
     tab1, tab2 = st.tabs([f"Twoje Kolekcje ({len(owned_cols)})", f"Współdzielone ze mną ({len(shared_cols)})"])
 
@@ -86,7 +120,8 @@ def dashboard_view(user):
         if not owned_cols: st.info("Nie masz jeszcze własnych projektów.")
 
         grid = st.columns(3)
-        for i, (cid, name, owner) in enumerate(owned_cols):
+        for i, col in enumerate(owned_cols):
+            cid, name, owner = col["id"], col["name"], col["owner"]
             with grid[i % 3]:
                 with st.container(border=True):
                     c_head, c_del = st.columns([5, 1])
@@ -98,30 +133,25 @@ def dashboard_view(user):
                         st.rerun()
 
                     # --- ZARZĄDZANIE PLIKAMI (Dla Właściciela) ---
-                    files = db_utils.get_collection_files(cid)
+                    files = col["files"]
                     with st.expander(f"📄 Pliki ({len(files)})"):
                         for f in files:
                             f1, f2 = st.columns([4, 1])
                             f1.write(f)
                             if f2.button("🗑️", key=f"f_{cid}_{f}"):
-                                rag_core.delete_file_from_storage(owner, f)
+                                # Wektory zostają dla innych kolekcji właściciela; nieużywane usunie collect_garbage
                                 db_utils.remove_file_from_collection(cid, f)
                                 st.rerun()
 
                         st.write("---")
                         new_files = st.file_uploader("Dodaj pliki", accept_multiple_files=True, key=f"up_{cid}")
                         if new_files and st.button("Wgraj", key=f"btn_up_{cid}"):
-                            with st.spinner("Przetwarzanie..."):
-                                for nf in new_files:
-                                    path = os.path.join(config.TEMP_UPLOAD_DIR, nf.name)
-                                    os.makedirs(config.TEMP_UPLOAD_DIR, exist_ok=True)
-                                    with open(path, "wb") as bf: bf.write(nf.getvalue())
-                                    # Procesujemy jako właściciel (owner)
-                                    rag_core.process_file(path, nf.name, owner)
-                                    db_utils.add_file_to_collection(cid, nf.name)
-                                st.success("Dodano!")
-                                time.sleep(0.5)
-                                st.rerun()
+                            for nf in new_files:
+                                # Procesujemy jako właściciel (owner) - w tle, przez ingest_worker
+                                upload_staging.enqueue_upload(nf, user, owner, cid)
+                            st.success("Dodano do kolejki indeksowania!")
+                            time.sleep(0.5)
+                            st.rerun()
 
                     with st.expander("📤 Udostępnianie"):
                         target_u = st.text_input("Dodaj login", key=f"share_in_{cid}")
@@ -134,7 +164,7 @@ def dashboard_view(user):
 
                         st.write("---")
                         st.caption("Mają dostęp:")
-                        permitted_users = db_utils.get_collection_permissions(cid)
+                        permitted_users = col["permissions"]
                         if not permitted_users:
                             st.caption("(Tylko Ty)")
                         else:
@@ -147,7 +177,7 @@ def dashboard_view(user):
 
                     if st.button("💬 Czat", key=f"open_{cid}", use_container_width=True):
                         st.session_state.active_col = (cid, name)
-                        st.session_state.messages = db_utils.load_active_chat(cid, user)
+                        st.session_state.messages = db_utils.load_active_chat(cid, user, limit=config.CHAT_PAGE_SIZE)
                         st.session_state.view = 'chat'
                         st.rerun()
 
@@ -155,43 +185,39 @@ def dashboard_view(user):
     with tab2:
         if not shared_cols: st.info("Brak udostępnionych projektów.")
         grid_s = st.columns(3)
-        for i, (cid, name, owner) in enumerate(shared_cols):
+        for i, col in enumerate(shared_cols):
+            cid, name, owner = col["id"], col["name"], col["owner"]
             with grid_s[i % 3]:
                 with st.container(border=True):
                     st.subheader(f"📂 {name}")
                     st.caption(f"👤 Właściciel: **{owner}**")
 
                     # --- ZARZĄDZANIE PLIKAMI (Dla Gościa) ---
-                    files = db_utils.get_collection_files(cid)
+                    files = col["files"]
                     with st.expander(f"📄 Pliki ({len(files)})"):
                         for f in files:
                             f1, f2 = st.columns([4, 1])
                             f1.write(f)
                             if f2.button("🗑️", key=f"sh_del_{cid}_{f}"):
-                                rag_core.delete_file_from_storage(owner, f)
+                                # Wektory zostają dla innych kolekcji właściciela; nieużywane usunie collect_garbage
                                 db_utils.remove_file_from_collection(cid, f)
                                 st.rerun()
 
                         st.write("---")
                         guest_files = st.file_uploader("Dodaj pliki", accept_multiple_files=True, key=f"sh_up_{cid}")
                         if guest_files and st.button("Wgraj", key=f"btn_sh_up_{cid}"):
-                            with st.spinner("Wgrywanie do projektu właściciela..."):
-                                for gf in guest_files:
-                                    path = os.path.join(config.TEMP_UPLOAD_DIR, gf.name)
-                                    os.makedirs(config.TEMP_UPLOAD_DIR, exist_ok=True)
-                                    with open(path, "wb") as bf: bf.write(gf.getvalue())
-                                    # TU JEST MAGIA: Zapisujemy wektory jako 'owner'
-                                    rag_core.process_file(path, gf.name, owner)
-                                    db_utils.add_file_to_collection(cid, gf.name)
-                                st.success("Dodano plik do współdzielonego projektu!")
-                                time.sleep(0.5)
-                                st.rerun()
+                            for gf in guest_files:
+                                # TU JEST MAGIA: Zapisujemy wektory jako 'owner'
+                                upload_staging.enqueue_upload(gf, user, owner, cid)
+                            st.success("Pliki czekają na indeksowanie w projekcie właściciela!")
+                            time.sleep(0.5)
+                            st.rerun()
 
                     b_join, b_leave = st.columns([3, 1])
                     with b_join:
                         if st.button("💬 Dołącz", key=f"open_shared_{cid}", use_container_width=True):
                             st.session_state.active_col = (cid, name)
-                            st.session_state.messages = db_utils.load_active_chat(cid, user)
+                            st.session_state.messages = db_utils.load_active_chat(cid, user, limit=config.CHAT_PAGE_SIZE)
                             st.session_state.view = 'chat'
                             st.rerun()
                     with b_leave:
@@ -228,18 +254,12 @@ def create_view(user):
         up = st.file_uploader("Dodaj pliki", accept_multiple_files=True)
 
     if st.button("🚀 Utwórz"):
-        with st.spinner("Przetwarzanie..."):
-            all_f = selected.copy()
-            if up:
-                for f in up:
-                    path = os.path.join(config.TEMP_UPLOAD_DIR, f.name)
-                    os.makedirs(config.TEMP_UPLOAD_DIR, exist_ok=True)
-                    with open(path, "wb") as bf: bf.write(f.getvalue())
-                    rag_core.process_file(path, f.name, user)
-                    all_f.append(f.name)
-            db_utils.create_collection(name, user, all_f)
-            st.session_state.view = 'dashboard';
-            st.rerun()
+        # Wgrane pliki trafią do kolekcji, gdy worker skończy ich indeksowanie
+        cid = db_utils.create_collection(name, user, selected)
+        for f in up or []:
+            upload_staging.enqueue_upload(f, user, user, cid)
+        st.session_state.view = 'dashboard';
+        st.rerun()
     if st.button("Anuluj"): st.session_state.view = 'dashboard'; st.rerun()
 
 
@@ -263,6 +283,14 @@ def chat_view(user):
             st.session_state.view = 'dashboard'
             st.rerun()
 
+    # Z bazy ładujemy tylko ostatnią stronę rozmowy; starsze wiadomości dociągamy na żądanie
+    msgs = st.session_state.messages
+    if msgs and msgs[0].get("seq", 0) > 0:
+        if st.button("⬆️ Wcześniejsze wiadomości"):
+            older = db_utils.load_active_chat(cid, user, limit=config.CHAT_PAGE_SIZE, before_seq=msgs[0]["seq"])
+            st.session_state.messages = older + msgs
+            st.rerun()
+
     for m in st.session_state.messages:
         with st.chat_message(m["role"]):
             st.markdown(m["content"])
@@ -270,20 +298,37 @@ def chat_view(user):
     p = st.chat_input("Zadaj pytanie...")
 
     if p:
+        history = list(st.session_state.messages)
         st.session_state.messages.append({"role": "user", "content": p})
         with st.chat_message("user"):
             st.markdown(p)
 
         with st.chat_message("assistant"):
             with st.spinner("Generowanie odpowiedzi..."):
-                chain = rag_core.get_collection_chain(cid)
-                if chain:
-                    response = chain.invoke(p)
-                    st.markdown(response)
-                    st.session_state.messages.append({"role": "assistant", "content": response})
-                    db_utils.save_active_chat(cid, user, st.session_state.messages)
+                # Pytanie uzupełniające ("a ile to w euro?") zamieniamy na samodzielne - ono trafia do wyszukiwania i cache
+                turn = rag_core.prepare_turn(cid, user, p, history)
+                if turn["cacheable"]:
+                    cached, probe = rag_core.lookup_cached_answer(cid, turn["standalone"])
                 else:
-                    st.error("Błąd: Nie można połączyć się z modelem RAG dla tej kolekcji.")
+                    cached, probe = None, None  # bez probe store_cached_answer też nic nie zapisze
+                chain = None if cached else rag_core.get_collection_chain(cid)
+            if cached:
+                st.markdown(cached)
+                st.caption("⚡ Odpowiedź z cache (podobne pytanie padło już w tej kolekcji)")
+                st.session_state.messages.append({"role": "assistant", "content": cached})
+                db_utils.save_active_chat(cid, user, st.session_state.messages)
+            elif chain:
+                # Tokeny pokazujemy na bieżąco; pełną odpowiedź zapisujemy dopiero po końcu strumienia
+                gen_stats = {}
+                response = st.write_stream(rag_core.stream_answer(chain, turn, gen_stats))
+                st.session_state.messages.append({"role": "assistant", "content": response})
+                db_utils.save_active_chat(cid, user, st.session_state.messages)
+                rag_core.store_cached_answer(cid, turn["standalone"], probe, response, gen_stats.get("total_s", 0.0))
+            else:
+                st.error("Błąd: Nie można połączyć się z modelem RAG dla tej kolekcji.")
+        # Po odpowiedzi: starsze wiadomości przechodzą do streszczenia, żeby prompt nie rósł z długością rozmowy
+        # (w tle - kolejna tura najwyżej użyje jeszcze starego streszczenia)
+        rag_core.refresh_chat_summary_async(cid, user, list(st.session_state.messages))
 
 
 # --- WIDOK HISTORII ---
@@ -300,7 +345,26 @@ def history_view(user):
         st.success("Wyczyszczono historię.")
         st.rerun()
 
-    archives = db_utils.get_user_history(user)
+    # --- FILTRY (wykonywane w SQL) ---
+    col_opts = dict(db_utils.get_history_collections(user))
+    f1, f2 = st.columns([2, 2])
+    col_filter = f1.selectbox("Projekt", [None] + list(col_opts),
+                              format_func=lambda c: "Wszystkie" if c is None else col_opts[c])
+    dates = f2.date_input("Zakres dat", value=(), format="YYYY-MM-DD")
+    date_from = dates[0] if len(dates) > 0 else None
+    date_to = dates[1] + datetime.timedelta(days=1) if len(dates) > 1 else None
+
+    # Stos kursorów: zmiana filtrów wraca na pierwszą stronę
+    filters = (col_filter, date_from, date_to)
+    if st.session_state.get("hist_filters") != filters:
+        st.session_state.hist_filters = filters
+        st.session_state.hist_cursors = [None]
+    cursors = st.session_state.hist_cursors
+
+    page_size = config.HISTORY_PAGE_SIZE
+    # Jeden wiersz ponad stronę mówi, czy jest następna strona
+    rows = db_utils.get_user_history(user, col_filter, date_from, date_to, after=cursors[-1], limit=page_size + 1)
+    archives, has_next = rows[:page_size], len(rows) > page_size
 
     if not archives:
         st.info("Brak zarchiwizowanych rozmów.")
@@ -319,6 +383,7 @@ def history_view(user):
                 with col_btn:
                     if st.button("👁️", key=f"arch_{aid}", help="Zobacz szczegóły"):
                         st.session_state.selected_arch_id = aid
+                        st.session_state.arch_page = 0
                         st.session_state.view = 'history_detail'
                         st.rerun()
 
@@ -330,17 +395,35 @@ def history_view(user):
                 time.sleep(0.5)
                 st.rerun()
 
+    n1, n2, n3 = st.columns([1, 2, 1])
+    if len(cursors) > 1 and n1.button("⬅️ Nowsze"):
+        cursors.pop(); st.rerun()
+    n2.caption(f"Strona {len(cursors)}")
+    if has_next and n3.button("Starsze ➡️"):
+        last = archives[-1]
+        cursors.append((last[2], last[0])); st.rerun()
+
 
 # --- WIDOK SZCZEGÓŁÓW HISTORII ---
 def history_detail_view():
     st.title("📖 Podgląd Rozmowy")
     if st.button("⬅️ Powrót do listy"): st.session_state.view = 'history'; st.rerun()
 
-    messages = db_utils.get_archive_detail(st.session_state.selected_arch_id)
+    page = st.session_state.get("arch_page", 0)
+    # Jedna wiadomość ponad stronę mówi, czy jest następna strona
+    messages = db_utils.get_archive_detail(st.session_state.selected_arch_id,
+                                           limit=config.CHAT_PAGE_SIZE + 1, offset=page * config.CHAT_PAGE_SIZE) or []
+    has_next = len(messages) > config.CHAT_PAGE_SIZE
     st.warning("To jest widok archiwalny - nie możesz kontynuować tej rozmowy.")
-    for m in messages:
+    for m in messages[:config.CHAT_PAGE_SIZE]:
         with st.chat_message(m["role"]): st.markdown(m["content"])
 
+    n1, n2 = st.columns(2)
+    if page > 0 and n1.button("⬅️ Poprzednie"):
+        st.session_state.arch_page = page - 1; st.rerun()
+    if has_next and n2.button("Następne ➡️"):
+        st.session_state.arch_page = page + 1; st.rerun()
+
 
 # --- ROUTER ---
 if not st.session_state.logged_in:
@@ -0,0 +1,582 @@
+"""Benchmarki wydajności RAG. Wyniki w JSON, żeby dało się je porównywać między wersjami.
+
+    python benchmark.py --out bench.json all            # offline: deterministyczny embedder i LLM
+    python benchmark.py --real-ollama all               # z prawdziwymi modelami Ollamy
+    python benchmark.py index --sizes 10000,100000,1000000
+    python benchmark.py chunking                        # strategie dzielenia na temp_uploads/
+    python benchmark.py extract --workers 1,2,4         # skalowanie ekstrakcji PDF na rdzenie
+    python benchmark.py quantization --source embeddings  # halfvec/binary/obcięte wymiary vs pełne wektory
+"""
+import argparse, contextlib, json, os, random, statistics, subprocess, sys, time, uuid
+from datetime import datetime
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import FakeStreamingListLLM
+import config, db_utils, rag_core, pdf_extract
+from ollama_stub import stub_embed_documents
+
+BENCH_TABLE = "bench_embedding"
+BENCH_USER = "__bench__"
+BENCH_QUESTIONS = [
+    "Jaka jest kwota brutto na fakturze?",
+    "Kto jest sprzedawcą i jaki ma NIP?",
+    "Jaki jest termin płatności?",
+    "Jak odkamienić ekspres do kawy?",
+    "Jaki jest zasięg hulajnogi elektrycznej?",
+    "Jaki przebieg ma Toyota Yaris z oferty?",
+    "Jaki jest numer VIN samochodu?",
+    "Jakie były wnioski z post mortem awarii?",
+    "Jaki poziom glukozy wyszedł w badaniu?",
+    "Ile punktów na mecz zdobywa zawodnik?",
+    "Czy kobra królewska jest jadowita?",
+    "Gdzie występuje tajpan pustynny?",
+]
+
+
+def _progress(*args):
+    # Postęp na stderr - stdout bez --out zawiera wyłącznie raport JSON
+    print(*args, file=sys.stderr, flush=True)
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    pick = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)]
+    return {"p50_ms": pick(0.5) * 1000, "p95_ms": pick(0.95) * 1000, "p99_ms": pick(0.99) * 1000,
+            "mean_ms": statistics.mean(samples) * 1000}
+
+
+def _random_vector(dim):
+    return [random.uniform(-1, 1) for _ in range(dim)]
+
+
+def _vector_literal(vec):
+    return "[" + ",".join(f"{v:.6f}" for v in vec) + "]"
+
+
+# --- INDEKSY WEKTOROWE ---
+def _fill_bench_table(cur, target, users, files_per_user):
+    """Dopełnia tabelę losowymi wektorami (generowanymi po stronie serwera) do target wierszy."""
+    cur.execute(f"SELECT count(*) FROM {BENCH_TABLE}")
+    have = cur.fetchone()[0]
+    batch = 50000
+    while have < target:
+        n = min(batch, target - have)
+        cur.execute(f"""
+            INSERT INTO {BENCH_TABLE} (embedding, cmetadata)
+            SELECT (SELECT array_agg(random() - 0.5 + g * 0) FROM generate_series(1, %s))::vector,
+                   jsonb_build_object('username', 'user' || (g %% %s), 'source_file', f.name, 'document_id', f.name)
+            FROM generate_series(%s, %s) g,
+                 LATERAL (SELECT 'plik_' || (g %% %s) || '_' || ((g / %s) %% %s) || '.pdf' AS name) f
+        """, (config.EMBEDDING_DIM, users, have + 1, have + n, users, users, files_per_user))
+        have += n
+
+
+def _drop_bench_indexes(cur):
+    cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s AND indexname <> %s",
+                (BENCH_TABLE, f"{BENCH_TABLE}_pkey"))
+    for (name,) in cur.fetchall():
+        cur.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def _run_index_queries(cur, queries, k):
+    """Mierzy typowe zapytanie czatu: wyszukiwanie wektorowe z filtrem po dokumentach kolekcji."""
+    search, results = [], []
+    for vec, files in queries:
+        t0 = time.perf_counter()
+        cur.execute(f"""
+            SELECT id FROM {BENCH_TABLE}
+            WHERE cmetadata ->> 'document_id' = ANY(%s)
+            ORDER BY embedding <=> %s::vector LIMIT %s
+        """, (files, _vector_literal(vec), k))
+        results.append([r[0] for r in cur.fetchall()])
+        search.append(time.perf_counter() - t0)
+    return {"filtered_search": _percentiles(search)}, results
+
+
+def bench_index(args):
+    sizes = [int(x) for x in args.sizes.split(",")]
+    random.seed(args.seed)
+    report = {"benchmark": "index", "index": config.VECTOR_INDEX, "dim": config.EMBEDDING_DIM, "runs": []}
+    with db_utils.db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        cur.execute(f"DROP TABLE IF EXISTS {BENCH_TABLE}")
+        cur.execute(f"CREATE TABLE {BENCH_TABLE} (id BIGSERIAL PRIMARY KEY, embedding vector({config.EMBEDDING_DIM}), cmetadata JSONB)")
+        if config.VECTOR_INDEX == "hnsw":
+            cur.execute(f"SET LOCAL hnsw.ef_search = {config.HNSW_EF_SEARCH}")
+        try:
+            for size in sizes:
+                _drop_bench_indexes(cur)
+                t0 = time.perf_counter()
+                _fill_bench_table(cur, size, args.users, args.files_per_user)
+                cur.execute(f"ANALYZE {BENCH_TABLE}")
+                fill_s = time.perf_counter() - t0
+
+                queries = []
+                for _ in range(args.queries):
+                    u = random.randrange(args.users)
+                    files = [f"plik_{u}_{random.randrange(args.files_per_user)}.pdf" for _ in range(args.files_per_query)]
+                    queries.append((_random_vector(config.EMBEDDING_DIM), files))
+
+                before, exact = _run_index_queries(cur, queries, args.k)
+                t0 = time.perf_counter()
+                for stmt in rag_core.vector_index_statements(BENCH_TABLE):
+                    cur.execute(stmt)
+                cur.execute(f"ANALYZE {BENCH_TABLE}")
+                build_s = time.perf_counter() - t0
+                after, approx = _run_index_queries(cur, queries, args.k)
+
+                overlaps = [len(set(a) & set(e)) / len(e) for a, e in zip(approx, exact) if e]
+                recall = statistics.mean(overlaps) if overlaps else 0.0
+                run = {"rows": size, "fill_s": fill_s, "index_build_s": build_s, "before": before, "after": after,
+                       f"recall_at_{args.k}": recall}
+                report["runs"].append(run)
+                _progress(f"{size} wierszy: wyszukiwanie p50 {before['filtered_search']['p50_ms']:.1f} ms -> "
+                      f"{after['filtered_search']['p50_ms']:.1f} ms, recall {recall:.3f}")
+        finally:
+            if not args.keep:
+                cur.execute(f"DROP TABLE IF EXISTS {BENCH_TABLE}")
+    return report
+
+
+def _parse_variant(text):
+    """"halfvec@256" -> ("halfvec", 256); bez @ - pełny wymiar (0)."""
+    storage, _, dim = text.strip().partition("@")
+    return storage, int(dim or 0)
+
+
+def _index_bytes(cur):
+    cur.execute("SELECT COALESCE(sum(pg_relation_size(indexrelid)), 0) FROM pg_index "
+                "WHERE indrelid = %s::regclass AND NOT indisprimary", (BENCH_TABLE,))
+    return cur.fetchone()[0]
+
+
+def bench_quantization(args):
+    """Rozmiar indeksu ANN, opóźnienie i recall@k trybów VECTOR_STORAGE względem dokładnego wyszukiwania float32."""
+    random.seed(args.seed)
+    variants = [_parse_variant(v) for v in args.variants.split(",")]
+    report = {"benchmark": "quantization", "index": config.VECTOR_INDEX, "source": args.source,
+              "rescore_factor": config.RESCORE_FACTOR, "runs": []}
+    with db_utils.db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        cur.execute(f"DROP TABLE IF EXISTS {BENCH_TABLE}")
+        cur.execute(f"CREATE TABLE {BENCH_TABLE} (id BIGSERIAL PRIMARY KEY, embedding vector({config.EMBEDDING_DIM}), cmetadata JSONB)")
+        if config.VECTOR_INDEX == "hnsw":
+            cur.execute(f"SET LOCAL hnsw.ef_search = {max(config.HNSW_EF_SEARCH, args.k * config.RESCORE_FACTOR)}")
+        try:
+            if args.source == "embeddings":
+                # Prawdziwe wektory nomic-embed-text - na losowych obcinanie wymiarów nie ma sensu
+                cur.execute(f"INSERT INTO {BENCH_TABLE} (embedding, cmetadata) "
+                            f"SELECT embedding, cmetadata FROM langchain_pg_embedding LIMIT %s", (args.rows,))
+            else:
+                _fill_bench_table(cur, args.rows, 1, 1)
+            cur.execute(f"ANALYZE {BENCH_TABLE}")
+            cur.execute(f"SELECT id FROM {BENCH_TABLE}")
+            ids = [r[0] for r in cur.fetchall()]
+            if not ids:
+                _progress("Brak wektorów do benchmarku (najpierw zaindeksuj dokumenty albo użyj --source random).")
+                return report
+            report["rows"] = len(ids)
+            cur.execute(f"SELECT pg_relation_size('{BENCH_TABLE}')")
+            report["table_bytes"] = cur.fetchone()[0]
+
+            # Zapytaniem jest wektor z tabeli; sam wiersz jest wykluczany, żeby nie zawyżał recall
+            queries = []
+            for qid in random.sample(ids, min(args.queries, len(ids))):
+                cur.execute(f"SELECT embedding::text FROM {BENCH_TABLE} WHERE id = %s", (qid,))
+                queries.append((qid, cur.fetchone()[0]))
+            exact = []
+            for qid, vec in queries:
+                cur.execute(f"SELECT id FROM {BENCH_TABLE} WHERE id <> %s ORDER BY embedding <=> %s::vector LIMIT %s",
+                            (qid, vec, args.k))
+                exact.append({r[0] for r in cur.fetchall()})
+
+            meta_stmts = len(rag_core.vector_index_statements(BENCH_TABLE, ann=False))
+            for storage, dim in variants:
+                _drop_bench_indexes(cur)
+                t0 = time.perf_counter()
+                for stmt in rag_core.vector_index_statements(BENCH_TABLE, storage=storage, truncate_dim=dim)[meta_stmts:]:
+                    cur.execute(stmt)
+                cur.execute(f"ANALYZE {BENCH_TABLE}")
+                build_s = time.perf_counter() - t0
+                index_bytes = _index_bytes(cur)
+
+                sql = rag_core.vector_search_sql(BENCH_TABLE, "WHERE e.id <> %(self)s", storage, dim)
+                latencies, overlaps = [], []
+                for (qid, vec), truth in zip(queries, exact):
+                    t0 = time.perf_counter()
+                    cur.execute(f"SELECT id FROM ({sql}) r", {"self": qid, "q": vec, "k": args.k,
+                                                              "fetch": args.k * config.RESCORE_FACTOR})
+                    found = {r[0] for r in cur.fetchall()}
+                    latencies.append(time.perf_counter() - t0)
+                    if truth:
+                        overlaps.append(len(found & truth) / len(truth))
+                recall = statistics.mean(overlaps) if overlaps else 0.0
+                run = {"storage": storage, "truncate_dim": dim or None, "index_bytes": index_bytes,
+                       "index_build_s": build_s, "search": _percentiles(latencies), f"recall_at_{args.k}": recall}
+                report["runs"].append(run)
+                _progress(f"{storage}{'@' + str(dim) if dim else ''}: indeks {index_bytes / 2**20:.1f} MB, "
+                      f"p50 {run['search']['p50_ms']:.1f} ms, recall {recall:.3f}")
+        finally:
+            if not args.keep:
+                cur.execute(f"DROP TABLE IF EXISTS {BENCH_TABLE}")
+    return report
+
+
+# Pytania z oczekiwanym plikiem źródłowym - dokładne tokeny (VIN, NIP, numery faktur) i pytania opisowe
+LABELLED_QUERIES = [
+    ("Czego dotyczy faktura z VIN WF0AXXGBVA1234567?", "Faktura_8_Leasing_VIN.pdf"),
+    ("Kto ma NIP 525-000-11-22?", "Faktura_12_Hurt_Elektronika.pdf"),
+    ("Ile wynosi kwota brutto na fakturze SERV/2024/07?", "Faktura_7_Rabaty.pdf"),
+    ("Jaki kurs EUR przyjęto na fakturze FV/EXP/2024/09/14?", "Faktura_14_Transport_EUR.pdf"),
+    ("Na ile dni ważna jest pro-forma PF/2024/11?", "Faktura_11_ProForma.pdf"),
+    ("Jaka jest cena Toyoty Yaris 1.5 Hybrid?", "Oferta_1_Toyota_Yaris.pdf"),
+    ("Jaki przebieg ma BMW E90 320d?", "Oferta_2_BMW_E90_Igla.pdf"),
+    ("Którego auta dotyczy VIN TMBRS123456789000?", "Oferta_5_Skoda_Octavia_Leasing.pdf"),
+    ("Jaki wynik HbA1c miał pacjent?", "Wynik_2_Cukrzyca.pdf"),
+    ("Jaki był poziom ferrytyny?", "Wynik_3_Anemia.pdf"),
+    ("Jak wymienić filtr HEPA?", "Instrukcja_4_Oczyszczacz_Powietrza.pdf"),
+    ("Jak sparować słuchawki AudioSpace Air przez Bluetooth?", "Instrukcja_3_Sluchawki_BT.pdf"),
+    ("Co było przyczyną awarii bazy danych PROD?", "Raport_4_Awaria_PostMortem.pdf"),
+    ("Na jaki rynek zarząd zdecydował się rozszerzyć działalność?", "Raport_3_Zarzad_Strategia.pdf"),
+    ("Ile punktów na mecz zdobywa Marcus Johnson?", "Scout_1_Gwiazda_NBA.pdf"),
+    ("Jaka jest łacińska nazwa tajpana pustynnego?", "Tajpan_pustynny.pdf"),
+]
+
+
+# --- OFFLINE: DETERMINISTYCZNE MODELE ---
+class DeterministicEmbeddings(Embeddings):
+    """Embedder bez Ollamy - wektory z hasha tekstu, stabilne między uruchomieniami."""
+
+    def embed_documents(self, texts):
+        return stub_embed_documents(texts)
+
+    def embed_query(self, text):
+        return stub_embed_documents([text])[0]
+
+
+def _setup_models(args):
+    """Bez --real-ollama podmienia modele. Dane benchmarku i tak leżą w osobnej partycji BENCH_USER."""
+    if args.real_ollama:
+        return None
+    rag_core.embeddings = DeterministicEmbeddings()
+    rag_core.llm = FakeStreamingListLLM(responses=["Odpowiedź testowa benchmarku na podstawie pliku X.pdf."])
+    return rag_core.embeddings.embed_documents
+
+
+def _bench_documents(docs_dir, limit):
+    """PDF-y z katalogu (rekurencyjnie), bez duplikatów nazw - te same pliki leżą w kilku podkatalogach."""
+    seen = {}
+    for root, _, files in sorted(os.walk(docs_dir)):
+        for f in sorted(files):
+            if f.lower().endswith(".pdf") and f not in seen and not root.split(os.sep)[-1].startswith("."):
+                seen[f] = os.path.join(root, f)
+    docs = sorted(seen.items())
+    return docs[:limit] if limit else docs
+
+
+def _cleanup():
+    """Usuwa dane BENCH_USER razem z jego kolekcją PGVector i jej częściowym indeksem ANN."""
+    collection_name = rag_core.owner_collection_name(BENCH_USER)
+    with db_utils.db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM collections WHERE owner_username = %s", (BENCH_USER,))
+        cur.execute("SELECT uuid::text FROM langchain_pg_collection WHERE name = %s", (collection_name,))
+        r = cur.fetchone()
+        if r:
+            rag_core.drop_stale_ann_indexes(cur, f"emb_{uuid.UUID(r[0]).hex}_", [])
+            cur.execute("DELETE FROM langchain_pg_embedding WHERE collection_id = %s", (r[0],))
+            cur.execute("DELETE FROM langchain_pg_collection WHERE uuid = %s", (r[0],))
+        cur.execute("DELETE FROM file_fingerprints WHERE username = %s", (BENCH_USER,))
+        cur.execute("DELETE FROM documents WHERE owner_username = %s", (BENCH_USER,))
+    # Zapamiętany PGVector i UUID wskazywałyby na usuniętą kolekcję - następny zapis założy ją od nowa
+    with rag_core._vector_stores_lock:
+        rag_core._vector_stores.pop(BENCH_USER, None)
+    rag_core._collection_uuids.pop(BENCH_USER, None)
+
+
+def bench_ingest(args, embed_fn):
+    """Przepustowość process_file na dokumentach z temp_uploads."""
+    _cleanup()
+    docs = _bench_documents(args.docs_dir, args.limit)
+    totals = {"files": 0, "failed": 0, "pages": 0, "chunks": 0, "load_split_s": 0.0, "embed_s": 0.0, "write_s": 0.0}
+    per_file = []
+    t0 = time.perf_counter()
+    for name, path in docs:
+        pages = rag_core._count_pages(path, name)
+        stats = rag_core.process_file(path, name, BENCH_USER, embed_fn=embed_fn)
+        if not stats:
+            totals["failed"] += 1
+            continue
+        totals["files"] += 1
+        totals["pages"] += pages
+        for k in ("chunks", "load_split_s", "embed_s", "write_s"):
+            totals[k] += stats[k]
+        per_file.append({"file": name, "pages": pages, "chunks": stats["chunks"], "total_s": stats["total_s"]})
+    wall = time.perf_counter() - t0
+    totals.update({"wall_s": wall, "pages_per_s": totals["pages"] / wall if wall else 0.0,
+                   "chunks_per_s": totals["chunks"] / wall if wall else 0.0})
+    _progress(f"Indeksowanie: {totals['files']} plików, {totals['pages'] / wall:.1f} stron/s, "
+          f"{totals['chunks'] / wall:.1f} fragmentów/s")
+    return {"totals": totals, "files": per_file, "names": [n for n, _ in docs]}
+
+
+def bench_retrieval(args, names):
+    """Budowa łańcucha (zimny/ciepły cache) i opóźnienia odpowiedzi - z atrapą LLM to czysty narzut retrievalu."""
+    cid = db_utils.create_collection("benchmark", BENCH_USER, names)
+    t0 = time.perf_counter()
+    chain = rag_core.get_collection_chain(cid)
+    cold = time.perf_counter() - t0
+    warm = []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        rag_core.get_collection_chain(cid)
+        warm.append(time.perf_counter() - t0)
+
+    latencies, ttft = [], []
+    for _ in range(args.repeat):
+        for q in BENCH_QUESTIONS:
+            stats = {}
+            for _token in rag_core.stream_answer(chain, q, stats):
+                pass
+            latencies.append(stats["total_s"])
+            ttft.append(stats.get("ttft_s", stats["total_s"]))
+    _progress(f"Odpowiedź: p50 {_percentiles(latencies)['p50_ms']:.0f} ms, TTFT p50 {_percentiles(ttft)['p50_ms']:.0f} ms")
+    return {"chain_build_cold_ms": cold * 1000, "chain_build_warm": _percentiles(warm),
+            "answer": _percentiles(latencies), "ttft": _percentiles(ttft), "queries": len(latencies)}
+
+
+def bench_recall(args, names):
+    """Trafność wyboru pliku (recall@k) i rozmiar kontekstu dla trybów wyszukiwania na LABELLED_QUERIES."""
+    variants = [("vector", 15), ("vector", config.RETRIEVAL_K), ("hybrid", config.RETRIEVAL_K),
+                ("hybrid", config.RERANK_TOP_N)]
+    # BM25 na kandydatach hybrydowych: sam (waga 1) i zmieszany z pozycją RRF (RERANK_WEIGHT)
+    variants += [(f"rerank-w{w:g}", config.RERANK_TOP_N) for w in sorted({1.0, config.RERANK_WEIGHT})]
+    queries = [(q, f) for q, f in LABELLED_QUERIES if f in names]
+    document_ids = list(db_utils.get_document_ids(BENCH_USER, names).values())
+    results = {}
+    for mode, k in variants:
+        hits, chars, times = 0, [], []
+        for question, expected in queries:
+            t0 = time.perf_counter()
+            if mode.startswith("rerank"):
+                candidates = rag_core.retrieve_documents(BENCH_USER, document_ids, question, k=config.RERANK_CANDIDATES)
+                docs = rag_core.rerank(question, candidates, top_n=k, scorer=rag_core.lexical_overlap_scores,
+                                       weight=float(mode[len("rerank-w"):]))
+            else:
+                docs = rag_core.retrieve_documents(BENCH_USER, document_ids, question, k=k, mode=mode)
+            times.append(time.perf_counter() - t0)
+            hits += any(d.metadata.get("source_file") == expected for d in docs)
+            chars.append(sum(len(d.page_content) for d in docs))
+        recall = hits / len(queries) if queries else 0.0
+        results[f"{mode}@{k}"] = {"recall": recall, "context_chars_mean": statistics.mean(chars) if chars else 0,
+                                  "latency": _percentiles(times)}
+        _progress(f"{mode}@{k}: recall {recall:.2f}, kontekst {results[f'{mode}@{k}']['context_chars_mean']:.0f} znaków")
+    return {"queries": len(queries), "variants": results}
+
+
+# --- EKSTRAKCJA PDF ---
+def bench_extract(args):
+    """Strony/s ekstrakcji tekstu: jeden proces vs pula pdf_extract z różną liczbą procesów - bez bazy."""
+    paths = [path for _, path in _bench_documents(args.docs_dir, args.limit)]
+    t0 = time.perf_counter()
+    pages = sum(len(pdf_extract._extract_range(p, 0, pdf_extract.count_pages(p))) for p in paths)
+    baseline = time.perf_counter() - t0
+    results = {"sequential": {"wall_s": baseline, "pages_per_s": pages / baseline if baseline else 0.0}}
+    _progress(f"1 proces (bez puli): {pages / baseline:.1f} stron/s")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        config.EXTRACT_WORKERS = workers
+        pdf_extract._reset_pool()
+        # Rozgrzanie puli (start procesów spawn) nie wchodzi do pomiaru
+        pdf_extract.get_pool().submit(int).result()
+        t0 = time.perf_counter()
+        done = sum(len(res) for _, res in pdf_extract.extract_many(paths) if not isinstance(res, Exception))
+        wall = time.perf_counter() - t0
+        results[f"pool_{workers}"] = {"wall_s": wall, "pages": done, "pages_per_s": done / wall if wall else 0.0,
+                                      "speedup": baseline / wall if wall else 0.0}
+        _progress(f"pula {workers} procesów: {done / wall:.1f} stron/s, x{baseline / wall:.2f}")
+    pdf_extract._reset_pool()
+    return {"benchmark": "extract", "meta": _bench_meta(args), "files": len(paths), "pages": pages,
+            "cpu_count": os.cpu_count(), "results": results}
+
+
+# --- DZIELENIE NA FRAGMENTY ---
+def bench_chunking(args):
+    """Liczba i rozmiar fragmentów oraz hit@k na LABELLED_QUERIES dla obu strategii dzielenia - bez bazy.
+
+    Offline fragmenty są rankowane BM25, z --real-ollama podobieństwem embeddingów.
+    """
+    names = {path: name for name, path in _bench_documents(args.docs_dir, args.limit)}
+    pages = {names[path]: res for path, res in pdf_extract.extract_many(names) if not isinstance(res, Exception)}
+    queries = [(q, f) for q, f in LABELLED_QUERIES if f in pages]
+    results = {}
+    for strategy in ("recursive", "structured"):
+        t0 = time.perf_counter()
+        chunks = []
+        for name, doc_pages in pages.items():
+            split = rag_core.make_splitter(name, strategy)
+            for page in doc_pages:
+                chunks.extend((name, c.page_content) for c in split(page))
+        split_s = time.perf_counter() - t0
+        texts = [t for _, t in chunks]
+        vectors = rag_core.embeddings.embed_documents(texts) if args.real_ollama else None
+        hits = 0
+        for question, expected in queries:
+            if vectors:
+                qv = rag_core.embeddings.embed_query(question)
+                scores = [rag_core._cosine(qv, v) for v in vectors]
+            else:
+                scores = rag_core.lexical_overlap_scores(question, texts)
+            top = sorted(range(len(texts)), key=scores.__getitem__, reverse=True)[:args.k]
+            hits += any(chunks[i][0] == expected for i in top)
+        sizes = [len(t) for t in texts]
+        results[strategy] = {"chunks": len(texts), "chars_total": sum(sizes),
+                             "chunk_chars_mean": statistics.mean(sizes) if sizes else 0,
+                             "split_ms": split_s * 1000, f"hit_at_{args.k}": hits / len(queries) if queries else 0.0}
+        _progress(f"{strategy}: {len(texts)} fragmentów, {sum(sizes)} znaków, "
+              f"hit@{args.k} {results[strategy][f'hit_at_{args.k}']:.2f}")
+    return {"benchmark": "chunking", "meta": _bench_meta(args), "files": len(pages), "queries": len(queries),
+            "scoring": "embeddings" if args.real_ollama else "bm25", "strategies": results}
+
+
+def _render_dashboard_reads(user):
+    """Te same odczyty z bazy, które wykonuje dashboard_view w app.py przy każdym renderze."""
+    db_utils.get_user_jobs(user)
+    db_utils.get_dashboard_snapshot(user)
+
+
+def bench_dashboard(args):
+    """Liczba wypożyczeń połączeń (= zapytań do bazy) i czas na jeden render dashboardu: bez cache (pierwszy
+    render / po zmianie) i z cache odczytów (kolejne reruny Streamlit)."""
+    _cleanup()
+    for i in range(args.collections):
+        db_utils.create_collection(f"bench_{i}", BENCH_USER, [f"plik_{i}_{j}.pdf" for j in range(3)])
+    report = {"collections": args.collections}
+    for label, cold in (("cold", True), ("warm", False)):
+        db_utils.invalidate_read_cache()
+        if not cold:
+            _render_dashboard_reads(BENCH_USER)
+        before = db_utils.get_pool_stats()["checkouts"]
+        times = []
+        for _ in range(args.repeat):
+            if cold:
+                db_utils.invalidate_read_cache()
+            t0 = time.perf_counter()
+            _render_dashboard_reads(BENCH_USER)
+            times.append(time.perf_counter() - t0)
+        calls = (db_utils.get_pool_stats()["checkouts"] - before) / args.repeat
+        _progress(f"Dashboard ({args.collections} kolekcji, {label}): {calls:.0f} zapytań na render")
+        report[label] = {"db_calls_per_render": calls, "render": _percentiles(times)}
+    return report
+
+
+def _bench_meta(args):
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        rev = None
+    return {"timestamp": datetime.now().isoformat(timespec="seconds"), "git": rev,
+            "models": "ollama" if args.real_ollama else "deterministic",
+            "config": {k: getattr(config, k) for k in ("EMBEDDING_MODEL", "LLM_MODEL", "CHUNKING_STRATEGY",
+                                                        "CHUNK_SIZE", "CHUNK_OVERLAP", "EXTRACT_WORKERS",
+                                                        "EMBED_BATCH_SIZE", "EMBED_WORKERS",
+                                                        "VECTOR_INDEX", "RETRIEVAL_MODE", "RETRIEVAL_K")}}
+
+
+def run_suite(args):
+    embed_fn = _setup_models(args)
+    report = {"benchmark": args.command, "meta": _bench_meta(args)}
+    try:
+        names = None
+        if args.command in ("ingest", "retrieval", "recall", "all"):
+            ingest = bench_ingest(args, embed_fn)
+            names = ingest.pop("names")
+            if args.command in ("ingest", "all"):
+                report["ingest"] = ingest
+        if args.command in ("retrieval", "all"):
+            report["retrieval"] = bench_retrieval(args, names)
+        if args.command in ("recall", "all"):
+            report["recall"] = bench_recall(args, names)
+        if args.command in ("dashboard", "all"):
+            report["dashboard"] = bench_dashboard(args)
+        report["pool"] = db_utils.get_pool_stats()
+        # Cache embeddingów działa tylko z prawdziwym modelem (--real-ollama); atrapa embed_fn go omija
+        report["cache"] = {"embedding": rag_core.get_embedding_cache_stats(), "answer": rag_core.get_answer_cache_stats()}
+    finally:
+        if not args.keep:
+            _cleanup()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarki RAG")
+    parser.add_argument("--out", help="plik JSON z wynikami (domyślnie stdout)")
+    parser.add_argument("--real-ollama", action="store_true", help="prawdziwe modele zamiast deterministycznych atrap")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    for name, help_text in (("ingest", "przepustowość process_file (strony/s, fragmenty/s)"),
+                            ("retrieval", "opóźnienia łańcucha RAG i TTFT (wymaga indeksowania)"),
+                            ("recall", "recall@k trybów wyszukiwania na oznaczonych pytaniach (sens z --real-ollama)"),
+                            ("dashboard", "zapytania do bazy i czas na render dashboardu"),
+                            ("all", "wszystkie powyższe")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("--docs-dir", default=config.TEMP_UPLOAD_DIR)
+        p.add_argument("--limit", type=int, default=0, help="maksymalna liczba plików (0 = wszystkie)")
+        p.add_argument("--repeat", type=int, default=5)
+        p.add_argument("--collections", type=int, default=50)
+        p.add_argument("--keep", action="store_true", help="nie usuwaj danych benchmarku")
+        p.set_defaults(func=run_suite)
+
+    p = sub.add_parser("chunking", help="liczba fragmentów i hit@k strategii dzielenia (bez bazy)")
+    p.add_argument("--docs-dir", default=config.TEMP_UPLOAD_DIR)
+    p.add_argument("--limit", type=int, default=0, help="maksymalna liczba plików (0 = wszystkie)")
+    p.add_argument("--k", type=int, default=config.RETRIEVAL_K)
+    p.set_defaults(func=bench_chunking)
+
+    p = sub.add_parser("extract", help="strony/s ekstrakcji PDF w puli procesów vs jeden proces (bez bazy)")
+    p.add_argument("--docs-dir", default=config.TEMP_UPLOAD_DIR)
+    p.add_argument("--limit", type=int, default=0, help="maksymalna liczba plików (0 = wszystkie)")
+    p.add_argument("--workers", default=",".join(str(w) for w in sorted({1, 2, 4, os.cpu_count() or 1})))
+    p.set_defaults(func=bench_extract)
+
+    p = sub.add_parser("index", help="opóźnienie zapytań do tabeli wektorów przed/po założeniu indeksów")
+    p.add_argument("--sizes", default="10000,100000,1000000")
+    p.add_argument("--queries", type=int, default=50)
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--files-per-user", type=int, default=20)
+    p.add_argument("--files-per-query", type=int, default=5)
+    p.add_argument("--k", type=int, default=15)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--keep", action="store_true", help="nie usuwaj tabeli benchmarku")
+    p.set_defaults(func=bench_index)
+
+    p = sub.add_parser("quantization", help="rozmiar indeksu, opóźnienie i recall halfvec/binary/obciętych wymiarów")
+    p.add_argument("--source", choices=("embeddings", "random"), default="embeddings",
+                   help="wektory z langchain_pg_embedding albo losowe")
+    p.add_argument("--rows", type=int, default=100000)
+    p.add_argument("--variants", default="full,halfvec,binary,full@256,halfvec@256",
+                   help="tryby VECTOR_STORAGE, opcjonalnie @wymiar (Matryoshka)")
+    p.add_argument("--queries", type=int, default=100)
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--keep", action="store_true", help="nie usuwaj tabeli benchmarku")
+    p.set_defaults(func=bench_quantization)
+
+    args = parser.parse_args()
+    # Komunikaty z rag_core/db_utils też idą na stderr - stdout to wyłącznie raport JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.func not in (bench_chunking, bench_extract):
+            db_utils.init_db()
+        report = args.func(args)
+    out = json.dumps(report, indent=2, ensure_ascii=False, default=str)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(out)
+    else:
+        sys.stdout.write(out + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Import całego katalogu dokumentów bez przechodzenia przez Streamlit.
+
+Każdy podkatalog staje się kolekcją właściciela (--user), pliki leżące bezpośrednio w katalogu głównym
+trafiają do kolekcji o nazwie katalogu. Postęp jest zapisywany w pliku stanu, więc przerwany import
+wystarczy uruchomić ponownie tą samą komendą:
+    python bulk_import.py temp_uploads --user admin --workers 4
+Do testów bez Ollamy:
+    python bulk_import.py temp_uploads --user test --stub-embeddings
+"""
+import argparse, json, os, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import config, db_utils, rag_core
+
+SUPPORTED = (".pdf", ".txt")
+
+
+def scan(root):
+    """{nazwa kolekcji: [(ścieżka względna, ścieżka, nazwa pliku)]} - ukryte katalogi (np. .staging) są pomijane."""
+    root = os.path.abspath(root)
+    groups = {}
+    for dirpath, dirnames, files in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        rel_dir = os.path.relpath(dirpath, root)
+        name = os.path.basename(root) if rel_dir == "." else rel_dir.replace(os.sep, " / ")
+        for f in sorted(files):
+            if f.lower().endswith(SUPPORTED):
+                rel = os.path.normpath(os.path.join(rel_dir, f))
+                groups.setdefault(name, []).append((rel, os.path.join(dirpath, f), f))
+    return groups
+
+
+class ImportState:
+    """Plik JSON z postępem: done/failed - zakończone. Zapis atomowy po każdym pliku."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {"done": {}, "failed": {}}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.data.update(json.load(f))
+            self.data.pop("started", None)  # pole ze starszych wersji pliku stanu
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+
+    def is_done(self, rel):
+        return rel in self.data["done"]
+
+    def mark(self, rel, key, value=None):
+        with self.lock:
+            self.data[key][rel] = value
+            if key == "done":
+                self.data["failed"].pop(rel, None)
+            self._save()
+
+
+_name_locks = {}
+_name_locks_guard = threading.Lock()
+
+
+def _name_lock(name):
+    # Wektory są kluczowane (użytkownik, nazwa pliku) - ta sama nazwa w dwóch katalogach nie może iść równolegle
+    with _name_locks_guard:
+        return _name_locks.setdefault(name, threading.Lock())
+
+
+def import_file(state, cid, rel, path, name, user, embed_fn=None):
+    with _name_lock(name):
+        # Po przerwanym imporcie zostają wektory części pliku - ingest_file porównuje je z nową wersją
+        # (te same fragmenty zostają, pozostałe są kasowane), więc nie trzeba ich usuwać wcześniej
+        stats = rag_core.ingest_file(path, name, user, embed_fn=embed_fn)
+    db_utils.add_file_to_collection(cid, name)
+    state.mark(rel, "done", {"chunks": stats["chunks"], "pages": stats["pages"], "skipped": stats["skipped"]})
+    return stats
+
+
+def run(root, user, workers, state_path=None, embed_fn=None):
+    groups = scan(root)
+    state = ImportState(state_path or os.path.join(root, ".bulk_import.json"))
+    totals = {"files": 0, "resumed": 0, "unchanged": 0, "failed": 0, "pages": 0, "chunks": 0}
+
+    jobs = []
+    for col_name, files in groups.items():
+        cid = db_utils.get_owned_collection_id(user, col_name) or db_utils.create_collection(col_name, user, [])
+        for rel, path, name in files:
+            if state.is_done(rel):
+                totals["resumed"] += 1
+            else:
+                jobs.append((cid, rel, path, name))
+    print(f"Kolekcje: {len(groups)}, plików do zaindeksowania: {len(jobs)}, pominiętych (już zrobione): {totals['resumed']}")
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = {pool.submit(import_file, state, cid, rel, path, name, user, embed_fn): rel
+                   for cid, rel, path, name in jobs}
+        for fut in as_completed(futures):
+            rel = futures[fut]
+            try:
+                stats = fut.result()
+            except Exception as e:
+                print(f"Błąd importu {rel}: {e}")
+                state.mark(rel, "failed", str(e))
+                totals["failed"] += 1
+                continue
+            totals["files"] += 1
+            totals["unchanged"] += stats["skipped"]
+            totals["pages"] += stats["pages"]
+            totals["chunks"] += stats["chunks"]
+            elapsed = time.perf_counter() - t0
+            print(f"[{totals['files'] + totals['failed']}/{len(jobs)}] {rel}: {stats['chunks']} fragmentów "
+                  f"({totals['pages'] / elapsed:.1f} stron/s, {totals['chunks'] / elapsed:.1f} fragmentów/s)")
+
+    wall = time.perf_counter() - t0
+    totals["wall_s"] = wall
+    for key in ("files", "pages", "chunks"):
+        totals[f"{key}_per_s"] = totals[key] / wall if wall else 0.0
+    print(f"Gotowe w {wall:.1f}s: {totals['files']} plików ({totals['unchanged']} bez zmian), "
+          f"{totals['failed']} błędów, {totals['files_per_s']:.2f} plików/s, {totals['pages_per_s']:.1f} stron/s, "
+          f"{totals['chunks_per_s']:.1f} fragmentów/s")
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import katalogu dokumentów do kolekcji RAG")
+    parser.add_argument("root", help="katalog z dokumentami (podkatalogi = kolekcje)")
+    parser.add_argument("--user", required=True, help="właściciel kolekcji i wektorów")
+    parser.add_argument("--workers", type=int, default=config.INGEST_WORKERS, help="pliki indeksowane równolegle")
+    parser.add_argument("--state", help="plik stanu (domyślnie <root>/.bulk_import.json)")
+    parser.add_argument("--stub-embeddings", action="store_true", help="deterministyczne wektory zamiast Ollamy")
+    args = parser.parse_args()
+    db_utils.init_db()
+    embed_fn = None
+    if args.stub_embeddings:
+        from ollama_stub import stub_embed_documents
+        embed_fn = stub_embed_documents
+    totals = run(args.root, args.user, args.workers, args.state, embed_fn)
+    raise SystemExit(1 if totals["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
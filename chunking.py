@@ -0,0 +1,174 @@
+"""Dzielenie dokumentów na fragmenty z zachowaniem struktury strony.
+
+Zamiast ciąć tekst co CHUNK_SIZE znaków, strona jest rozbijana na sekcje (nagłówki) i tabele (wiersze
+z liczbami), a potem małe kawałki są sklejane do rozmiaru z profilu. Fragment nigdy nie przechodzi
+przez granicę strony, więc metadane "page" zostają prawdziwe. Profil wybiera się po nazwie pliku.
+"""
+import re
+import config
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+# chunk_size / chunk_overlap - jak w RecursiveCharacterTextSplitter (overlap tylko przy cięciu długiego tekstu)
+# min_chunk - mniejsza sekcja jest doklejana do następnej zamiast tworzyć własny fragment
+PROFILES = {
+    # Jedna faktura to zwykle jedna strona: tabela pozycji ma zostać w całości razem z nagłówkiem kolumn
+    "faktura": {"chunk_size": 1500, "chunk_overlap": 0, "min_chunk": 400},
+    # Instrukcje: krótkie sekcje (kroki, rozwiązywanie problemów) - każda osobno, ale bez drobnicy
+    "instrukcja": {"chunk_size": 900, "chunk_overlap": 100, "min_chunk": 250},
+    # Ogłoszenie mieści się w jednym-dwóch fragmentach
+    "oferta": {"chunk_size": 1500, "chunk_overlap": 0, "min_chunk": 400},
+    "raport": {"chunk_size": 1000, "chunk_overlap": 150, "min_chunk": 300},
+    "default": {"chunk_size": config.CHUNK_SIZE, "chunk_overlap": config.CHUNK_OVERLAP, "min_chunk": config.CHUNK_MIN_SIZE},
+}
+
+# Prefiks nazwy pliku -> profil (wyniki badań mają układ raportu)
+_PREFIXES = {"faktura": "faktura", "instrukcja": "instrukcja", "oferta": "oferta", "raport": "raport", "wynik": "raport"}
+
+_NUMBER = re.compile(r"[\d.,]*\d[\d.,]*%?")
+
+
+def get_profile(name):
+    base = name.replace("\\", "/").rsplit("/", 1)[-1].lower()
+    for prefix, profile in _PREFIXES.items():
+        if base.startswith(prefix):
+            return profile
+    return "default"
+
+
+def _is_table_row(line):
+    # Wiersz pozycji faktury / tabeli wyników: kilka osobnych liczb w jednej linii.
+    # Daty (2024-06-15) i kody z literami się nie liczą.
+    tokens = line.split()
+    return len(tokens) >= 4 and sum(1 for t in tokens if _NUMBER.fullmatch(t)) >= 3
+
+
+def _is_heading(line):
+    if len(line) > 80 or len(line) < 4 or _is_table_row(line):
+        return False
+    if line.endswith(":") and len(line) <= 50:
+        return True
+    letters = [ch for ch in line if ch.isalpha()]
+    return len(letters) >= 4 and sum(ch.isupper() for ch in letters) / len(letters) >= 0.8
+
+
+class Chunker:
+    """Dzieli kolejne strony jednego dokumentu; pamięta bieżącą sekcję i nagłówek tabeli między stronami."""
+
+    def __init__(self, profile="default"):
+        self.profile = profile
+        self.opts = PROFILES[profile]
+        self.section = ""
+        self._table_header = None
+        self._splitter = RecursiveCharacterTextSplitter(chunk_size=self.opts["chunk_size"],
+                                                        chunk_overlap=self.opts["chunk_overlap"],
+                                                        add_start_index=True)
+
+    @classmethod
+    def for_file(cls, name):
+        return cls(get_profile(name))
+
+    def split(self, page):
+        """Fragmenty jednej strony (Document z pdf_extract/TextLoader) z metadanymi page/section/start_index."""
+        meta = {k: v for k, v in page.metadata.items() if k in ("source", "page")}
+        meta.setdefault("page", 0)
+        chunks = []
+        for text, start, section, kind in self._pack(self._units(page.page_content)):
+            chunks.append(Document(page_content=text, metadata={**meta, "start_index": start, "section": section,
+                                                                "chunk_type": kind, "profile": self.profile}))
+        return chunks
+
+    def _units(self, text):
+        """Bloki strony: akapit tekstu (nagłówek otwiera nowy) albo tabela (nagłówek kolumn + wiersze)."""
+        units, cur, offset = [], None, 0
+        for raw in text.splitlines(keepends=True):
+            line, start = raw.strip(), offset
+            offset += len(raw)
+            if not line:
+                continue
+            if _is_table_row(line):
+                if cur is None or cur["kind"] != "table":
+                    header = self._table_header if cur is None and not units else None
+                    # Krótka linia tuż nad tabelą to nagłówek kolumn - idzie z każdym kawałkiem tabeli
+                    if cur and cur["kind"] == "text" and len(cur["lines"][-1]) <= 150 and not cur["lines"][-1].endswith("."):
+                        header = cur["lines"].pop()
+                        if not cur["lines"]:
+                            units.pop()
+                    cur = {"kind": "table", "header": header, "lines": [], "offsets": [], "start": start,
+                           "section": self.section, "heading": False}
+                    units.append(cur)
+                    self._table_header = header
+                cur["lines"].append(line)
+                cur["offsets"].append(start)
+            elif _is_heading(line):
+                self.section = line
+                cur = {"kind": "text", "lines": [line], "start": start, "section": line, "heading": True}
+                units.append(cur)
+            else:
+                if cur is None or cur["kind"] != "text":
+                    cur = {"kind": "text", "lines": [], "start": start, "section": self.section, "heading": False}
+                    units.append(cur)
+                cur["lines"].append(line)
+        if cur is None or cur["kind"] != "table":
+            self._table_header = None
+        return units
+
+    def _pack(self, units):
+        """Skleja bloki do chunk_size; za duże tnie (tabele po wierszach, tekst splitterem)."""
+        size, min_chunk = self.opts["chunk_size"], self.opts["min_chunk"]
+        out, buf = [], []
+
+        def flush():
+            if buf:
+                kinds = {u["kind"] for u, _ in buf}
+                out.append(("\n".join(t for _, t in buf), buf[0][0]["start"], buf[0][0]["section"],
+                            kinds.pop() if len(kinds) == 1 else "mixed"))
+                buf.clear()
+
+        # Sekcja (nagłówek + bloki do następnego nagłówka) trafia w całości do jednego fragmentu, jeśli się mieści
+        sections = []
+        for u in units:
+            if u["heading"] or not sections:
+                sections.append([])
+            sections[-1].append((u, "\n".join(([u["header"]] if u.get("header") else []) + u["lines"])))
+
+        for section in sections:
+            buf_len = sum(len(t) + 1 for _, t in buf)
+            if buf_len >= min_chunk and buf_len + sum(len(t) + 1 for _, t in section) > size:
+                flush()
+            for u, text in section:
+                if len(text) > size:
+                    flush()
+                    pieces = self._split_large(u, text)
+                    out.extend(pieces[:-1])
+                    # Ostatni kawałek zwykle jest krótki - może się do niego dokleić następny blok
+                    text = pieces[-1][0]
+                    u = dict(u, start=pieces[-1][1])
+                if sum(len(t) + 1 for _, t in buf) + len(text) > size:
+                    flush()
+                buf.append((u, text))
+        flush()
+        return out
+
+    def _split_large(self, u, text):
+        if u["kind"] == "table":
+            # Każdy kawałek tabeli dostaje nagłówek kolumn (i sekcję), inaczej liczby tracą znaczenie
+            prefix = "\n".join(p for p in (u["section"] if u["section"] not in u["lines"] else "", u["header"]) if p)
+            # Pozycja kawałka to pozycja jego pierwszego wiersza na stronie (kolejne kawałki się nie nakładają)
+            pieces, rows, start = [], [], u["start"]
+            for row, offset in zip(u["lines"], u["offsets"]):
+                if rows and len(prefix) + sum(len(r) + 1 for r in rows) + len(row) > self.opts["chunk_size"]:
+                    pieces.append((rows, start))
+                    rows, start = [], offset
+                rows.append(row)
+            pieces.append((rows, start))
+            return [("\n".join(([prefix] if prefix else []) + rows), start, u["section"], "table") for rows, start in pieces]
+        return [(d.page_content, u["start"] + d.metadata["start_index"], u["section"], "text")
+                for d in self._splitter.create_documents([text])]
+
+
+def split_pages(pages, name):
+    """Wszystkie fragmenty dokumentu z iterowalnej listy stron."""
+    chunker = Chunker.for_file(name)
+    for page in pages:
+        yield from chunker.split(page)
@@ -1,151 +1,719 @@
-import psycopg2, bcrypt, config, json
+import psycopg2, bcrypt, config, copy, functools, threading, time
+from contextlib import contextmanager
+from psycopg2 import extensions
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from sqlalchemy.engine.url import make_url
 
+# --- PULA POŁĄCZEŃ ---
+# Jedna pula na proces; semafor pilnuje limitu, żeby wątki czekały na wolne
+# połączenie zamiast dostawać PoolError od ThreadedConnectionPool.
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+_last_used = {}
+_pool_stats = {"checkouts": 0, "wait_time_s": 0.0, "max_wait_s": 0.0, "timeouts": 0, "reconnects": 0, "in_use": 0}
 
-def get_db_connection():
+
+def _connect_kwargs():
     url = make_url(config.DATABASE_URL)
-    return psycopg2.connect(
-        user=url.username, password=url.password,
-        host=url.host, port=url.port, database=url.database
-    )
+    return dict(user=url.username, password=url.password, host=url.host, port=url.port, database=url.database)
+
+
+def _get_pool():
+    global _pool, _pool_slots
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool_slots = threading.BoundedSemaphore(config.DB_POOL_MAX_SIZE)
+                _pool = ThreadedConnectionPool(config.DB_POOL_MIN_SIZE, config.DB_POOL_MAX_SIZE, **_connect_kwargs())
+    return _pool
+
+
+def _is_healthy(conn):
+    if conn.closed or conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+    if time.monotonic() - _last_used.get(id(conn), 0) < config.DB_POOL_HEALTHCHECK_IDLE:
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.fetchone()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _checkout(pool):
+    conn = pool.getconn()
+    if not _is_healthy(conn):
+        pool.putconn(conn, close=True)
+        _last_used.pop(id(conn), None)
+        with _pool_lock:
+            _pool_stats["reconnects"] += 1
+        conn = pool.getconn()
+    return conn
+
+
+@contextmanager
+def db_conn():
+    """Wypożycza połączenie z puli; commit przy sukcesie, rollback przy wyjątku."""
+    pool = _get_pool()
+    start = time.monotonic()
+    if not _pool_slots.acquire(timeout=config.DB_POOL_TIMEOUT):
+        with _pool_lock:
+            _pool_stats["timeouts"] += 1
+        raise PoolError("Brak wolnego połączenia w puli (timeout).")
+    try:
+        conn = _checkout(pool)
+    except Exception:
+        _pool_slots.release()
+        raise
+    waited = time.monotonic() - start
+    with _pool_lock:
+        _pool_stats["checkouts"] += 1
+        _pool_stats["wait_time_s"] += waited
+        _pool_stats["max_wait_s"] = max(_pool_stats["max_wait_s"], waited)
+        _pool_stats["in_use"] += 1
+
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except Exception:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        raise
+    finally:
+        broken = broken or bool(conn.closed)
+        if broken:
+            _last_used.pop(id(conn), None)
+        else:
+            _last_used[id(conn)] = time.monotonic()
+        pool.putconn(conn, close=broken)
+        with _pool_lock:
+            _pool_stats["in_use"] -= 1
+        _pool_slots.release()
+
+
+# --- POWIADOMIENIA O ZMIANACH KOLEKCJI ---
+# Moduły z cache per kolekcja (np. rag_core) rejestrują tu callback(cid); inne procesy
+# (ingest_worker) widzą zmiany przez collections.files_version.
+_collection_listeners = []
+
+
+def on_collection_change(callback):
+    _collection_listeners.append(callback)
+
+
+def _notify_collection_change(cid):
+    for cb in _collection_listeners:
+        try:
+            cb(cid)
+        except Exception as e:
+            print(f"Błąd powiadomienia o zmianie kolekcji {cid}: {e}")
+
+
+# --- CACHE ODCZYTÓW ---
+# Streamlit wykonuje cały skrypt przy każdej interakcji, a lista kolekcji i plików zmienia się rzadko.
+# Wpisy żyją READ_CACHE_TTL sekund; każda zmiana z tego procesu czyści cały cache od razu.
+_read_cache = {}
+_read_cache_lock = threading.Lock()
+_read_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_read_cache_generation = 0
+
+
+def cached_read(func):
+    """Dekorator odczytu: wynik per argumenty, kopia przy każdym zwrocie (wywołujący mogą go modyfikować)."""
+    @functools.wraps(func)
+    def wrapper(*args):
+        key = (func.__qualname__, args)
+        with _read_cache_lock:
+            entry = _read_cache.get(key)
+            if entry and time.monotonic() - entry[0] < config.READ_CACHE_TTL:
+                _read_cache_stats["hits"] += 1
+                return copy.deepcopy(entry[1])
+            generation = _read_cache_generation
+        value = func(*args)
+        with _read_cache_lock:
+            # Zmiana w trakcie odczytu - wynik może być sprzed niej, nie zapisujemy go
+            if generation == _read_cache_generation:
+                _read_cache[key] = (time.monotonic(), value)
+            _read_cache_stats["misses"] += 1
+        return copy.deepcopy(value)
+    return wrapper
+
+
+def invalidate_read_cache(*_):
+    global _read_cache_generation
+    with _read_cache_lock:
+        _read_cache.clear()
+        _read_cache_generation += 1
+        _read_cache_stats["invalidations"] += 1
+
+
+def get_read_cache_stats():
+    with _read_cache_lock:
+        return dict(_read_cache_stats, entries=len(_read_cache))
+
+
+on_collection_change(invalidate_read_cache)
+
+
+def get_pool_stats():
+    """Liczniki puli do jej wymiarowania (wypożyczenia, czas oczekiwania, reconnecty)."""
+    with _pool_lock:
+        stats = dict(_pool_stats)
+    stats["avg_wait_s"] = stats["wait_time_s"] / stats["checkouts"] if stats["checkouts"] else 0.0
+    stats["max_size"] = config.DB_POOL_MAX_SIZE
+    return stats
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _last_used.clear()
+
+
+_db_initialized = False
+_db_init_lock = threading.Lock()
 
 
 def init_db():
-    conn = get_db_connection();
-    cur = conn.cursor()
-    cur.execute(
-        "CREATE TABLE IF NOT EXISTS user_groups (id SERIAL PRIMARY KEY, group_name VARCHAR(100) UNIQUE NOT NULL);")
-    cur.execute(
-        "CREATE TABLE IF NOT EXISTS users (id SERIAL PRIMARY KEY, username VARCHAR(100) UNIQUE NOT NULL, hashed_password VARCHAR(100) NOT NULL, is_admin BOOLEAN DEFAULT FALSE);")
-    cur.execute(
-        "CREATE TABLE IF NOT EXISTS collections (id SERIAL PRIMARY KEY, name VARCHAR(255) NOT NULL, owner_username VARCHAR(100) NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);")
-    cur.execute(
-        "CREATE TABLE IF NOT EXISTS collection_files (id SERIAL PRIMARY KEY, collection_id INTEGER REFERENCES collections(id) ON DELETE CASCADE, file_name VARCHAR(255) NOT NULL);")
-    cur.execute(
-        "CREATE TABLE IF NOT EXISTS permissions (id SERIAL PRIMARY KEY, collection_id INTEGER REFERENCES collections(id) ON DELETE CASCADE, target_username VARCHAR(100), target_group VARCHAR(100));")
-    cur.execute(
-        "CREATE TABLE IF NOT EXISTS chat_archives (id SERIAL PRIMARY KEY, collection_id INTEGER REFERENCES collections(id) ON DELETE CASCADE, username VARCHAR(100) NOT NULL, history_json JSONB NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);")
+    """Zakłada i migruje schemat raz na proces. Wołają to punkty wejścia (app.py, ingest_worker, bulk_import,
+    benchmark), a nie import modułu - procesy puli ekstrakcji PDF (spawn) importują go ponownie."""
+    global _db_initialized
+    with _db_init_lock:
+        if not _db_initialized:
+            _create_schema()
+            _db_initialized = True
 
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS active_chats (
-            id SERIAL PRIMARY KEY, 
-            collection_id INTEGER REFERENCES collections(id) ON DELETE CASCADE, 
-            username VARCHAR(100) NOT NULL, 
-            history_json JSONB NOT NULL, 
-            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(collection_id, username)
-        );
-    """)
 
-    cur.execute("SELECT id FROM users WHERE username = 'admin'")
-    if not cur.fetchone():
-        hashed = bcrypt.hashpw("admin123".encode(), bcrypt.gensalt()).decode()
-        cur.execute("INSERT INTO users (username, hashed_password, is_admin) VALUES ('admin', %s, TRUE)", (hashed,))
-    conn.commit();
-    conn.close()
+def _create_schema():
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS user_groups (id SERIAL PRIMARY KEY, group_name VARCHAR(100) UNIQUE NOT NULL);")
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS users (id SERIAL PRIMARY KEY, username VARCHAR(100) UNIQUE NOT NULL, hashed_password VARCHAR(100) NOT NULL, is_admin BOOLEAN DEFAULT FALSE);")
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS collections (id SERIAL PRIMARY KEY, name VARCHAR(255) NOT NULL, owner_username VARCHAR(100) NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);")
+        # Wersja listy plików - podbijana przy każdej zmianie, służy do unieważniania cache łańcuchów
+        cur.execute("ALTER TABLE collections ADD COLUMN IF NOT EXISTS files_version INTEGER NOT NULL DEFAULT 0;")
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS collection_files (id SERIAL PRIMARY KEY, collection_id INTEGER REFERENCES collections(id) ON DELETE CASCADE, file_name VARCHAR(255) NOT NULL);")
+        # Dokument = plik właściciela o stałym id; wektory i collection_files wskazują na id, nie na nazwę
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+                owner_username VARCHAR(100) NOT NULL,
+                file_name VARCHAR(255) NOT NULL,
+                content_hash CHAR(64),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (owner_username, file_name)
+            );
+        """)
+        cur.execute("ALTER TABLE documents ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0;")
+        cur.execute("ALTER TABLE collection_files ADD COLUMN IF NOT EXISTS document_id UUID REFERENCES documents(id) ON DELETE SET NULL;")
+        cur.execute("CREATE INDEX IF NOT EXISTS collection_files_document_idx ON collection_files (document_id);")
+        cur.execute("CREATE INDEX IF NOT EXISTS collection_files_file_name_idx ON collection_files (file_name);")
+        # Wpisy bez id mimo istniejącego dokumentu (plik dodany do kolekcji w chwili, gdy dokument dopiero powstawał) -
+        # uzupełniane raz przy starcie, a nie przy każdym odczycie
+        cur.execute("""
+            WITH linked AS (
+                UPDATE collection_files f SET document_id = d.id
+                FROM collections c, documents d
+                WHERE c.id = f.collection_id AND f.document_id IS NULL
+                  AND d.owner_username = c.owner_username AND d.file_name = f.file_name
+                RETURNING f.collection_id
+            )
+            UPDATE collections SET files_version = files_version + 1 WHERE id IN (SELECT collection_id FROM linked)
+        """)
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS permissions (id SERIAL PRIMARY KEY, collection_id INTEGER REFERENCES collections(id) ON DELETE CASCADE, target_username VARCHAR(100), target_group VARCHAR(100));")
+        # chat_archives i active_chats to dawny zapis historii jako jeden JSON - dziś tylko źródło migracji
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS chat_archives (id SERIAL PRIMARY KEY, collection_id INTEGER REFERENCES collections(id) ON DELETE CASCADE, username VARCHAR(100) NOT NULL, history_json JSONB NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);")
+
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS active_chats (
+                id SERIAL PRIMARY KEY, 
+                collection_id INTEGER REFERENCES collections(id) ON DELETE CASCADE, 
+                username VARCHAR(100) NOT NULL, 
+                history_json JSONB NOT NULL, 
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(collection_id, username)
+            );
+        """)
+
+        # Historia per wiadomość: sesja czatu (aktywna / zarchiwizowana) + wiadomości dopisywane na końcu
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS chat_sessions (
+                id SERIAL PRIMARY KEY,
+                collection_id INTEGER REFERENCES collections(id) ON DELETE CASCADE,
+                username VARCHAR(100) NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'active',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                archived_at TIMESTAMP
+            );
+        """)
+        cur.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS chat_sessions_active_uq ON chat_sessions (collection_id, username) WHERE status = 'active';")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS chat_messages (
+                session_id INTEGER REFERENCES chat_sessions(id) ON DELETE CASCADE,
+                seq INTEGER NOT NULL,
+                role VARCHAR(20) NOT NULL,
+                content TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (session_id, seq)
+            );
+        """)
+        # Streszczenie starszej części rozmowy (pamięć czatu) - liczone raz, trzymane przy sesji
+        cur.execute("ALTER TABLE chat_sessions ADD COLUMN IF NOT EXISTS summary TEXT;")
+        cur.execute("ALTER TABLE chat_sessions ADD COLUMN IF NOT EXISTS summary_upto_seq INTEGER NOT NULL DEFAULT -1;")
+        # Stronicowanie historii po (archived_at, id) bez skanowania wszystkich archiwów użytkownika
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS chat_sessions_history_idx ON chat_sessions (username, status, archived_at DESC, id DESC);")
+        _migrate_json_chats(cur)
+
+        # Cache embeddingów po hashu treści fragmentu + modelu oraz odciski całych plików
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache (content_hash CHAR(64) PRIMARY KEY, model VARCHAR(255) NOT NULL, embedding REAL[] NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);")
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS file_fingerprints (username VARCHAR(100) NOT NULL, file_name VARCHAR(255) NOT NULL, content_hash CHAR(64) NOT NULL, model VARCHAR(255) NOT NULL, chunk_count INTEGER, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (username, file_name));")
+
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                id SERIAL PRIMARY KEY,
+                collection_id INTEGER REFERENCES collections(id) ON DELETE CASCADE,
+                files_version INTEGER NOT NULL,
+                question TEXT NOT NULL,
+                embedding REAL[] NOT NULL,
+                answer TEXT NOT NULL,
+                generation_s REAL NOT NULL DEFAULT 0,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_hit_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS answer_cache_col_idx ON answer_cache (collection_id, files_version);")
+
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_jobs (
+                id SERIAL PRIMARY KEY,
+                username VARCHAR(100) NOT NULL,
+                owner_username VARCHAR(100) NOT NULL,
+                collection_id INTEGER REFERENCES collections(id) ON DELETE CASCADE,
+                file_path TEXT NOT NULL,
+                file_name VARCHAR(255) NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                progress REAL NOT NULL DEFAULT 0,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 3,
+                run_after TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS ingest_jobs_status_idx ON ingest_jobs (status, run_after, id);")
+        cur.execute("CREATE INDEX IF NOT EXISTS ingest_jobs_user_idx ON ingest_jobs (username, created_at DESC);")
+
+        cur.execute("SELECT id FROM users WHERE username = 'admin'")
+        if not cur.fetchone():
+            hashed = bcrypt.hashpw("admin123".encode(), bcrypt.gensalt()).decode()
+            cur.execute("INSERT INTO users (username, hashed_password, is_admin) VALUES ('admin', %s, TRUE)", (hashed,))
 
 
 def verify_user(u, p):
-    conn = get_db_connection();
-    cur = conn.cursor()
-    cur.execute("SELECT hashed_password, is_admin FROM users WHERE username = %s", (u,))
-    r = cur.fetchone();
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT hashed_password, is_admin FROM users WHERE username = %s", (u,))
+        r = cur.fetchone()
     if r and bcrypt.checkpw(p.encode(), r[0].encode()): return True, r[1]
     return False, False
 
 
 def create_user(u, p):
     try:
-        conn = get_db_connection();
-        cur = conn.cursor()
         hashed = bcrypt.hashpw(p.encode(), bcrypt.gensalt()).decode()
-        cur.execute("INSERT INTO users (username, hashed_password) VALUES (%s, %s)", (u, hashed))
-        conn.commit();
-        conn.close();
+        with db_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("INSERT INTO users (username, hashed_password) VALUES (%s, %s)", (u, hashed))
         return True, "Zarejestrowano pomyślnie!"
     except:
         return False, "Użytkownik już istnieje."
 
 
+def _migrate_json_chats(cur):
+    """Jednorazowe przeniesienie historii z JSONB (chat_archives, active_chats) do chat_sessions/chat_messages.
+
+    Przeniesione wiersze są usuwane w tej samej transakcji, więc ponowne wywołanie nic nie robi. Blokada
+    doradcza chroni przed podwójnym przeniesieniem, gdy aplikacja i worker startują jednocześnie.
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('migrate_json_chats'))")
+    # Id sesji rezerwowane z sekwencji przed wstawieniem - archiwum i jego wiadomości łączy ten sam wiersz keyed,
+    # a nie kolejność RETURNING (której Postgres nie gwarantuje)
+    cur.execute("""
+        WITH src AS (DELETE FROM chat_archives RETURNING *),
+        keyed AS MATERIALIZED (
+            SELECT nextval(pg_get_serial_sequence('chat_sessions', 'id')) AS session_id, src.* FROM src
+        ),
+        ins AS (
+            INSERT INTO chat_sessions (id, collection_id, username, status, created_at, last_updated, archived_at)
+            SELECT session_id, collection_id, username, 'archived', created_at, created_at, created_at FROM keyed
+        )
+        INSERT INTO chat_messages (session_id, seq, role, content)
+        SELECT k.session_id, m.ord - 1, m.value ->> 'role', m.value ->> 'content'
+        FROM keyed k, jsonb_array_elements(k.history_json) WITH ORDINALITY m(value, ord)
+    """)
+    # Aktywna rozmowa, dla której jest już sesja: wiadomości są dopisywane na jej koniec
+    cur.execute("""
+        INSERT INTO chat_messages (session_id, seq, role, content)
+        SELECT s.id, COALESCE((SELECT max(x.seq) FROM chat_messages x WHERE x.session_id = s.id), -1) + m.ord,
+               m.value ->> 'role', m.value ->> 'content'
+        FROM active_chats a
+        JOIN chat_sessions s ON s.collection_id = a.collection_id AND s.username = a.username AND s.status = 'active',
+             jsonb_array_elements(a.history_json) WITH ORDINALITY m(value, ord)
+    """)
+    cur.execute("""
+        WITH ins AS (
+            INSERT INTO chat_sessions (collection_id, username, status, created_at, last_updated)
+            SELECT collection_id, username, 'active', last_updated, last_updated FROM active_chats
+            ON CONFLICT (collection_id, username) WHERE status = 'active' DO NOTHING
+            RETURNING id, collection_id, username
+        )
+        INSERT INTO chat_messages (session_id, seq, role, content)
+        SELECT ins.id, m.ord - 1, m.value ->> 'role', m.value ->> 'content'
+        FROM ins JOIN active_chats a ON a.collection_id = ins.collection_id AND a.username = ins.username,
+             jsonb_array_elements(a.history_json) WITH ORDINALITY m(value, ord)
+    """)
+    # Usuwamy tylko to, co ma już swoją sesję
+    cur.execute("""
+        DELETE FROM active_chats a USING chat_sessions s
+        WHERE s.collection_id = a.collection_id AND s.username = a.username AND s.status = 'active'
+    """)
+
+
+@cached_read
 def get_accessible_collections(username):
-    conn = get_db_connection();
-    cur = conn.cursor()
-    query = "SELECT DISTINCT c.id, c.name, c.owner_username FROM collections c LEFT JOIN permissions p ON c.id = p.collection_id WHERE c.owner_username = %s OR p.target_username = %s"
-    cur.execute(query, (username, username))
-    res = cur.fetchall();
-    conn.close();
-    return res
+    with db_conn() as conn:
+        cur = conn.cursor()
+        query = "SELECT DISTINCT c.id, c.name, c.owner_username FROM collections c LEFT JOIN permissions p ON c.id = p.collection_id WHERE c.owner_username = %s OR p.target_username = %s"
+        cur.execute(query, (username, username))
+        return cur.fetchall()
+
+
+@cached_read
+def get_dashboard_snapshot(username):
+    """Kolekcje użytkownika razem z listą plików i uprawnień - jedno zapytanie zamiast 1 + 2*N."""
+    query = """
+        SELECT c.id, c.name, c.owner_username,
+               COALESCE((SELECT array_agg(f.file_name ORDER BY f.id) FROM collection_files f
+                         WHERE f.collection_id = c.id), '{}') AS files,
+               CASE WHEN c.owner_username = %(u)s THEN
+                   COALESCE((SELECT array_agg(p.target_username ORDER BY p.id) FROM permissions p
+                             WHERE p.collection_id = c.id AND p.target_username IS NOT NULL), '{}')
+               ELSE '{}' END AS permissions
+        FROM collections c
+        WHERE c.owner_username = %(u)s
+           OR EXISTS (SELECT 1 FROM permissions p WHERE p.collection_id = c.id AND p.target_username = %(u)s)
+        ORDER BY c.id
+    """
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(query, {"u": username})
+        rows = cur.fetchall()
+    return [{"id": r[0], "name": r[1], "owner": r[2], "files": list(r[3]), "permissions": list(r[4])} for r in rows]
+
+
+# Wpis collection_files razem z id dokumentu właściciela kolekcji (NULL, jeśli plik nie jest jeszcze zaindeksowany)
+_INSERT_COLLECTION_FILE = """
+    INSERT INTO collection_files (collection_id, file_name, document_id)
+    SELECT c.id, %(f)s, d.id FROM collections c
+    LEFT JOIN documents d ON d.owner_username = c.owner_username AND d.file_name = %(f)s
+    WHERE c.id = %(cid)s
+"""
 
 
 def create_collection(name, owner, files):
-    conn = get_db_connection();
-    cur = conn.cursor()
-    cur.execute("INSERT INTO collections (name, owner_username) VALUES (%s, %s) RETURNING id", (name, owner))
-    cid = cur.fetchone()[0]
-    for f in files: cur.execute("INSERT INTO collection_files (collection_id, file_name) VALUES (%s, %s)", (cid, f))
-    conn.commit();
-    conn.close();
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO collections (name, owner_username) VALUES (%s, %s) RETURNING id", (name, owner))
+        cid = cur.fetchone()[0]
+        for f in files: cur.execute(_INSERT_COLLECTION_FILE, {"cid": cid, "f": f})
+    invalidate_read_cache()
     return cid
 
 
+def get_owned_collection_id(owner, name):
+    """Id kolekcji o tej nazwie należącej do właściciela (najstarszej, jeśli jest kilka) albo None."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM collections WHERE owner_username = %s AND name = %s ORDER BY id LIMIT 1",
+                    (owner, name))
+        res = cur.fetchone()
+        return res[0] if res else None
+
+
 def get_collection_files(cid):
-    conn = get_db_connection();
-    cur = conn.cursor()
-    cur.execute("SELECT file_name FROM collection_files WHERE collection_id = %s", (cid,))
-    res = [r[0] for r in cur.fetchall()];
-    conn.close();
-    return res
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT file_name FROM collection_files WHERE collection_id = %s", (cid,))
+        return [r[0] for r in cur.fetchall()]
+
+
+def get_collection_version(cid):
+    """Wersja listy plików kolekcji albo None, jeśli kolekcja nie istnieje."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT files_version FROM collections WHERE id = %s", (cid,))
+        r = cur.fetchone()
+    return r[0] if r else None
+
+
+def get_collection_documents(cid):
+    """(właściciel, [id dokumentów]) kolekcji - zakres wyszukiwania w partycji wektorów właściciela."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        # Id dokumentów uzupełniają zapisy (upsert_document, _INSERT_COLLECTION_FILE) i init_db - tu tylko odczyt
+        cur.execute("""
+            SELECT c.owner_username, COALESCE(array_agg(f.document_id::text) FILTER (WHERE f.document_id IS NOT NULL), '{}')
+            FROM collections c LEFT JOIN collection_files f ON f.collection_id = c.id
+            WHERE c.id = %s GROUP BY c.owner_username
+        """, (cid,))
+        res = cur.fetchone()
+        return (res[0], list(res[1])) if res else (None, [])
+
+
+def upsert_document(owner, file_name):
+    """Id dokumentu (właściciel, nazwa pliku) - zakładany przy pierwszym indeksowaniu."""
+    changed = []
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO documents (owner_username, file_name) VALUES (%s, %s)
+            ON CONFLICT (owner_username, file_name) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+            RETURNING id::text, xmax = 0
+        """, (owner, file_name))
+        document_id, inserted = cur.fetchone()
+        if inserted:
+            # Plik wgrany ponownie po usunięciu: kolekcje, które nadal go wymieniają, dostają nowe id od razu,
+            # a nie dopiero przy przebudowie łańcucha
+            cur.execute("""
+                UPDATE collection_files f SET document_id = %s
+                FROM collections c
+                WHERE c.id = f.collection_id AND c.owner_username = %s AND f.file_name = %s
+            """, (document_id, owner, file_name))
+            if cur.rowcount:
+                changed = _bump_file_collections(cur, owner, file_name)
+    for cid in changed:
+        _notify_collection_change(cid)
+    return document_id
+
+
+def _bump_file_collections(cur, owner, file_name):
+    """Podbija files_version kolekcji właściciela zawierających plik - unieważnia cache łańcuchów i odpowiedzi.
+    Zwraca id tych kolekcji (do _notify_collection_change po commicie)."""
+    cur.execute("""
+        UPDATE collections c SET files_version = c.files_version + 1
+        FROM (SELECT DISTINCT f.collection_id FROM collection_files f JOIN collections o ON o.id = f.collection_id
+              WHERE o.owner_username = %s AND f.file_name = %s) f
+        WHERE c.id = f.collection_id
+        RETURNING c.id
+    """, (owner, file_name))
+    return [r[0] for r in cur.fetchall()]
+
+
+def set_document_hash(document_id, content_hash):
+    """Zapisuje hash zaindeksowanej treści; nowa treść podbija numer wersji dokumentu. Zwraca wersję."""
+    changed = []
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT content_hash FROM documents WHERE id = %s FOR UPDATE", (document_id,))
+        old = cur.fetchone()
+        cur.execute("""
+            UPDATE documents SET version = version + (content_hash IS DISTINCT FROM %s)::int,
+                                 content_hash = %s, updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s RETURNING version, owner_username, file_name
+        """, (content_hash, content_hash, document_id))
+        r = cur.fetchone()
+        if r and old and old[0] is not None and old[0] != content_hash:
+            # Nowa wersja pliku o tej samej nazwie - odpowiedzi z cache dotyczą starej treści
+            changed = _bump_file_collections(cur, r[1], r[2])
+    for cid in changed:
+        _notify_collection_change(cid)
+    invalidate_read_cache()
+    return r[0] if r else None
+
+
+def get_document_ids(owner, file_names):
+    """{nazwa pliku: id} dla zaindeksowanych dokumentów właściciela."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT file_name, id::text FROM documents WHERE owner_username = %s AND file_name = ANY(%s)",
+                    (owner, list(file_names)))
+        return dict(cur.fetchall())
+
+
+@cached_read
+def get_owner_documents(owner):
+    """Nazwy plików właściciela, których indeksowanie się zakończyło."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT file_name FROM documents WHERE owner_username = %s AND content_hash IS NOT NULL ORDER BY file_name",
+                    (owner,))
+        return [r[0] for r in cur.fetchall()]
+
+
+def delete_document(owner, file_name):
+    """Usuwa wpis dokumentu i zwraca jego id (albo None); wektory usuwa rag_core."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM documents WHERE owner_username = %s AND file_name = %s RETURNING id::text",
+                    (owner, file_name))
+        res = cur.fetchone()
+        changed = _bump_file_collections(cur, owner, file_name) if res else []
+    for cid in changed:
+        _notify_collection_change(cid)
+    invalidate_read_cache()
+    return res[0] if res else None
+
+
+def get_unreferenced_documents(grace_hours):
+    """(id, właściciel, plik) dokumentów bez żadnego wpisu w collection_files, nieruszanych od grace_hours
+    i bez zadania indeksowania w kolejce."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT d.id::text, d.owner_username, d.file_name FROM documents d
+            WHERE d.updated_at < CURRENT_TIMESTAMP - make_interval(hours => %s)
+              -- Dwa osobne warunki zamiast OR - każdy idzie swoim indeksem (document_id / file_name)
+              AND NOT EXISTS (SELECT 1 FROM collection_files f WHERE f.document_id = d.id)
+              AND NOT EXISTS (SELECT 1 FROM collection_files f JOIN collections c ON c.id = f.collection_id
+                              WHERE f.file_name = d.file_name AND c.owner_username = d.owner_username)
+              AND NOT EXISTS (SELECT 1 FROM ingest_jobs j
+                              WHERE j.owner_username = d.owner_username AND j.file_name = d.file_name
+                                AND j.status IN ('queued', 'running'))
+        """, (grace_hours,))
+        return cur.fetchall()
+
+
+def delete_documents(document_ids):
+    """Usuwa wpisy dokumentów razem z odciskami plików; wektory usuwa rag_core."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM documents WHERE id = ANY(%s::uuid[]) RETURNING owner_username, file_name",
+                    (list(document_ids),))
+        removed = cur.fetchall()
+        if removed:
+            execute_values(cur, "DELETE FROM file_fingerprints f USING (VALUES %s) v(username, file_name) "
+                                "WHERE f.username = v.username AND f.file_name = v.file_name", removed)
+    invalidate_read_cache()
+    return len(removed)
 
 
 def remove_file_from_collection(cid, fname):
-    conn = get_db_connection();
-    cur = conn.cursor()
-    cur.execute("DELETE FROM collection_files WHERE collection_id = %s AND file_name = %s", (cid, fname))
-    conn.commit();
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM collection_files WHERE collection_id = %s AND file_name = %s", (cid, fname))
+        cur.execute("UPDATE collections SET files_version = files_version + 1 WHERE id = %s", (cid,))
+    _notify_collection_change(cid)
 
 
 def delete_collection(cid):
-    conn = get_db_connection();
-    cur = conn.cursor()
-    cur.execute("DELETE FROM collections WHERE id = %s", (cid,))
-    conn.commit();
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM collections WHERE id = %s", (cid,))
+    _notify_collection_change(cid)
 
 
 def archive_chat(cid, user, history):
-    conn = get_db_connection();
-    cur = conn.cursor()
-    cur.execute("INSERT INTO chat_archives (collection_id, username, history_json) VALUES (%s, %s, %s)",
-                (cid, user, json.dumps(history)))
-    cur.execute("DELETE FROM active_chats WHERE collection_id = %s AND username = %s", (cid, user))
-    conn.commit();
-    conn.close()
-
-
-def get_user_history(user):
-    conn = get_db_connection();
-    cur = conn.cursor()
-    query = "SELECT a.id, c.name, a.created_at FROM chat_archives a JOIN collections c ON a.collection_id = c.id WHERE a.username = %s ORDER BY a.created_at DESC"
-    cur.execute(query, (user,))
-    res = cur.fetchall();
-    conn.close();
-    return res
-
-
-def get_archive_detail(archive_id):
-    try:
-        conn = get_db_connection()
+    """Dopisuje niezapisane wiadomości i przełącza sesję na 'archived' - bez kopiowania historii."""
+    save_active_chat(cid, user, history)
+    with db_conn() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT history_json FROM chat_archives WHERE id = %s", (archive_id,))
-        res = cur.fetchone()
-        conn.close()
-        if res:
-            data = res[0]
-            if isinstance(data, (list, dict)): return data
-            return json.loads(data)
-        return None
+        cur.execute("""
+            UPDATE chat_sessions SET status = 'archived', archived_at = CURRENT_TIMESTAMP
+            WHERE collection_id = %s AND username = %s AND status = 'active'
+        """, (cid, user))
+
+
+def get_user_history(user, collection_id=None, date_from=None, date_to=None, after=None, limit=None):
+    """Strona zarchiwizowanych rozmów (najnowsze pierwsze), stronicowana kluczem zamiast OFFSET.
+
+    after - (archived_at, id) ostatniego wiersza poprzedniej strony; date_to jest wyłączne.
+    """
+    conds, params = ["s.username = %s", "s.status = 'archived'"], [user]
+    if collection_id is not None:
+        conds.append("s.collection_id = %s"); params.append(collection_id)
+    if date_from is not None:
+        conds.append("s.archived_at >= %s"); params.append(date_from)
+    if date_to is not None:
+        conds.append("s.archived_at < %s"); params.append(date_to)
+    if after is not None:
+        conds.append("(s.archived_at, s.id) < (%s, %s)"); params.extend(after)
+    params.append(limit)
+    with db_conn() as conn:
+        cur = conn.cursor()
+        query = f"""
+            SELECT s.id, c.name, s.archived_at FROM chat_sessions s JOIN collections c ON s.collection_id = c.id
+            WHERE {" AND ".join(conds)}
+            ORDER BY s.archived_at DESC, s.id DESC LIMIT %s
+        """
+        cur.execute(query, params)
+        return cur.fetchall()
+
+
+def get_history_collections(user):
+    """Kolekcje, w których użytkownik ma archiwa - do filtra w widoku historii."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT c.id, c.name FROM collections c
+            WHERE EXISTS (SELECT 1 FROM chat_sessions s
+                          WHERE s.collection_id = c.id AND s.username = %s AND s.status = 'archived')
+            ORDER BY c.name
+        """, (user,))
+        return cur.fetchall()
+
+
+def _load_messages(cur, session_id, limit=None, before_seq=None, offset=None):
+    """Wiadomości sesji rosnąco po seq: strona od offset albo (bez offset) ostatnie `limit` przed before_seq."""
+    if offset is None and limit:
+        cur.execute("""
+            SELECT seq, role, content FROM (
+                SELECT seq, role, content FROM chat_messages
+                WHERE session_id = %s AND seq < COALESCE(%s, 2147483647)
+                ORDER BY seq DESC LIMIT %s
+            ) page ORDER BY seq
+        """, (session_id, before_seq, limit))
+    else:
+        cur.execute("SELECT seq, role, content FROM chat_messages WHERE session_id = %s ORDER BY seq LIMIT %s OFFSET %s",
+                    (session_id, limit, offset or 0))
+    return [{"role": r[1], "content": r[2], "seq": r[0]} for r in cur.fetchall()]
+
+
+def get_archive_detail(archive_id, limit=None, offset=0):
+    try:
+        with db_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id FROM chat_sessions WHERE id = %s AND status = 'archived'", (archive_id,))
+            if not cur.fetchone():
+                return None
+            return _load_messages(cur, archive_id, limit=limit, offset=offset)
     except Exception as e:
         print(f"Błąd pobierania szczegółów archiwum: {e}")
         return None
@@ -154,101 +722,320 @@ def get_archive_detail(archive_id):
 def share_collection_with_user(owner, collection_id, target_username):
     if owner == target_username:
         return False, "Nie możesz udostępnić kolekcji samemu sobie."
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM users WHERE username = %s", (target_username,))
-    if not cur.fetchone():
-        conn.close()
-        return False, f"Użytkownik {target_username} nie istnieje."
-    cur.execute("SELECT id FROM permissions WHERE collection_id = %s AND target_username = %s",
-                (collection_id, target_username))
-    if cur.fetchone():
-        conn.close()
-        return False, f"Już udostępniono użytkownikowi {target_username}."
-    try:
-        cur.execute("INSERT INTO permissions (collection_id, target_username) VALUES (%s, %s)",
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM users WHERE username = %s", (target_username,))
+        if not cur.fetchone():
+            return False, f"Użytkownik {target_username} nie istnieje."
+        cur.execute("SELECT id FROM permissions WHERE collection_id = %s AND target_username = %s",
                     (collection_id, target_username))
-        conn.commit()
-        conn.close()
+        if cur.fetchone():
+            return False, f"Już udostępniono użytkownikowi {target_username}."
+    try:
+        with db_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("INSERT INTO permissions (collection_id, target_username) VALUES (%s, %s)",
+                        (collection_id, target_username))
+        invalidate_read_cache()
         return True, f"Kolekcja udostępniona dla {target_username}!"
     except Exception as e:
-        conn.close()
         return False, f"Błąd bazy danych: {str(e)}"
 
 
 def save_active_chat(cid, user, history):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    history_json = json.dumps(history)
-    query = """
-        INSERT INTO active_chats (collection_id, username, history_json, last_updated)
-        VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
-        ON CONFLICT (collection_id, username) 
-        DO UPDATE SET history_json = EXCLUDED.history_json, last_updated = CURRENT_TIMESTAMP;
-    """
-    cur.execute(query, (cid, user, history_json))
-    conn.commit()
-    conn.close()
+    """Dopisuje do aktywnej sesji tylko wiadomości bez 'seq' (nowe) i nadaje im numery."""
+    new = [m for m in history if "seq" not in m]
+    if not new: return
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO chat_sessions (collection_id, username) VALUES (%s, %s)
+            ON CONFLICT (collection_id, username) WHERE status = 'active'
+            DO UPDATE SET last_updated = CURRENT_TIMESTAMP
+            RETURNING id
+        """, (cid, user))
+        session_id = cur.fetchone()[0]
+        cur.execute("SELECT COALESCE(MAX(seq), -1) FROM chat_messages WHERE session_id = %s", (session_id,))
+        first = cur.fetchone()[0] + 1
+        execute_values(cur, "INSERT INTO chat_messages (session_id, seq, role, content) VALUES %s",
+                       [(session_id, first + i, m["role"], m["content"]) for i, m in enumerate(new)])
+    for i, m in enumerate(new):
+        m["seq"] = first + i
+
+
+def load_active_chat(cid, user, limit=None, before_seq=None):
+    """Wiadomości aktywnej sesji; z limit - ostatnia strona (albo strona przed before_seq)."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM chat_sessions WHERE collection_id = %s AND username = %s AND status = 'active'",
+                    (cid, user))
+        res = cur.fetchone()
+        if not res:
+            return []
+        return _load_messages(cur, res[0], limit=limit, before_seq=before_seq)
 
 
-def load_active_chat(cid, user):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT history_json FROM active_chats WHERE collection_id = %s AND username = %s", (cid, user))
-    res = cur.fetchone()
-    conn.close()
-    if res:
-        data = res[0]
-        if isinstance(data, (list, dict)): return data
-        return json.loads(data)
-    return []
+def get_chat_summary(cid, user):
+    """(streszczenie, seq ostatniej streszczonej wiadomości) aktywnej sesji; ("", -1) gdy brak."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT summary, summary_upto_seq FROM chat_sessions WHERE collection_id = %s AND username = %s AND status = 'active'",
+                    (cid, user))
+        res = cur.fetchone()
+        return (res[0] or "", res[1]) if res else ("", -1)
+
+
+def save_chat_summary(cid, user, summary, upto_seq):
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE chat_sessions SET summary = %s, summary_upto_seq = %s
+            WHERE collection_id = %s AND username = %s AND status = 'active'
+        """, (summary, upto_seq, cid, user))
 
 
 def delete_selected_archives(ids_list):
     if not ids_list: return
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM chat_archives WHERE id IN %s", (tuple(ids_list),))
-    conn.commit()
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM chat_sessions WHERE id IN %s AND status = 'archived'", (tuple(ids_list),))
 
 
 def delete_all_user_archives(user):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM chat_archives WHERE username = %s", (user,))
-    conn.commit()
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM chat_sessions WHERE username = %s AND status = 'archived'", (user,))
 
 
+@cached_read
 def get_collection_permissions(cid):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT target_username FROM permissions WHERE collection_id = %s", (cid,))
-    res = [r[0] for r in cur.fetchall()]
-    conn.close()
-    return res
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT target_username FROM permissions WHERE collection_id = %s", (cid,))
+        return [r[0] for r in cur.fetchall()]
 
 
 def revoke_permission(cid, username):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM permissions WHERE collection_id = %s AND target_username = %s", (cid, username))
-    conn.commit()
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM permissions WHERE collection_id = %s AND target_username = %s", (cid, username))
+    invalidate_read_cache()
 
 
 # --- NOWA FUNKCJA DODAJĄCA PLIK DO ISTNIEJĄCEJ KOLEKCJI ---
 def add_file_to_collection(cid, filename):
     """Dodaje wpis o pliku do tabeli SQL."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    # Sprawdź czy plik już nie istnieje w tej kolekcji (żeby nie było duplikatów na liście)
-    cur.execute("SELECT id FROM collection_files WHERE collection_id = %s AND file_name = %s", (cid, filename))
-    if not cur.fetchone():
-        cur.execute("INSERT INTO collection_files (collection_id, file_name) VALUES (%s, %s)", (cid, filename))
-    conn.commit()
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        # Sprawdź czy plik już nie istnieje w tej kolekcji (żeby nie było duplikatów na liście)
+        cur.execute("SELECT id FROM collection_files WHERE collection_id = %s AND file_name = %s", (cid, filename))
+        if not cur.fetchone():
+            cur.execute(_INSERT_COLLECTION_FILE, {"cid": cid, "f": filename})
+            cur.execute("UPDATE collections SET files_version = files_version + 1 WHERE id = %s", (cid,))
+    _notify_collection_change(cid)
+
+
+# --- CACHE EMBEDDINGÓW ---
+def get_cached_embeddings(hashes):
+    """Zwraca {hash: wektor} dla fragmentów, które były już embedowane."""
+    if not hashes: return {}
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT content_hash, embedding FROM embedding_cache WHERE content_hash = ANY(%s)", (list(hashes),))
+        return {r[0]: r[1] for r in cur.fetchall()}
+
+
+def save_cached_embeddings(items, model):
+    """items: lista par (hash, wektor)."""
+    if not items: return
+    with db_conn() as conn:
+        cur = conn.cursor()
+        execute_values(cur,
+                       "INSERT INTO embedding_cache (content_hash, model, embedding) VALUES %s ON CONFLICT (content_hash) DO NOTHING",
+                       [(h, model, list(v)) for h, v in items])
+
+
+def get_file_fingerprint(user, filename):
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT content_hash, model FROM file_fingerprints WHERE username = %s AND file_name = %s",
+                    (user, filename))
+        return cur.fetchone()
+
 
+def save_file_fingerprint(user, filename, content_hash, model, chunk_count):
+    query = """
+        INSERT INTO file_fingerprints (username, file_name, content_hash, model, chunk_count, updated_at)
+        VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+        ON CONFLICT (username, file_name)
+        DO UPDATE SET content_hash = EXCLUDED.content_hash, model = EXCLUDED.model,
+                      chunk_count = EXCLUDED.chunk_count, updated_at = CURRENT_TIMESTAMP;
+    """
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(query, (user, filename, content_hash, model, chunk_count))
+
+
+def delete_file_fingerprint(user, filename):
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM file_fingerprints WHERE username = %s AND file_name = %s", (user, filename))
+
+
+# --- CACHE ODPOWIEDZI ---
+def get_answer_cache_entries(cid, version, ttl):
+    """Świeże wpisy cache dla bieżącej wersji kolekcji: (id, wektor pytania, odpowiedź, czas generowania)."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT id, embedding, answer, generation_s FROM answer_cache
+            WHERE collection_id = %s AND files_version = %s
+              AND created_at > CURRENT_TIMESTAMP - make_interval(secs => %s)
+        """, (cid, version, ttl))
+        return cur.fetchall()
+
+
+def record_answer_cache_hit(entry_id):
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE answer_cache SET hits = hits + 1, last_hit_at = CURRENT_TIMESTAMP WHERE id = %s",
+                    (entry_id,))
+
+
+def save_answer_cache_entry(cid, version, question, embedding, answer, generation_s, ttl, max_entries):
+    """Zapisuje odpowiedź i sprząta: nieaktualne wersje, wpisy po TTL i nadmiar ponad max_entries (LRU)."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO answer_cache (collection_id, files_version, question, embedding, answer, generation_s) VALUES (%s, %s, %s, %s, %s, %s)",
+            (cid, version, question, list(embedding), answer, generation_s))
+        cur.execute("""
+            DELETE FROM answer_cache WHERE collection_id = %s
+              AND (files_version <> %s OR created_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+        """, (cid, version, ttl))
+        cur.execute("""
+            DELETE FROM answer_cache WHERE id IN (
+                SELECT id FROM answer_cache WHERE collection_id = %s
+                ORDER BY last_hit_at DESC, id DESC OFFSET %s)
+        """, (cid, max_entries))
+
+
+# --- KOLEJKA INDEKSOWANIA ---
+_JOB_COLUMNS = "id, username, owner_username, collection_id, file_path, file_name, status, progress, error, attempts, max_attempts"
+
+
+def _job_row(r):
+    return dict(zip([c.strip() for c in _JOB_COLUMNS.split(",")], r))
+
+
+def enqueue_ingest_job(user, owner, cid, path, filename, cur=None):
+    """Dodaje plik do kolejki; wektory zapisywane są jako owner, plik trafia do kolekcji cid po sukcesie.
+
+    cur - kursor otwartej transakcji (np. z staged_file_lock); bez niego zadanie idzie we własnej.
+    """
+    if cur is None:
+        with db_conn() as conn:
+            return enqueue_ingest_job(user, owner, cid, path, filename, conn.cursor())
+    cur.execute(
+        "INSERT INTO ingest_jobs (username, owner_username, collection_id, file_path, file_name, max_attempts) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
+        (user, owner, cid, path, filename, config.INGEST_MAX_ATTEMPTS))
+    return cur.fetchone()[0]
+
+
+def claim_ingest_job(per_user_limit):
+    """Atomowo przejmuje najstarsze gotowe zadanie, respektując limit równoległych zadań na użytkownika."""
+    query = f"""
+        UPDATE ingest_jobs SET status = 'running', attempts = attempts + 1, progress = 0,
+                               error = NULL, updated_at = CURRENT_TIMESTAMP
+        WHERE id = (
+            SELECT j.id FROM ingest_jobs j
+            WHERE j.status = 'queued' AND j.run_after <= CURRENT_TIMESTAMP
+              AND (SELECT count(*) FROM ingest_jobs r WHERE r.status = 'running' AND r.username = j.username) < %s
+            ORDER BY j.run_after, j.id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING {_JOB_COLUMNS}
+    """
+    with db_conn() as conn:
+        cur = conn.cursor()
+        # Serializuje przejmowanie między workerami, inaczej limit per użytkownik mógłby zostać przekroczony
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('ingest_jobs_claim'))")
+        cur.execute(query, (per_user_limit,))
+        r = cur.fetchone()
+    return _job_row(r) if r else None
+
+
+def update_ingest_progress(job_id, progress):
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE ingest_jobs SET progress = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                    (progress, job_id))
+
+
+def complete_ingest_job(job_id):
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE ingest_jobs SET status = 'done', progress = 1, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                    (job_id,))
+
+
+def fail_ingest_job(job_id, error, retry=True):
+    """Wraca zadanie do kolejki z opóźnieniem albo oznacza jako 'failed' po wyczerpaniu prób."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE ingest_jobs SET
+                status = CASE WHEN %s AND attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                run_after = CURRENT_TIMESTAMP + make_interval(secs => %s * attempts),
+                error = %s, updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+        """, (retry, config.INGEST_RETRY_BACKOFF, error, job_id))
+
+
+def requeue_stale_jobs(stale_after):
+    """Zadania porzucone przez martwy worker (brak postępu) wracają do kolejki."""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE ingest_jobs SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                                   error = 'Worker przestał odpowiadać.', updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'running' AND updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+        """, (stale_after,))
+        return cur.rowcount
+
+
+def get_user_jobs(user, limit=20):
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT {_JOB_COLUMNS} FROM ingest_jobs WHERE username = %s ORDER BY created_at DESC LIMIT %s",
+                    (user, limit))
+        return [_job_row(r) for r in cur.fetchall()]
+
+
+def clear_finished_jobs(user):
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM ingest_jobs WHERE username = %s AND status IN ('done', 'failed')", (user,))
+
+
+def get_pending_job_paths(cur=None):
+    """Ścieżki plików, na które czekają zadania w kolejce lub w trakcie - nie wolno ich usuwać."""
+    if cur is None:
+        with db_conn() as conn:
+            return get_pending_job_paths(conn.cursor())
+    cur.execute("SELECT DISTINCT file_path FROM ingest_jobs WHERE status IN ('queued', 'running')")
+    return {r[0] for r in cur.fetchall()}
+
+
+@contextmanager
+def staged_file_lock(path):
+    """Transakcja z blokadą doradczą na plik z magazynu uploadów; zwraca jej kursor.
+
+    Dodanie zadania do pliku i jego usunięcie idą pod tą samą blokadą, więc nie mogą się przeplatać.
+    """
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('upload:' || %s))", (path,))
+        yield cur
 
-init_db()
\ No newline at end of file
@@ -0,0 +1,117 @@
+"""Worker kolejki indeksowania (tabela ingest_jobs).
+
+Uruchomienie obok aplikacji Streamlit:
+    python ingest_worker.py --workers 2
+Do testów z lokalnym Postgresem bez Ollamy:
+    python ingest_worker.py --once --stub-embeddings
+Jednorazowe sprzątanie dokumentów, których nie używa żadna kolekcja:
+    python ingest_worker.py --gc
+"""
+import argparse, multiprocessing, time
+import config, db_utils, llm_client, rag_core, upload_staging
+
+
+def run_job(job, embed_fn=None):
+    """Przetwarza jedno przejęte zadanie i zapisuje jego wynik w ingest_jobs."""
+    last_report = [0.0]
+
+    def progress(fraction):
+        # Nie zapisujemy postępu częściej niż co sekundę
+        now = time.monotonic()
+        if now - last_report[0] >= 1.0:
+            last_report[0] = now
+            db_utils.update_ingest_progress(job["id"], fraction)
+
+    try:
+        rag_core.ingest_file(job["file_path"], job["file_name"], job["owner_username"],
+                             embed_fn=embed_fn, progress_cb=progress)
+        if job["collection_id"] is not None:
+            db_utils.add_file_to_collection(job["collection_id"], job["file_name"])
+        db_utils.complete_ingest_job(job["id"])
+        return True
+    except rag_core.PermanentIngestError as e:
+        # Pusty, uszkodzony lub brakujący plik nie naprawi się przy kolejnej próbie. Zwykły ValueError
+        # (np. ucięty JSON z Ollamy) idzie do ponowienia jak każdy inny błąd
+        db_utils.fail_ingest_job(job["id"], str(e), retry=False)
+    except Exception as e:
+        print(f"Błąd zadania {job['id']} ({job['file_name']}): {e}")
+        db_utils.fail_ingest_job(job["id"], str(e))
+    finally:
+        # Zadanie wróciło do kolejki (ponowienie) - release zostawi plik
+        upload_staging.release(job["file_path"])
+    return False
+
+
+def log_embedding_cache_stats():
+    s = rag_core.get_embedding_cache_stats()
+    print(f"Cache embeddingów: fragmenty {s['chunk_hits']}/{s['chunk_hits'] + s['chunk_misses']} "
+          f"({s['chunk_hit_rate']:.0%}), pliki bez zmian {s['file_hits']}/{s['file_hits'] + s['file_misses']} "
+          f"({s['file_hit_rate']:.0%})")
+
+
+def worker_loop(stub_embeddings=False, once=False, poll_interval=None):
+    """Pętla pojedynczego procesu: przejmuje zadania aż do zatrzymania (lub opróżnienia kolejki przy once)."""
+    embed_fn = None
+    if stub_embeddings:
+        # Atrapa tylko do testów - produkcyjny worker jej nie ładuje
+        from ollama_stub import stub_embed_documents
+        embed_fn = stub_embed_documents
+    # Limit klienta Ollamy jest per proces - worker bierze mniejszy, żeby nie zająć serwera czatowi
+    llm_client.get_client().max_concurrency = config.OLLAMA_WORKER_CONCURRENCY
+    poll_interval = config.INGEST_POLL_INTERVAL if poll_interval is None else poll_interval
+    last_gc = time.monotonic()
+    while True:
+        job = db_utils.claim_ingest_job(config.INGEST_PER_USER_LIMIT)
+        if job:
+            run_job(job, embed_fn=embed_fn)
+            log_embedding_cache_stats()
+            continue
+        if once:
+            return
+        db_utils.requeue_stale_jobs(config.INGEST_STALE_AFTER)
+        # Sprzątanie wektorów tylko przy pustej kolejce; równoległe workery pomija blokada w collect_garbage
+        if time.monotonic() - last_gc >= config.GC_INTERVAL:
+            last_gc = time.monotonic()
+            try:
+                rag_core.collect_garbage()
+            except Exception as e:
+                print(f"Błąd sprzątania wektorów: {e}")
+        time.sleep(poll_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker indeksowania dokumentów RAG")
+    parser.add_argument("--workers", type=int, default=config.INGEST_WORKERS)
+    parser.add_argument("--once", action="store_true", help="zakończ, gdy kolejka jest pusta")
+    parser.add_argument("--stub-embeddings", action="store_true", help="deterministyczne wektory zamiast Ollamy")
+    parser.add_argument("--gc", action="store_true", help="tylko posprzątaj nieużywane dokumenty i wektory, potem zakończ")
+    args = parser.parse_args()
+    db_utils.init_db()
+
+    if args.gc:
+        run = rag_core.collect_garbage()
+        print(f"Usunięto dokumentów: {run['documents']}, wektorów: {run['vectors']}, "
+              f"osieroconych wektorów: {run['orphan_vectors']}" + (" (sprząta inny proces)" if run["skipped"] else ""))
+        return
+
+    requeued = db_utils.requeue_stale_jobs(config.INGEST_STALE_AFTER)
+    if requeued:
+        print(f"Przywrócono do kolejki {requeued} porzuconych zadań.")
+
+    # spawn: każdy proces buduje własną pulę połączeń zamiast dziedziczyć gniazda rodzica;
+    # nie-demony, bo ekstrakcja PDF (pdf_extract) uruchamia własne procesy potomne
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=worker_loop, args=(args.stub_embeddings, args.once))
+             for _ in range(max(args.workers, 1))]
+    for p in procs:
+        p.start()
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        for p in procs:
+            p.terminate()
+
+
+if __name__ == "__main__":
+    main()
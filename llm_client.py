@@ -0,0 +1,252 @@
+"""Asynchroniczny klient HTTP Ollamy współdzielony przez wszystkie sesje w procesie.
+
+- ogranicza liczbę równoległych zapytań do serwera (OLLAMA_MAX_CONCURRENCY),
+- czat (INTERACTIVE) ma pierwszeństwo w kolejce przed indeksowaniem (BACKGROUND),
+- identyczne zapytania w locie (embed / generate) są liczone raz, a wynik trafia do wszystkich czekających.
+
+Pętla asyncio działa w osobnym wątku, więc kod synchroniczny (Streamlit, LangChain) używa metod
+embed() i generate_stream(). Adres serwera bierze się z OLLAMA_BASE_URL - do testów wystarczy
+lokalny serwer HTTP udający /api/embed i /api/generate.
+"""
+import asyncio, heapq, itertools, json, queue, threading, time
+from typing import Any, Iterator, List, Optional
+import httpx
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+import config
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class _Broadcast:
+    """Strumień tokenów jednego zapytania, odtwarzany każdemu, kto na nie czeka (także dołączającym później)."""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def push(self, chunk):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def follow(self):
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class OllamaClient:
+    def __init__(self, base_url=None, max_concurrency=None, timeout=None):
+        self.base_url = (base_url or config.OLLAMA_BASE_URL).rstrip("/")
+        self.max_concurrency = max_concurrency or config.OLLAMA_MAX_CONCURRENCY
+        self.timeout = timeout or config.OLLAMA_TIMEOUT
+        self._loop = None
+        self._loop_lock = threading.Lock()
+        self._http = None
+        # Stan poniżej jest używany wyłącznie z wątku pętli - bez blokad
+        self._active = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._inflight = {}
+        self.stats = {"requests": 0, "coalesced": 0, "queued": 0, "queue_wait_s": 0.0}
+
+    # --- pętla i połączenie ---
+    def _ensure_loop(self):
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="ollama-client", daemon=True).start()
+                self._loop = loop
+        return self._loop
+
+    def _client(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout)
+        return self._http
+
+    # --- limit równoległości z priorytetami ---
+    async def _acquire(self, priority):
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        self.stats["queued"] += 1
+        t0 = time.perf_counter()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # Slot mógł zostać przekazany tuż przed anulowaniem - trzeba go oddać
+            if fut.done() and not fut.cancelled():
+                self._release()
+            raise
+        self.stats["queue_wait_s"] += time.perf_counter() - t0
+
+    def _release(self):
+        # Slot przechodzi bezpośrednio na najważniejszego czekającego; anulowanych pomijamy
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._active -= 1
+
+    # --- embeddingi ---
+    async def embed_async(self, model, texts, priority=INTERACTIVE):
+        key = ("embed", model, tuple(texts))
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run_embed(model, list(texts), priority))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None) if self._inflight.get(key) is t else None)
+            self.stats["requests"] += 1
+        else:
+            self.stats["coalesced"] += 1
+        # shield: anulowanie jednego z czekających nie przerywa zapytania pozostałym
+        return await asyncio.shield(task)
+
+    async def _run_embed(self, model, texts, priority):
+        await self._acquire(priority)
+        try:
+            r = await self._client().post("/api/embed", json={"model": model, "input": texts})
+            r.raise_for_status()
+            return r.json()["embeddings"]
+        finally:
+            self._release()
+
+    # --- generowanie ---
+    async def generate_stream_async(self, model, prompt, options=None, priority=INTERACTIVE):
+        key = ("generate", model, prompt, json.dumps(options or {}, sort_keys=True))
+        bc = self._inflight.get(key)
+        if bc is None:
+            bc = _Broadcast()
+            self._inflight[key] = bc
+            self.stats["requests"] += 1
+            asyncio.ensure_future(self._run_generate(key, bc, model, prompt, options, priority))
+        else:
+            self.stats["coalesced"] += 1
+        async for chunk in bc.follow():
+            yield chunk
+
+    async def _run_generate(self, key, bc, model, prompt, options, priority):
+        try:
+            await self._acquire(priority)
+            try:
+                payload = {"model": model, "prompt": prompt, "stream": True, "options": options or {}}
+                async with self._client().stream("POST", "/api/generate", json=payload) as r:
+                    r.raise_for_status()
+                    async for line in r.aiter_lines():
+                        if not line:
+                            continue
+                        data = json.loads(line)
+                        if data.get("error"):
+                            raise RuntimeError(data["error"])
+                        if data.get("response"):
+                            bc.push(data["response"])
+                        if data.get("done"):
+                            break
+            finally:
+                self._release()
+            bc.finish()
+        except Exception as e:
+            bc.finish(e)
+        finally:
+            self._inflight.pop(key, None)
+
+    # --- most dla kodu synchronicznego ---
+    def embed(self, model, texts, priority=INTERACTIVE):
+        return asyncio.run_coroutine_threadsafe(self.embed_async(model, texts, priority), self._ensure_loop()).result()
+
+    def generate_stream(self, model, prompt, options=None, priority=INTERACTIVE):
+        q = queue.Queue()
+        done = object()
+
+        async def pump():
+            try:
+                async for chunk in self.generate_stream_async(model, prompt, options, priority):
+                    q.put(chunk)
+                q.put(done)
+            except Exception as e:
+                q.put(e)
+
+        asyncio.run_coroutine_threadsafe(pump(), self._ensure_loop())
+        while True:
+            item = q.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def get_client():
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            _default_client = OllamaClient()
+    return _default_client
+
+
+# --- ADAPTERY LANGCHAIN ---
+class CoalescingEmbeddings(Embeddings):
+    def __init__(self, client, model, priority=INTERACTIVE):
+        self.client = client
+        self.model = model
+        self.priority = priority
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.client.embed(self.model, texts, self.priority)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.client.embed(self.model, [text], self.priority)[0]
+
+
+class CoalescingLLM(LLM):
+    client: Any
+    model: str
+    temperature: float = 0.1
+    priority: int = INTERACTIVE
+
+    @property
+    def _llm_type(self) -> str:
+        return "ollama-coalescing"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        return "".join(chunk.text for chunk in self._stream(prompt, stop, run_manager, **kwargs))
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        options = {"temperature": self.temperature}
+        if stop:
+            options["stop"] = stop
+        for text in self.client.generate_stream(self.model, prompt, options, self.priority):
+            chunk = GenerationChunk(text=text)
+            if run_manager:
+                run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
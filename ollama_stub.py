@@ -0,0 +1,128 @@
+"""Atrapa serwera Ollamy do testów i benchmarków bez modeli.
+
+Obsługuje /api/embed (deterministyczne wektory z hasha tekstu) i /api/generate (strumień NDJSON ze stałą
+odpowiedzią). Uruchomienie:
+    python ollama_stub.py --port 11435
+    OLLAMA_HOST=http://localhost:11435 streamlit run app.py
+"""
+import argparse, hashlib, json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import config
+
+DEFAULT_ANSWER = "To jest odpowiedź testowa serwera atrapy."
+
+
+def stub_embed_documents(texts):
+    """Deterministyczne pseudo-embeddingi (bez Ollamy) - ten sam tekst daje ten sam wektor."""
+    vectors = []
+    for t in texts:
+        seed = hashlib.sha256(t.encode("utf-8")).digest()
+        raw = (seed * (config.EMBEDDING_DIM // len(seed) + 1))[:config.EMBEDDING_DIM]
+        vec = [b / 127.5 - 1.0 for b in raw]
+        norm = sum(v * v for v in vec) ** 0.5 or 1.0
+        vectors.append([v / norm for v in vec])
+    return vectors
+
+
+class StubOllama(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, answer=DEFAULT_ANSWER, delay=0.0):
+        super().__init__(address, _Handler)
+        self.answer = answer
+        self.delay = delay  # sekundy na token / na zapytanie embed - do testów kolejkowania
+        self.requests = {"embed": 0, "generate": 0}
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def _enter(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def _leave(self):
+        with self._lock:
+            self.active -= 1
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/api/embed":
+            self.server._enter("embed")
+            try:
+                time.sleep(self.server.delay)
+                texts = body.get("input") or []
+                self._send_json({"model": body.get("model"), "embeddings": stub_embed_documents(
+                    [texts] if isinstance(texts, str) else texts)})
+            finally:
+                self.server._leave()
+        elif self.path == "/api/generate":
+            self.server._enter("generate")
+            try:
+                self._stream_answer(body)
+            finally:
+                self.server._leave()
+        else:
+            self.send_error(404)
+
+    def _send_json(self, data):
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _stream_answer(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for token in self.server.answer.split(" "):
+            time.sleep(self.server.delay)
+            self._chunk({"model": body.get("model"), "response": token + " ", "done": False})
+        self._chunk({"model": body.get("model"), "response": "", "done": True})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _chunk(self, data):
+        line = (json.dumps(data) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(line):X}\r\n".encode() + line + b"\r\n")
+        self.wfile.flush()
+
+
+def serve(host="127.0.0.1", port=0, answer=DEFAULT_ANSWER, delay=0.0):
+    """Uruchamia atrapę w wątku w tle i zwraca serwer (server.url, server.shutdown())."""
+    server = StubOllama((host, port), answer, delay)
+    threading.Thread(target=server.serve_forever, name="ollama-stub", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Atrapa serwera Ollamy")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--answer", default=DEFAULT_ANSWER)
+    parser.add_argument("--delay", type=float, default=0.0, help="opóźnienie na token (s)")
+    args = parser.parse_args()
+    server = StubOllama((args.host, args.port), args.answer, args.delay)
+    print(f"Atrapa Ollamy na {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Wyciąganie tekstu z PDF-ów w puli procesów.
+
+Parsowanie PDF w pypdf jest czysto CPU-bound, więc wątki nic nie dają. Strony dokumentu są dzielone
+na zakresy po EXTRACT_PAGES_PER_TASK i rozdzielane między procesy; iter_pages oddaje je w kolejności
+stron, gdy tylko kolejny zakres jest gotowy, więc chunker i embedding ruszają przed końcem pliku.
+Każdy proces ma limit pamięci (RLIMIT_AS, tylko Linux/macOS), żeby jeden ogromny PDF nie zabrał
+pamięci całej maszynie, a pula jest co jakiś czas wymieniana na świeżą (wycieki pamięci pypdf).
+"""
+import multiprocessing, threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from langchain_core.documents import Document
+from pypdf import PdfReader
+from pypdf.errors import PdfReadError
+import config
+
+try:
+    import resource
+except ImportError:  # Windows - bez limitu pamięci
+    resource = None
+
+
+class PermanentIngestError(Exception):
+    """Błąd samego pliku (brak, uszkodzony PDF, brak tekstu, limit pamięci) - ponowienie zadania go nie naprawi."""
+
+
+_pool = None
+_pool_tasks = 0
+_pool_lock = threading.Lock()
+
+
+def _init_worker(limit_mb):
+    if resource is not None and limit_mb:
+        limit = limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _extract_range(path, start, stop):
+    """Tekst stron [start, stop) - wykonywane w procesie puli."""
+    reader = PdfReader(path)
+    return [(i, reader.pages[i].extract_text() or "") for i in range(start, min(stop, len(reader.pages)))]
+
+
+def get_pool(tasks=0):
+    """Pula procesów ekstrakcji; tasks - ile zadań wywołujący zaraz do niej wyśle.
+
+    Po EXTRACT_RECYCLE_TASKS zadaniach zakładana jest nowa pula, a stara kończy swoje zadania i znika -
+    max_tasks_per_child z biblioteki standardowej zawiesza się na Pythonie 3.11 przy wymianie procesu.
+    """
+    global _pool, _pool_tasks
+    with _pool_lock:
+        if _pool is not None and _pool_tasks >= config.EXTRACT_RECYCLE_TASKS:
+            _pool.shutdown(wait=False)
+            _pool = None
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=config.EXTRACT_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker, initargs=(config.EXTRACT_MEMORY_LIMIT_MB,))
+            _pool_tasks = 0
+        _pool_tasks += tasks
+        return _pool
+
+
+def _reset_pool():
+    # Po zabiciu procesu (np. OOM killer) pula jest bezużyteczna - następne wywołanie założy nową
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _open(path):
+    try:
+        return PdfReader(path)
+    except (FileNotFoundError, PdfReadError) as e:
+        raise PermanentIngestError(f"Nie można otworzyć pliku PDF: {e}") from e
+
+
+def count_pages(path):
+    return len(_open(path).pages)
+
+
+def _submit_ranges(path, pages):
+    starts = range(0, pages, config.EXTRACT_PAGES_PER_TASK)
+    pool = get_pool(len(starts))
+    return [pool.submit(_extract_range, path, start, start + config.EXTRACT_PAGES_PER_TASK) for start in starts]
+
+
+def _page_docs(path, results):
+    return [Document(page_content=text, metadata={"source": path, "page": i}) for i, text in results]
+
+
+def _result(fut, name):
+    try:
+        return fut.result()
+    except MemoryError:
+        raise PermanentIngestError(f"Plik {name} przekracza limit pamięci ekstrakcji ({config.EXTRACT_MEMORY_LIMIT_MB} MB).")
+    except PdfReadError as e:
+        raise PermanentIngestError(f"Uszkodzony plik PDF {name}: {e}") from e
+    except BrokenProcessPool:
+        _reset_pool()
+        raise
+
+
+def iter_pages(path, name=None):
+    """Strony PDF jako Document(page_content, metadata page/source), w kolejności, w miarę postępu ekstrakcji."""
+    name = name or path
+    if multiprocessing.current_process().daemon:
+        # Proces-demon nie może mieć dzieci - czytamy na miejscu
+        reader = _open(path)
+        for i, page in enumerate(reader.pages):
+            yield Document(page_content=page.extract_text() or "", metadata={"source": path, "page": i})
+        return
+    futures = _submit_ranges(path, count_pages(path))
+    try:
+        for fut in futures:
+            yield from _page_docs(path, _result(fut, name))
+    finally:
+        # Przerwane czytanie (błąd dalej w pipeline) nie zostawia zadań w kolejce
+        for fut in futures:
+            fut.cancel()
+
+
+def extract_many(paths):
+    """Ekstrakcja wielu plików naraz: wszystkie zakresy stron idą do puli jednocześnie.
+
+    Oddaje (path, strony albo wyjątek) w kolejności ukończenia plików.
+    """
+    pending, parts = {}, {}
+    for path in paths:
+        try:
+            futures = _submit_ranges(path, count_pages(path))
+        except Exception as e:
+            yield path, e
+            continue
+        if not futures:
+            yield path, []
+            continue
+        parts[path] = [None] * len(futures)
+        for idx, fut in enumerate(futures):
+            pending[fut] = (path, idx)
+    if not pending:
+        return
+    failed = set()
+    for fut in as_completed(pending):
+        path, idx = pending[fut]
+        if path in failed:
+            continue
+        try:
+            parts[path][idx] = _result(fut, path)
+        except Exception as e:
+            failed.add(path)
+            yield path, e
+            continue
+        if all(p is not None for p in parts[path]):
+            yield path, _page_docs(path, [page for part in parts.pop(path) for page in part])
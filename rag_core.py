@@ -1,70 +1,1032 @@
-import os, config, db_utils, uuid
+import os, re, math, json, config, db_utils, llm_client, chunking, pdf_extract, uuid, time, hashlib, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeout
 from langchain_postgres.vectorstores import PGVector
+from sqlalchemy import create_engine
+from psycopg2.extras import execute_values
 from langchain_ollama import OllamaLLM, OllamaEmbeddings
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda
 from langchain_core.output_parsers import StrOutputParser
-from langchain_community.document_loaders import PyPDFLoader, TextLoader
+from langchain_community.document_loaders import TextLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pdf_extract import PermanentIngestError
 
-embeddings = OllamaEmbeddings(model=config.EMBEDDING_MODEL)
-llm = OllamaLLM(model=config.LLM_MODEL, temperature=0.1)
+if config.LLM_CLIENT == "async":
+    embeddings = llm_client.CoalescingEmbeddings(llm_client.get_client(), config.EMBEDDING_MODEL)
+    llm = llm_client.CoalescingLLM(client=llm_client.get_client(), model=config.LLM_MODEL, temperature=0.1)
+else:
+    embeddings = OllamaEmbeddings(model=config.EMBEDDING_MODEL)
+    llm = OllamaLLM(model=config.LLM_MODEL, temperature=0.1)
 
-# Pojedyncza globalna instancja vector store
-_vector_store = None
+# Wektory są partycjonowane po właścicielu: każdy ma własną kolekcję PGVector, a wszystkie
+# instancje PGVector dzielą jeden silnik SQLAlchemy (jedną pulę połączeń)
+_engine = None
+_vector_stores = {}
+_vector_stores_lock = threading.Lock()
+_schema_ready = False
 
 
-def get_vector_store():
-    global _vector_store
-    if _vector_store is None:
-        _vector_store = PGVector(
-            connection=config.DATABASE_URL,
+def _search_options():
+    """Parametry sesji dla wyszukiwania ANN (przekazywane w połączeniu SQLAlchemy)."""
+    opts = []
+    if config.VECTOR_INDEX == "hnsw":
+        opts.append(f"-c hnsw.ef_search={config.HNSW_EF_SEARCH}")
+        if config.HNSW_ITERATIVE_SCAN:
+            opts.append(f"-c hnsw.iterative_scan={config.HNSW_ITERATIVE_SCAN}")
+    return " ".join(opts)
+
+
+def owner_collection_name(owner):
+    return f"{config.COLLECTION_NAME}__{owner}"
+
+
+def get_vector_store(owner):
+    """PGVector dla partycji właściciela; przy pierwszym użyciu zakłada jej częściowy indeks ANN."""
+    global _engine, _schema_ready
+    with _vector_stores_lock:
+        store = _vector_stores.get(owner)
+        if store is not None:
+            return store
+        if _engine is None:
+            options = _search_options()
+            _engine = create_engine(config.DATABASE_URL, connect_args={"options": options} if options else {})
+        store = PGVector(
+            connection=_engine,
             embeddings=embeddings,
-            collection_name=config.COLLECTION_NAME,
-            use_jsonb=True
+            collection_name=owner_collection_name(owner),
+            embedding_length=config.EMBEDDING_DIM,
+            use_jsonb=True,
         )
-    return _vector_store
+        if not _schema_ready:
+            ensure_vector_schema()
+            _schema_ready = True
+        ensure_owner_index(owner)
+        _vector_stores[owner] = store
+        return store
+
+
+def quantized_search():
+    """Czy wyszukiwanie idzie po skwantyzowanym/obciętym wyrażeniu zamiast po pełnych wektorach."""
+    return config.VECTOR_STORAGE != "full" or bool(config.EMBEDDING_TRUNCATE_DIM)
+
+
+def ann_expression(column="embedding", storage=None, truncate_dim=None):
+    """(wyrażenie, klasa operatorów, operator odległości) dla trybu VECTOR_STORAGE.
+
+    Tabela zawsze trzyma pełne wektory float32 - zmniejsza się indeks, a pełna precyzja służy do
+    przeliczenia najlepszych kandydatów. Obcięcie (Matryoshka) bierze pierwsze truncate_dim współrzędnych.
+    """
+    storage = storage or config.VECTOR_STORAGE
+    dim = truncate_dim if truncate_dim is not None else config.EMBEDDING_TRUNCATE_DIM
+    base = f"subvector({column}, 1, {dim})" if dim else column
+    d = dim or config.EMBEDDING_DIM
+    if storage == "halfvec":
+        return f"({base}::halfvec({d}))", "halfvec_cosine_ops", "<=>"
+    if storage == "binary":
+        return f"(binary_quantize({base})::bit({d}))", "bit_hamming_ops", "<~>"
+    if dim:
+        return f"({base}::vector({d}))", "vector_cosine_ops", "<=>"
+    return column, "vector_cosine_ops", "<=>"
+
+
+_STORAGE_TAGS = {"full": "f", "halfvec": "hv", "binary": "bq"}
+
+
+def _ann_index_name(name, index, storage, truncate_dim):
+    storage = storage or config.VECTOR_STORAGE
+    dim = truncate_dim if truncate_dim is not None else config.EMBEDDING_TRUNCATE_DIM
+    if storage == "full" and not dim:
+        return f"{name}_embedding_{index}_idx"
+    # Krótsza nazwa - identyfikatory w Postgresie mają maks. 63 znaki
+    return f"{name}_{index}_{_STORAGE_TAGS[storage]}{dim or ''}_idx"
 
 
-def process_file(path, name, user):
+def vector_index_statements(table="langchain_pg_embedding", collection_uuid=None, ann=True, storage=None, truncate_dim=None):
+    """DDL indeksów: ANN na wektorach oraz wyrażeniowe/GIN na metadanych używanych w filtrach.
+
+    collection_uuid - tylko częściowy indeks ANN jednej partycji (kolekcji właściciela).
+    storage / truncate_dim - nadpisują VECTOR_STORAGE / EMBEDDING_TRUNCATE_DIM (benchmark).
+    """
+    if collection_uuid:
+        stmts, name, where = [], f"emb_{uuid.UUID(str(collection_uuid)).hex}", f" WHERE collection_id = '{collection_uuid}'"
+    else:
+        stmts, name, where = [
+            f"CREATE INDEX IF NOT EXISTS {table}_document_idx ON {table} ((cmetadata ->> 'document_id'))",
+            f"CREATE INDEX IF NOT EXISTS {table}_cmetadata_gin_idx ON {table} USING gin (cmetadata jsonb_path_ops)",
+        ], table, ""
+    if not ann:
+        return stmts
+    expr, opclass, _ = ann_expression("embedding", storage, truncate_dim)
+    if config.VECTOR_INDEX == "hnsw":
+        stmts.append(f"CREATE INDEX IF NOT EXISTS {_ann_index_name(name, 'hnsw', storage, truncate_dim)} ON {table} "
+                     f"USING hnsw ({expr} {opclass}) "
+                     f"WITH (m = {config.HNSW_M}, ef_construction = {config.HNSW_EF_CONSTRUCTION}){where}")
+    elif config.VECTOR_INDEX == "ivfflat":
+        stmts.append(f"CREATE INDEX IF NOT EXISTS {_ann_index_name(name, 'ivfflat', storage, truncate_dim)} ON {table} "
+                     f"USING ivfflat ({expr} {opclass}) WITH (lists = {config.IVFFLAT_LISTS}){where}")
+    return stmts
+
+
+def drop_stale_ann_indexes(cur, prefix, keep, table="langchain_pg_embedding"):
+    """Usuwa indeksy ANN z innego trybu przechowywania (po zmianie VECTOR_STORAGE), zostawia te z keep."""
+    cur.execute("""
+        SELECT indexname FROM pg_indexes
+        WHERE tablename = %s AND starts_with(indexname, %s) AND indexdef ~ 'USING (hnsw|ivfflat)'
+    """, (table, prefix))
+    for (name,) in cur.fetchall():
+        if not any(f" {name} " in stmt for stmt in keep):
+            cur.execute(f"DROP INDEX IF EXISTS {name}")
+            print(f"Usunięto nieużywany indeks wektorowy {name}.")
+
+
+_collection_uuids = {}
+
+
+def owner_collection_uuid(owner):
+    """UUID kolekcji PGVector właściciela (None, dopóki nic nie zaindeksował)."""
+    cached = _collection_uuids.get(owner)
+    if cached:
+        return cached
+    with db_utils.db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT uuid::text FROM langchain_pg_collection WHERE name = %s", (owner_collection_name(owner),))
+        r = cur.fetchone()
+    if r:
+        _collection_uuids[owner] = r[0]
+        return r[0]
+    return None
+
+
+def ensure_owner_index(owner):
+    """Częściowy indeks ANN na partycji właściciela - wyszukiwanie nie przechodzi przez graf innych użytkowników."""
+    if config.VECTOR_INDEX_SCOPE != "owner":
+        return
     try:
-        loader = PyPDFLoader(path) if name.lower().endswith('.pdf') else TextLoader(path, encoding='utf-8')
-        docs = loader.load()
-        splitter = RecursiveCharacterTextSplitter(chunk_size=config.CHUNK_SIZE, chunk_overlap=config.CHUNK_OVERLAP)
-        chunks = splitter.split_documents(docs)
-
-        if not chunks:
-            return False
-
-        texts = []
-        metadatas = []
-        ids = []
-
-        for c in chunks:
-            texts.append(c.page_content)
-            metadatas.append({"username": user, "source_file": name})
-            ids.append(str(uuid.uuid4()))
-
-        # Użyj pojedynczej instancji
-        vs = get_vector_store()
-        vs.add_texts(texts=texts, metadatas=metadatas, ids=ids)
-        return True
+        collection_uuid = owner_collection_uuid(owner)
+        if collection_uuid:
+            stmts = vector_index_statements(collection_uuid=collection_uuid)
+            with db_utils.db_conn() as conn:
+                cur = conn.cursor()
+                for stmt in stmts:
+                    cur.execute(stmt)
+                drop_stale_ann_indexes(cur, f"emb_{uuid.UUID(collection_uuid).hex}_", stmts)
+    except Exception as e:
+        print(f"Błąd zakładania indeksu partycji {owner}: {e}")
+
+
+def migrate_shared_collection(cur):
+    """Przenosi wektory ze wspólnej kolekcji COLLECTION_NAME do kolekcji właścicieli i nadaje im document_id."""
+    cur.execute("SELECT uuid FROM langchain_pg_collection WHERE name = %s", (config.COLLECTION_NAME,))
+    r = cur.fetchone()
+    if not r:
+        return
+    legacy = r[0]
+    cur.execute("""
+        INSERT INTO langchain_pg_collection (uuid, name, cmetadata)
+        SELECT gen_random_uuid(), %s || '__' || owner, '{}'::json
+        FROM (SELECT DISTINCT cmetadata ->> 'username' AS owner FROM langchain_pg_embedding WHERE collection_id = %s) o
+        WHERE NOT EXISTS (SELECT 1 FROM langchain_pg_collection c WHERE c.name = %s || '__' || o.owner)
+    """, (config.COLLECTION_NAME, legacy, config.COLLECTION_NAME))
+    cur.execute("""
+        INSERT INTO documents (owner_username, file_name)
+        SELECT DISTINCT cmetadata ->> 'username', cmetadata ->> 'source_file' FROM langchain_pg_embedding WHERE collection_id = %s
+        ON CONFLICT (owner_username, file_name) DO NOTHING
+    """, (legacy,))
+    cur.execute("""
+        UPDATE langchain_pg_embedding e
+        SET collection_id = c.uuid, cmetadata = e.cmetadata || jsonb_build_object('document_id', d.id::text)
+        FROM langchain_pg_collection c, documents d
+        WHERE e.collection_id = %s
+          AND c.name = %s || '__' || (e.cmetadata ->> 'username')
+          AND d.owner_username = e.cmetadata ->> 'username' AND d.file_name = e.cmetadata ->> 'source_file'
+    """, (legacy, config.COLLECTION_NAME))
+    print(f"Migracja wektorów do partycji właścicieli: przeniesiono {cur.rowcount} fragmentów.")
+    # Przeniesione dokumenty są kompletne - odcisk pliku staje się hashem dokumentu (bez odcisku: same zera,
+    # żeby dokument był widoczny jako zaindeksowany)
+    cur.execute("""
+        UPDATE documents d SET content_hash = COALESCE(fp.content_hash, repeat('0', 64))
+        FROM (SELECT DISTINCT cmetadata ->> 'username' AS owner, cmetadata ->> 'source_file' AS file
+              FROM langchain_pg_embedding WHERE cmetadata ? 'document_id') m
+        LEFT JOIN file_fingerprints fp ON fp.username = m.owner AND fp.file_name = m.file
+        WHERE d.owner_username = m.owner AND d.file_name = m.file AND d.content_hash IS NULL
+    """)
+    cur.execute("""
+        UPDATE collection_files f SET document_id = d.id
+        FROM collections c, documents d
+        WHERE c.id = f.collection_id AND f.document_id IS NULL
+          AND d.owner_username = c.owner_username AND d.file_name = f.file_name
+    """)
+    cur.execute("DELETE FROM langchain_pg_collection c WHERE c.uuid = %s AND NOT EXISTS "
+                "(SELECT 1 FROM langchain_pg_embedding e WHERE e.collection_id = c.uuid)", (legacy,))
+
+
+def ensure_vector_schema():
+    """Zakłada indeksy na langchain_pg_embedding i migruje stary układ; bezpieczne do wielokrotnego wywołania."""
+    try:
+        with db_utils.db_conn() as conn:
+            cur = conn.cursor()
+            # Indeksy ANN wymagają kolumny o ustalonym wymiarze; starsze tabele mają samo "vector"
+            cur.execute("""
+                SELECT atttypmod FROM pg_attribute
+                WHERE attrelid = 'langchain_pg_embedding'::regclass AND attname = 'embedding'
+            """)
+            r = cur.fetchone()
+            if r and r[0] <= 0:
+                cur.execute(f"ALTER TABLE langchain_pg_embedding ALTER COLUMN embedding TYPE vector({config.EMBEDDING_DIM})")
+            cur.execute("CREATE INDEX IF NOT EXISTS langchain_pg_embedding_collection_idx ON langchain_pg_embedding (collection_id)")
+            migrate_shared_collection(cur)
+            stmts = vector_index_statements(ann=config.VECTOR_INDEX_SCOPE == "global")
+            for stmt in stmts:
+                cur.execute(stmt)
+            # W trybie "owner" wspólny indeks ANN (z baz sprzed partycji) tylko dubluje indeksy partycji
+            drop_stale_ann_indexes(cur, "langchain_pg_embedding_", stmts)
+            # Filtry idą po document_id - indeksy po nazwie pliku/użytkowniku nie są już używane
+            for name in ("langchain_pg_embedding_username_file_idx", "langchain_pg_embedding_source_file_idx"):
+                cur.execute(f"DROP INDEX IF EXISTS {name}")
+            # Kolumna i indeks pełnotekstowy dla wyszukiwania hybrydowego
+            cur.execute(f"""
+                ALTER TABLE langchain_pg_embedding ADD COLUMN IF NOT EXISTS document_tsv tsvector
+                GENERATED ALWAYS AS (to_tsvector('{config.FTS_CONFIG}'::regconfig, coalesce(document, ''))) STORED
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS langchain_pg_embedding_tsv_idx ON langchain_pg_embedding USING gin (document_tsv)")
+    except Exception as e:
+        print(f"Błąd zakładania indeksów wektorowych: {e}")
+
+
+def make_splitter(name, strategy=None):
+    """Funkcja strona -> fragmenty dla pliku, wg CHUNKING_STRATEGY."""
+    if (strategy or config.CHUNKING_STRATEGY) == "structured":
+        return chunking.Chunker.for_file(name).split
+    splitter = RecursiveCharacterTextSplitter(chunk_size=config.CHUNK_SIZE, chunk_overlap=config.CHUNK_OVERLAP,
+                                              add_start_index=True)
+    return lambda page: splitter.split_documents([page])
+
+
+def _iter_chunk_batches(path, name, batch_size):
+    """Ładuje dokument strona po stronie i oddaje (partia, przeczytane strony), bez czekania na cały plik."""
+    if name.lower().endswith('.pdf'):
+        # Strony parsowane w puli procesów - pierwsze partie idą do embeddingu, zanim reszta pliku jest gotowa
+        page_iter = pdf_extract.iter_pages(path, name)
+    else:
+        page_iter = TextLoader(path, encoding='utf-8').lazy_load()
+    split = make_splitter(name)
+    batch = []
+    pages = 0
+    for page in page_iter:
+        pages += 1
+        batch.extend(split(page))
+        while len(batch) >= batch_size:
+            yield batch[:batch_size], pages
+            batch = batch[batch_size:]
+    if batch:
+        yield batch, pages
+
+
+def _count_pages(path, name):
+    if not name.lower().endswith('.pdf'):
+        return 1
+    return max(pdf_extract.count_pages(path), 1)
+
+
+# --- CACHE EMBEDDINGÓW ---
+_cache_stats = {"chunk_hits": 0, "chunk_misses": 0, "file_hits": 0, "file_misses": 0}
+_cache_stats_lock = threading.Lock()
+
+
+def _bump_cache_stats(**deltas):
+    with _cache_stats_lock:
+        for k, v in deltas.items():
+            _cache_stats[k] += v
+
+
+def get_embedding_cache_stats():
+    with _cache_stats_lock:
+        stats = dict(_cache_stats)
+    chunks = stats["chunk_hits"] + stats["chunk_misses"]
+    files = stats["file_hits"] + stats["file_misses"]
+    stats["chunk_hit_rate"] = stats["chunk_hits"] / chunks if chunks else 0.0
+    stats["file_hit_rate"] = stats["file_hits"] / files if files else 0.0
+    return stats
+
+
+def _chunk_hash(text):
+    return hashlib.sha256(f"{config.EMBEDDING_MODEL}\0{text}".encode("utf-8")).hexdigest()
+
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _embed_with_cache(embed_fn, texts):
+    """Embeduje tylko fragmenty, których nie ma w embedding_cache; zwraca (wektory, trafienia)."""
+    hashes = [_chunk_hash(t) for t in texts]
+    cached = db_utils.get_cached_embeddings(set(hashes))
+    # Identyczne fragmenty w obrębie partii (stopki, klauzule) embedujemy raz
+    missing = {h: t for h, t in zip(hashes, texts) if h not in cached}
+    if missing:
+        new_vectors = embed_fn(list(missing.values()))
+        fresh = dict(zip(missing.keys(), new_vectors))
+        db_utils.save_cached_embeddings(list(fresh.items()), config.EMBEDDING_MODEL)
+        cached.update(fresh)
+    hits = len(texts) - sum(1 for h in hashes if h in missing)
+    _bump_cache_stats(chunk_hits=hits, chunk_misses=len(texts) - hits)
+    return [cached[h] for h in hashes], hits
+
+
+def _embed_batch(embed_fn, item, use_cache):
+    t0 = time.perf_counter()
+    texts = [c.page_content for c in item[0]]
+    if not texts:
+        return item, [], 0, 0.0
+    if use_cache:
+        vectors, hits = _embed_with_cache(embed_fn, texts)
+    else:
+        vectors, hits = embed_fn(texts), 0
+    return item, vectors, hits, time.perf_counter() - t0
 
+
+def _ingest_embed_fn():
+    """Indeksowanie ustępuje w kolejce klienta Ollamy zapytaniom z czatu."""
+    if isinstance(embeddings, llm_client.CoalescingEmbeddings):
+        return lambda texts: embeddings.client.embed(embeddings.model, texts, llm_client.BACKGROUND)
+    return embeddings.embed_documents
+
+
+def _embed_workers(use_model):
+    # Więcej wątków niż slotów klienta Ollamy tylko czekałoby w jego kolejce
+    if use_model and isinstance(embeddings, llm_client.CoalescingEmbeddings):
+        return max(min(config.EMBED_WORKERS, embeddings.client.max_concurrency), 1)
+    return config.EMBED_WORKERS
+
+
+# --- WERSJE DOKUMENTÓW I USUWANIE WEKTORÓW ---
+def _document_chunks(owner, document_id):
+    """{chunk_hash: [id wiersza]} zaindeksowanej wersji dokumentu (wiersze bez hasha pod kluczem None)."""
+    collection_uuid = owner_collection_uuid(owner)
+    if not collection_uuid:
+        return {}
+    with db_utils.db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT id, cmetadata ->> 'chunk_hash' FROM langchain_pg_embedding
+            WHERE collection_id = %s AND cmetadata ->> 'document_id' = %s
+        """, (collection_uuid, document_id))
+        chunks = {}
+        for row_id, chunk_hash in cur.fetchall():
+            chunks.setdefault(chunk_hash, []).append(row_id)
+        return chunks
+
+
+def _update_chunk_metadata(kept):
+    """Niezmienione fragmenty dostają metadane nowej wersji (strona/pozycja mogły się przesunąć)."""
+    for i in range(0, len(kept), config.DELETE_BATCH_SIZE):
+        with db_utils.db_conn() as conn:
+            execute_values(conn.cursor(), """
+                UPDATE langchain_pg_embedding e SET cmetadata = v.meta::jsonb
+                FROM (VALUES %s) v(id, meta) WHERE e.id = v.id
+            """, [(row_id, json.dumps(meta, ensure_ascii=False)) for row_id, meta in kept[i:i + config.DELETE_BATCH_SIZE]])
+
+
+def delete_vectors(ids):
+    """Usuwa wiersze po id, po DELETE_BATCH_SIZE w transakcji; zwraca liczbę usuniętych."""
+    deleted = 0
+    for i in range(0, len(ids), config.DELETE_BATCH_SIZE):
+        with db_utils.db_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM langchain_pg_embedding WHERE id = ANY(%s)", (ids[i:i + config.DELETE_BATCH_SIZE],))
+            deleted += cur.rowcount
+    return deleted
+
+
+def _delete_document_rows(collection_uuid, document_ids):
+    deleted = 0
+    while True:
+        with db_utils.db_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                DELETE FROM langchain_pg_embedding WHERE id IN (
+                    SELECT id FROM langchain_pg_embedding
+                    WHERE collection_id = %s AND cmetadata ->> 'document_id' = ANY(%s)
+                    LIMIT %s)
+            """, (collection_uuid, list(document_ids), config.DELETE_BATCH_SIZE))
+            deleted += cur.rowcount
+            if cur.rowcount < config.DELETE_BATCH_SIZE:
+                return deleted
+
+
+def delete_document_vectors(owner, document_ids):
+    """Wektory dokumentów z partycji właściciela, partiami (krótkie transakcje, bez długich blokad)."""
+    collection_uuid = owner_collection_uuid(owner)
+    if not collection_uuid or not document_ids:
+        return 0
+    return _delete_document_rows(collection_uuid, document_ids)
+
+
+_gc_stats = {"runs": 0, "documents": 0, "vectors": 0, "orphan_vectors": 0, "last_run_s": 0.0}
+_gc_lock = threading.Lock()
+
+
+def collect_garbage(grace_hours=None):
+    """Usuwa dokumenty, do których nie odwołuje się żadna kolekcja (po GC_GRACE_HOURS), oraz wektory
+    dokumentów, których już nie ma w tabeli documents. Zwraca statystyki tego przebiegu.
+
+    Kilka workerów może wołać to równocześnie - sprząta tylko ten, który dostanie blokadę doradczą.
+    """
+    grace_hours = config.GC_GRACE_HOURS if grace_hours is None else grace_hours
+    run = {"documents": 0, "vectors": 0, "orphan_vectors": 0, "skipped": False}
+    t0 = time.perf_counter()
+    with db_utils.db_conn() as lock_conn:
+        lock_cur = lock_conn.cursor()
+        lock_cur.execute("SELECT pg_try_advisory_lock(hashtext('vector_gc'))")
+        if not lock_cur.fetchone()[0]:
+            run["skipped"] = True
+            return run
+        try:
+            by_owner = {}
+            for document_id, owner, _ in db_utils.get_unreferenced_documents(grace_hours):
+                by_owner.setdefault(owner, []).append(document_id)
+            for owner, document_ids in by_owner.items():
+                # Najpierw wektory: jeśli coś przerwie sprzątanie, dokument zostanie i następny przebieg dokończy
+                run["vectors"] += delete_document_vectors(owner, document_ids)
+                run["documents"] += db_utils.delete_documents(document_ids)
+            with db_utils.db_conn() as conn:
+                cur = conn.cursor()
+                cur.execute("""
+                    SELECT e.collection_id::text, array_agg(DISTINCT e.cmetadata ->> 'document_id')
+                    FROM langchain_pg_embedding e
+                    WHERE e.cmetadata ? 'document_id' AND NOT EXISTS
+                          (SELECT 1 FROM documents d WHERE d.id::text = e.cmetadata ->> 'document_id')
+                    GROUP BY e.collection_id
+                """)
+                orphans = cur.fetchall()
+            for collection_uuid, document_ids in orphans:
+                run["orphan_vectors"] += _delete_document_rows(collection_uuid, document_ids)
+        finally:
+            lock_cur.execute("SELECT pg_advisory_unlock(hashtext('vector_gc'))")
+    run["elapsed_s"] = time.perf_counter() - t0
+    with _gc_lock:
+        _gc_stats["runs"] += 1
+        for key in ("documents", "vectors", "orphan_vectors"):
+            _gc_stats[key] += run[key]
+        _gc_stats["last_run_s"] = run["elapsed_s"]
+    if run["documents"] or run["orphan_vectors"]:
+        print(f"Sprzątanie: usunięto {run['documents']} dokumentów, {run['vectors']} wektorów, "
+              f"{run['orphan_vectors']} osieroconych wektorów ({run['elapsed_s']:.1f}s)")
+    return run
+
+
+def get_gc_stats():
+    with _gc_lock:
+        return dict(_gc_stats)
+
+
+def ingest_file(path, name, user, embed_fn=None, progress_cb=None):
+    """Indeksuje plik: partie fragmentów są embedowane równolegle i zapisywane zbiorczo.
+
+    Zwraca słownik z licznikami i czasami etapów; błędy są propagowane (patrz process_file).
+    progress_cb(ułamek) jest wołany po zapisaniu każdej partii.
+    """
+    # Cache dotyczy tylko prawdziwego modelu - wektory z podstawionego embed_fn nie mogą do niego trafić
+    use_cache = embed_fn is None
+    embed_fn = embed_fn or _ingest_embed_fn()
+    stats = {"chunks": 0, "pages": 0, "batches": 0, "cache_hits": 0, "reused": 0, "deleted": 0, "skipped": False,
+             "load_split_s": 0.0, "embed_s": 0.0, "write_s": 0.0, "total_s": 0.0}
+    t_start = time.perf_counter()
+    try:
+        file_hash = _file_hash(path)
+    except FileNotFoundError as e:
+        raise PermanentIngestError(f"Brak pliku {path}.") from e
+    if use_cache:
+        if db_utils.get_file_fingerprint(user, name) == (file_hash, config.EMBEDDING_MODEL):
+            # Ten sam plik tego samego użytkownika jest już zaindeksowany - nic do roboty
+            _bump_cache_stats(file_hits=1)
+            stats["skipped"] = True
+            stats["total_s"] = time.perf_counter() - t_start
+            return stats
+        _bump_cache_stats(file_misses=1)
+
+    total_pages = _count_pages(path, name) if progress_cb else 1
+    vs = get_vector_store(user)
+    document_id = db_utils.upsert_document(user, name)
+    # Poprzednia wersja dokumentu: fragmenty o tej samej treści zostają (bez embedowania i ponownego zapisu).
+    # Wektory z podstawionego embed_fn nie mają chunk_hash, więc nigdy nie są używane ponownie.
+    previous = _document_chunks(user, document_id)
+    kept = []
+
+    def metadata(c):
+        return {"username": user, "source_file": name, "document_id": document_id, "page": c.metadata.get("page", 0),
+                "start_index": c.metadata.get("start_index"), "section": c.metadata.get("section"),
+                "chunk_hash": _chunk_hash(c.page_content) if use_cache else None}
+
+    def write(done):
+        for fut in done:
+            (batch, pages_read), vectors, hits, embed_s = fut.result()
+            t0 = time.perf_counter()
+            if batch:
+                vs.add_embeddings(
+                    texts=[c.page_content for c in batch],
+                    embeddings=vectors,
+                    metadatas=[metadata(c) for c in batch],
+                    ids=[str(uuid.uuid4()) for _ in batch],
+                )
+            stats["write_s"] += time.perf_counter() - t0
+            stats["embed_s"] += embed_s
+            stats["pages"] = max(stats["pages"], pages_read)
+            stats["cache_hits"] += hits
+            stats["batches"] += 1
+            if progress_cb:
+                progress_cb(min(pages_read / total_pages, 1.0))
+
+    workers = _embed_workers(use_cache)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        batches = _iter_chunk_batches(path, name, config.EMBED_BATCH_SIZE)
+        while True:
+            t0 = time.perf_counter()
+            item = next(batches, None)
+            stats["load_split_s"] += time.perf_counter() - t0
+            if item is None:
+                break
+            batch, pages_read = item
+            fresh = []
+            for c in batch:
+                ids = previous.get(_chunk_hash(c.page_content)) if use_cache else None
+                if ids:
+                    kept.append((ids.pop(), metadata(c)))
+                else:
+                    fresh.append(c)
+            stats["chunks"] += len(batch)
+            stats["reused"] += len(batch) - len(fresh)
+            pending.add(pool.submit(_embed_batch, embed_fn, (fresh, pages_read), use_cache))
+            # Ograniczamy liczbę partii w locie, żeby nie trzymać całego pliku w pamięci
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write(done)
+        write(pending)
+
+    if not stats["chunks"]:
+        raise PermanentIngestError("Nie znaleziono tekstu w pliku.")
+    t0 = time.perf_counter()
+    _update_chunk_metadata(kept)
+    # Fragmenty poprzedniej wersji, których treść zniknęła z pliku
+    stats["deleted"] = delete_vectors([i for ids in previous.values() for i in ids])
+    stats["write_s"] += time.perf_counter() - t0
+    stats["version"] = db_utils.set_document_hash(document_id, file_hash)
+    if use_cache:
+        db_utils.save_file_fingerprint(user, name, file_hash, config.EMBEDDING_MODEL, stats["chunks"])
+    stats["total_s"] = time.perf_counter() - t_start
+    print(f"Zaindeksowano {name} (wersja {stats['version']}): {stats['chunks']} fragmentów, "
+          f"bez zmian {stats['reused']}, usuniętych {stats['deleted']}, z cache {stats['cache_hits']}, "
+          f"{stats['total_s']:.1f}s")
+    return stats
+
+
+def process_file(path, name, user, embed_fn=None, progress_cb=None):
+    """Jak ingest_file, ale zwraca False zamiast rzucać wyjątek."""
+    try:
+        return ingest_file(path, name, user, embed_fn=embed_fn, progress_cb=progress_cb)
     except Exception as e:
         print(f"Błąd przetwarzania pliku {name}: {e}")
         return False
 
 
+# --- CACHE ŁAŃCUCHÓW ---
+# cid -> (files_version, chain), LRU o rozmiarze CHAIN_CACHE_SIZE
+_chain_cache = OrderedDict()
+_chain_cache_lock = threading.Lock()
+
+
+def invalidate_collection_chain(cid):
+    with _chain_cache_lock:
+        _chain_cache.pop(cid, None)
+
+
+db_utils.on_collection_change(invalidate_collection_chain)
+
+
 def get_collection_chain(cid):
-    files = db_utils.get_collection_files(cid)
-    if not files:
+    """Łańcuch RAG dla kolekcji z cache; przebudowywany, gdy zmieni się wersja listy plików."""
+    version = db_utils.get_collection_version(cid)
+    if version is None:
+        invalidate_collection_chain(cid)
         return None
+    with _chain_cache_lock:
+        entry = _chain_cache.get(cid)
+        if entry and entry[0] == version:
+            _chain_cache.move_to_end(cid)
+            return entry[1]
+
+    chain = _build_collection_chain(cid)
+    if chain is None:
+        return None
+    with _chain_cache_lock:
+        _chain_cache[cid] = (version, chain)
+        _chain_cache.move_to_end(cid)
+        while len(_chain_cache) > config.CHAIN_CACHE_SIZE:
+            _chain_cache.popitem(last=False)
+    return chain
+
+
+# --- WYSZUKIWANIE ---
+_STOPWORDS = {"jaki", "jaka", "jakie", "jest", "się", "sie", "nie", "czy", "dla", "oraz", "ile", "kto", "gdzie",
+              "jak", "był", "była", "było", "tym", "ten", "tej", "tego", "pod", "nad", "przez", "który", "która"}
+
+
+def _lexical_query(question):
+    """Słowa pytania połączone OR dla websearch_to_tsquery; krótkie słowa i stopwords odpadają, liczby zostają."""
+    terms = [t for t in re.findall(r"\w+", question.lower())
+             if (len(t) >= 3 or any(ch.isdigit() for ch in t)) and t not in _STOPWORDS]
+    return " or ".join(dict.fromkeys(terms))
 
-    sql_filter = {"source_file": {"$in": files}}
-    retriever = get_vector_store().as_retriever(search_kwargs={'filter': sql_filter, 'k': 15})
+
+def lexical_search(owner, document_ids, question, k):
+    """Pełnotekstowe wyszukiwanie fragmentów z podanych dokumentów partycji właściciela, ranking ts_rank_cd."""
+    query = _lexical_query(question)
+    if not query:
+        return []
+    with db_utils.db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT e.document, e.cmetadata
+            FROM langchain_pg_embedding e
+            JOIN langchain_pg_collection c ON c.uuid = e.collection_id,
+                 websearch_to_tsquery(%s::regconfig, %s) q
+            WHERE c.name = %s AND e.cmetadata ->> 'document_id' = ANY(%s) AND e.document_tsv @@ q
+            ORDER BY ts_rank_cd(e.document_tsv, q) DESC
+            LIMIT %s
+        """, (config.FTS_CONFIG, query, owner_collection_name(owner), list(document_ids), k))
+        return [Document(page_content=r[0], metadata=r[1]) for r in cur.fetchall()]
+
+
+def vector_search_sql(table="langchain_pg_embedding", where="", storage=None, truncate_dim=None):
+    """Zapytanie dwuetapowe: kandydaci z indeksu na wyrażeniu skwantyzowanym, potem ranking pełnymi wektorami.
+
+    Parametry: %(q)s - wektor zapytania jako literał, %(fetch)s - liczba kandydatów, %(k)s - wynik.
+    """
+    expr, _, op = ann_expression("e.embedding", storage, truncate_dim)
+    query_expr, _, _ = ann_expression("%(q)s::vector", storage, truncate_dim)
+    return f"""
+        WITH candidates AS (
+            SELECT e.* FROM {table} e {where}
+            ORDER BY {expr} {op} {query_expr}
+            LIMIT %(fetch)s
+        )
+        SELECT * FROM candidates ORDER BY embedding <=> %(q)s::vector LIMIT %(k)s
+    """
+
+
+def vector_search(owner, document_ids, question, k):
+    """Wyszukiwanie wektorowe w trybie VECTOR_STORAGE "halfvec"/"binary" albo z obciętym wymiarem."""
+    collection_uuid = owner_collection_uuid(owner)
+    if not collection_uuid:
+        return []
+    vec = embeddings.embed_query(question)
+    sql = vector_search_sql(where="WHERE e.collection_id = %(coll)s AND e.cmetadata ->> 'document_id' = ANY(%(ids)s)")
+    with db_utils.db_conn() as conn:
+        cur = conn.cursor()
+        if config.VECTOR_INDEX == "hnsw":
+            cur.execute(f"SET LOCAL hnsw.ef_search = {max(config.HNSW_EF_SEARCH, k * config.RESCORE_FACTOR)}")
+            if config.HNSW_ITERATIVE_SCAN:
+                cur.execute(f"SET LOCAL hnsw.iterative_scan = {config.HNSW_ITERATIVE_SCAN}")
+        # UUID kolekcji jako stała w SQL - planista może wtedy użyć częściowego indeksu partycji
+        cur.execute(f"SELECT document, cmetadata FROM ({sql}) r",
+                    {"coll": collection_uuid, "ids": list(document_ids), "q": str(list(vec)),
+                     "fetch": k * config.RESCORE_FACTOR, "k": k})
+        return [Document(page_content=r[0], metadata=r[1]) for r in cur.fetchall()]
+
+
+def _rrf(result_lists, k):
+    """Reciprocal rank fusion: suma 1/(RRF_K + pozycja) po wszystkich listach."""
+    scores, docs = {}, {}
+    for results in result_lists:
+        for rank, d in enumerate(results):
+            key = (d.metadata.get("document_id"), d.page_content)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (config.RRF_K + rank + 1)
+            docs.setdefault(key, d)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [docs[key] for key in best]
+
+
+def retrieve_documents(owner, document_ids, question, k=None, mode=None):
+    """Fragmenty dokumentów kolekcji: wektorowo albo hybrydowo (wektory + pełnotekstowe, fuzja RRF).
+
+    Przeszukiwana jest tylko partycja właściciela kolekcji.
+    """
+    k = k or config.RETRIEVAL_K
+    mode = mode or config.RETRIEVAL_MODE
+    if not document_ids:
+        return []
+    store = get_vector_store(owner)
+    if quantized_search():
+        search = lambda n: vector_search(owner, document_ids, question, n)
+    else:
+        sql_filter = {"document_id": {"$in": list(document_ids)}}
+        search = lambda n: store.similarity_search(question, k=n, filter=sql_filter)
+    if mode != "hybrid":
+        return search(k)
+    vector_docs = search(config.RETRIEVAL_FETCH_K)
+    try:
+        lexical_docs = lexical_search(owner, document_ids, question, config.RETRIEVAL_FETCH_K)
+    except Exception as e:
+        print(f"Błąd wyszukiwania pełnotekstowego: {e}")
+        lexical_docs = []
+    return _rrf([vector_docs, lexical_docs], k)
+
+
+# --- RERANKING ---
+def _stem_terms(text):
+    # Obcięcie do 6 znaków to tani zamiennik stemmingu dla polskiej fleksji (faktura/fakturze/faktury)
+    return [t[:6] for t in re.findall(r"\w+", text.lower()) if len(t) >= 3 or any(ch.isdigit() for ch in t)]
+
+
+def lexical_overlap_scores(question, texts):
+    """Scorer BM25 liczony na zbiorze kandydatów - bez modelu, praktycznie darmowy na CPU."""
+    query = set(_stem_terms(question)) - {t[:6] for t in _STOPWORDS}
+    docs = [_stem_terms(t) for t in texts]
+    avg_len = sum(len(d) for d in docs) / len(docs) if docs else 1.0
+    df = {q: sum(1 for d in docs if q in d) for q in query}
+    scores = []
+    for d in docs:
+        tf = {}
+        for t in d:
+            if t in query:
+                tf[t] = tf.get(t, 0) + 1
+        score = 0.0
+        for t, f in tf.items():
+            idf = math.log(1 + (len(docs) - df[t] + 0.5) / (df[t] + 0.5))
+            score += idf * f * 2.2 / (f + 1.2 * (0.25 + 0.75 * len(d) / (avg_len or 1.0)))
+        scores.append(score)
+    return scores
+
+
+_cross_encoder = None
+
+
+def cross_encoder_scores(question, texts):
+    global _cross_encoder
+    if _cross_encoder is None:
+        from sentence_transformers import CrossEncoder
+        _cross_encoder = CrossEncoder(config.CROSS_ENCODER_MODEL, device="cpu")
+    return list(_cross_encoder.predict([(question, t) for t in texts], batch_size=config.RERANK_BATCH_SIZE))
+
+
+def get_reranker():
+    if config.RERANKER == "lexical":
+        return lexical_overlap_scores
+    if config.RERANKER == "cross-encoder":
+        return cross_encoder_scores
+    return None
+
+
+def rerank(question, docs, top_n=None, scorer=None, stats=None, weight=None):
+    """Przelicza trafność kandydatów scorerem(question, texts) i zostawia top_n najlepszych.
+
+    Wynik scorera (znormalizowany do 0-1) jest mieszany z pozycją kandydata w wyszukiwaniu w proporcji
+    RERANK_WEIGHT - sam BM25 zepchnąłby na dół trafienia wektorowe bez wspólnych słów z pytaniem.
+    """
+    top_n = top_n or config.RERANK_TOP_N
+    scorer = scorer or get_reranker()
+    weight = config.RERANK_WEIGHT if weight is None else weight
+    if scorer is None or len(docs) <= 1:
+        return docs[:top_n]
+    t0 = time.perf_counter()
+    # Cała lista naraz: BM25 liczy idf na zbiorze kandydatów, cross-encoder sam dzieli na partie
+    scores = scorer(question, [d.page_content for d in docs])
+    low, high = min(scores), max(scores)
+    n = len(docs)
+    blended = [weight * ((scores[i] - low) / (high - low) if high > low else 0.0) + (1 - weight) * (1 - i / (n - 1))
+               for i in range(n)]
+    # sorted jest stabilne - przy remisie zostaje kolejność z wyszukiwania
+    order = sorted(range(n), key=lambda i: blended[i], reverse=True)[:top_n]
+    elapsed = time.perf_counter() - t0
+    if stats is not None:
+        stats["rerank_s"] = elapsed
+    print(f"Rerank: {len(docs)} -> {len(order)} fragmentów w {elapsed * 1000:.0f} ms")
+    return [docs[i] for i in order]
+
+
+def retrieve_for_prompt(owner, document_ids, question):
+    """Wyszukiwanie z nadmiarem kandydatów + reranking (jeśli włączony)."""
+    if get_reranker() is None:
+        return retrieve_documents(owner, document_ids, question)
+    return rerank(question, retrieve_documents(owner, document_ids, question, k=config.RERANK_CANDIDATES))
+
+
+# --- SKŁADANIE KONTEKSTU ---
+def _estimate_tokens(text):
+    return int(len(text) / config.CONTEXT_CHARS_PER_TOKEN) + 1
+
+
+def _merge_overlapping(ranked):
+    """Skleja nachodzące na siebie fragmenty tej samej strony (efekt CHUNK_OVERLAP).
+
+    Sklejane są tylko fragmenty, których wspólna część naprawdę się zgadza - kawałki tabel z chunking.py
+    mają dopisany nagłówek, więc ich tekst jest dłuższy niż zakres strony, który zajmują.
+    ranked: lista (pozycja w rankingu, dokument). Zwraca listę (najlepsza pozycja, dokument).
+    """
+    groups, rest = {}, []
+    for rank, d in ranked:
+        if d.metadata.get("start_index") is None:
+            rest.append((rank, d))
+        else:
+            groups.setdefault((d.metadata.get("source_file"), d.metadata.get("page")), []).append((rank, d))
+
+    merged = list(rest)
+    for items in groups.values():
+        items.sort(key=lambda x: x[1].metadata["start_index"])
+        cur_rank, cur = items[0]
+        cur_start, cur_text = cur.metadata["start_index"], cur.page_content
+        for rank, d in items[1:]:
+            start = d.metadata["start_index"]
+            if start <= cur_start + len(cur_text) and d.page_content.startswith(cur_text[start - cur_start:][:len(d.page_content)]):
+                cur_text += d.page_content[cur_start + len(cur_text) - start:]
+                cur_rank = min(cur_rank, rank)
+            else:
+                merged.append((cur_rank, Document(page_content=cur_text, metadata=dict(cur.metadata, start_index=cur_start))))
+                cur_rank, cur, cur_start, cur_text = rank, d, start, d.page_content
+        merged.append((cur_rank, Document(page_content=cur_text, metadata=dict(cur.metadata, start_index=cur_start))))
+    return merged
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+def assemble_context(docs, budget=None):
+    """Scala nakładające się fragmenty, usuwa prawie-duplikaty i pakuje wynik w budżet tokenów wg trafności."""
+    budget = budget or config.CONTEXT_TOKEN_BUDGET
+    before = sum(_estimate_tokens(d.page_content) for d in docs)
+    units = sorted(_merge_overlapping(list(enumerate(docs))), key=lambda x: x[0])
+
+    kept, kept_words, used = [], [], 0
+    for _, d in units:
+        words = set(re.findall(r"\w+", d.page_content.lower()))
+        if any(_jaccard(words, w) >= config.CONTEXT_DEDUP_THRESHOLD for w in kept_words):
+            continue
+        tokens = _estimate_tokens(d.page_content)
+        if used + tokens > budget:
+            if kept:
+                continue
+            # Najtrafniejszy fragment większy niż cały budżet - przycinamy zamiast zostawić pusty kontekst
+            d = Document(page_content=d.page_content[:int(budget * config.CONTEXT_CHARS_PER_TOKEN)], metadata=d.metadata)
+            tokens = budget
+        kept.append(d)
+        kept_words.append(words)
+        used += tokens
+    if docs:
+        print(f"Kontekst: {len(docs)} -> {len(kept)} fragmentów, ~{before} -> ~{used} tokenów "
+              f"(zaoszczędzono ~{before - used})")
+    return kept
+
+
+# --- PAMIĘĆ ROZMOWY ---
+_CONDENSE_TEMPLATE = """[INST] <<SYS>> Przeformułuj ostatnie pytanie użytkownika tak, aby było zrozumiałe bez rozmowy.
+Uzupełnij brakujące nazwy, liczby i odniesienia z historii. Zwróć TYLKO pytanie, po polsku. <</SYS>>
+STRESZCZENIE: {summary}
+HISTORIA:
+{history}
+PYTANIE: {question} [/INST]"""
+
+_SUMMARY_TEMPLATE = """[INST] <<SYS>> Uzupełnij streszczenie rozmowy o nowe wiadomości. Zachowaj fakty, liczby i nazwy plików.
+Najwyżej kilka zdań, po polsku. Zwróć TYLKO nowe streszczenie. <</SYS>>
+DOTYCHCZASOWE STRESZCZENIE: {summary}
+NOWE WIADOMOŚCI:
+{history} [/INST]"""
+
+
+def _format_history(messages):
+    lines = []
+    for m in messages:
+        who = "Użytkownik" if m["role"] == "user" else "Asystent"
+        lines.append(f"{who}: {m['content'][:config.CHAT_MEMORY_MSG_CHARS]}")
+    return "\n".join(lines)
+
+
+# Zaimki i słowa odsyłające do wcześniejszej rozmowy ("a ile to w euro?", "kto jest jej sprzedawcą?")
+_FOLLOW_UP_WORDS = {"to", "tego", "temu", "tym", "ten", "ta", "tę", "te", "tej", "tych", "tamten", "tamta", "tamto",
+                    "on", "ona", "ono", "oni", "one", "jego", "jej", "ich", "go", "mu", "nim", "niej", "nich",
+                    "tam", "wtedy", "też", "także", "również", "jeszcze", "poprzedni", "poprzednia", "powyższy"}
+_FOLLOW_UP_STARTS = {"a", "i", "oraz", "ale", "no"}
+
+
+def looks_like_follow_up(question):
+    """Tania heurystyka: czy pytanie ma sens dopiero z historią rozmowy."""
+    words = re.findall(r"\w+", question.lower())
+    if len(words) <= config.CONDENSE_MAX_WORDS or "..." in question or "…" in question:
+        return True
+    return words[0] in _FOLLOW_UP_STARTS or any(w in _FOLLOW_UP_WORDS for w in words)
+
+
+_condense_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="condense")
+
+
+def condense_question(question, history, summary=""):
+    """Samodzielne pytanie do wyszukiwania; przy błędzie lub przekroczeniu CONDENSE_TIMEOUT zostaje oryginał.
+
+    Model jest pytany tylko o pytania wyglądające na uzupełniające - reszta nie czeka na dodatkowe wywołanie.
+    """
+    if not config.CONDENSE_QUESTIONS or not (history or summary) or not looks_like_follow_up(question):
+        return question
+    prompt = _CONDENSE_TEMPLATE.format(summary=summary or "-", history=_format_history(history), question=question)
+    # Wystarcza pierwsza linia odpowiedzi - stop na końcu linii skraca generowanie
+    future = _condense_pool.submit(llm.invoke, prompt, stop=["\n"])
+    try:
+        return future.result(timeout=config.CONDENSE_TIMEOUT).strip().splitlines()[0].strip() or question
+    except FuturesTimeout:
+        future.cancel()
+        print(f"Przeformułowanie pytania trwa ponad {config.CONDENSE_TIMEOUT}s - wyszukuję po oryginale")
+        return question
+    except Exception as e:
+        print(f"Błąd przeformułowania pytania: {e}")
+        return question
+
+
+def _unsummarized(messages, upto_seq):
+    # Wiadomości bez seq są jeszcze niezapisane, więc na pewno nowsze niż streszczenie
+    return [m for m in messages if m.get("seq", upto_seq + 1) > upto_seq]
+
+
+def prepare_turn(cid, user, question, history):
+    """Wejście łańcucha dla pytania w trwającej rozmowie (history - wiadomości przed pytaniem).
+
+    cacheable: pytanie nie zależy od kontekstu tej rozmowy, więc odpowiedź można dzielić z innymi czatami kolekcji.
+    """
+    summary, upto = db_utils.get_chat_summary(cid, user)
+    recent = _unsummarized(history, upto)[-2 * config.CHAT_MEMORY_TURNS:]
+    standalone = condense_question(question, recent, summary)
+    # Nieprzeformułowane pytanie w trwającej rozmowie ("a ile to w euro?") ma sens tylko z jej historią
+    cacheable = not (recent or summary) or standalone != question
+    return {"question": question, "standalone": standalone, "cacheable": cacheable,
+            "summary": summary, "history": _format_history(recent)}
+
+
+def refresh_chat_summary(cid, user, messages):
+    """Wciąga do streszczenia wiadomości spoza okna CHAT_MEMORY_TURNS.
+
+    Liczone dopiero, gdy niestreszczony ogon urośnie do dwóch okien, więc model pracuje co kilka tur, a nie co turę.
+    """
+    summary, upto = db_utils.get_chat_summary(cid, user)
+    tail = [m for m in _unsummarized(messages, upto) if "seq" in m]
+    if len(tail) <= 2 * config.CHAT_MEMORY_TURNS:
+        return
+    fold = tail[:-config.CHAT_MEMORY_TURNS]
+    try:
+        new_summary = llm.invoke(_SUMMARY_TEMPLATE.format(summary=summary or "-", history=_format_history(fold))).strip()
+        db_utils.save_chat_summary(cid, user, new_summary, fold[-1]["seq"])
+    except Exception as e:
+        print(f"Błąd streszczania rozmowy: {e}")
+
+
+_summary_jobs = set()
+_summary_jobs_lock = threading.Lock()
+
+
+def refresh_chat_summary_async(cid, user, messages):
+    """refresh_chat_summary w wątku w tle - wywołanie modelu nie blokuje odpowiedzi (jedno naraz na rozmowę)."""
+    # Krótka rozmowa na pewno nie ma czego streszczać - bez wątku i bez zapytania do bazy
+    if sum(1 for m in messages if "seq" in m) <= 2 * config.CHAT_MEMORY_TURNS:
+        return
+    key = (cid, user)
+    with _summary_jobs_lock:
+        if key in _summary_jobs:
+            return
+        _summary_jobs.add(key)
+
+    def run():
+        try:
+            refresh_chat_summary(cid, user, messages)
+        finally:
+            with _summary_jobs_lock:
+                _summary_jobs.discard(key)
+
+    threading.Thread(target=run, name="chat-summary", daemon=True).start()
+
+
+def _as_turn(inputs):
+    # Samo pytanie (np. z benchmarku) traktujemy jak rozmowę bez historii
+    if isinstance(inputs, str):
+        return {"question": inputs, "standalone": inputs, "cacheable": True, "summary": "", "history": ""}
+    return inputs
+
+
+def _build_collection_chain(cid):
+    owner, document_ids = db_utils.get_collection_documents(cid)
+    if not document_ids:
+        return None
+
+    retriever = RunnableLambda(lambda turn: retrieve_for_prompt(owner, document_ids, turn["standalone"]))
 
     template = """[INST] <<SYS>> Jesteś ekspertem analizującym dokumenty. Odpowiadaj TYLKO po polsku. Jak nie mozesz znalezc informacji to pisz "nie wiem"
 Zawsze wskazuj nazwę pliku źródłowego. <</SYS>>
+STRESZCZENIE ROZMOWY: {summary}
+OSTATNIE WIADOMOŚCI:
+{history}
 KONTEKST: {context}
 PYTANIE: {question} [/INST]"""
 
@@ -72,23 +1034,98 @@ PYTANIE: {question} [/INST]"""
         return "\n\n".join([f"--- PLIK: {d.metadata['source_file']} ---\n{d.page_content}" for d in docs])
 
     return (
-            {"context": retriever | format_docs, "question": RunnablePassthrough()}
+            RunnableLambda(_as_turn)
+            | {"context": retriever | assemble_context | format_docs,
+               "question": lambda t: t["question"],
+               "summary": lambda t: t["summary"] or "-",
+               "history": lambda t: t["history"] or "-"}
             | ChatPromptTemplate.from_template(template)
             | llm
             | StrOutputParser()
     )
 
 
+# --- SEMANTYCZNY CACHE ODPOWIEDZI ---
+_answer_stats = {"hits": 0, "misses": 0, "saved_generation_s": 0.0}
+_answer_stats_lock = threading.Lock()
+
+
+def _cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    na = sum(x * x for x in a) ** 0.5
+    nb = sum(y * y for y in b) ** 0.5
+    return dot / (na * nb) if na and nb else 0.0
+
+
+def lookup_cached_answer(cid, question):
+    """Szuka odpowiedzi na podobne pytanie w tej samej wersji kolekcji.
+
+    Zwraca (odpowiedź albo None, probe); probe przekazuje się potem do store_cached_answer.
+    """
+    if not config.ANSWER_CACHE_ENABLED:
+        return None, None
+    try:
+        version = db_utils.get_collection_version(cid)
+        if version is None:
+            return None, None
+        probe = {"version": version, "embedding": embeddings.embed_query(question)}
+        best, best_score = None, 0.0
+        for entry in db_utils.get_answer_cache_entries(cid, version, config.ANSWER_CACHE_TTL):
+            score = _cosine(probe["embedding"], entry[1])
+            if score > best_score:
+                best, best_score = entry, score
+        if best and best_score >= config.ANSWER_CACHE_THRESHOLD:
+            db_utils.record_answer_cache_hit(best[0])
+            with _answer_stats_lock:
+                _answer_stats["hits"] += 1
+                _answer_stats["saved_generation_s"] += best[3]
+            return best[2], probe
+        with _answer_stats_lock:
+            _answer_stats["misses"] += 1
+        return None, probe
+    except Exception as e:
+        print(f"Błąd cache odpowiedzi: {e}")
+        return None, None
+
+
+def store_cached_answer(cid, question, probe, answer, generation_s):
+    if not probe or not answer:
+        return
+    try:
+        db_utils.save_answer_cache_entry(cid, probe["version"], question, probe["embedding"], answer, generation_s,
+                                         config.ANSWER_CACHE_TTL, config.ANSWER_CACHE_MAX_PER_COLLECTION)
+    except Exception as e:
+        print(f"Błąd zapisu cache odpowiedzi: {e}")
+
+
+def get_answer_cache_stats():
+    with _answer_stats_lock:
+        stats = dict(_answer_stats)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / total if total else 0.0
+    return stats
+
+
+def stream_answer(chain, question, stats=None):
+    """Oddaje odpowiedź token po tokenie; w stats zapisuje czas do pierwszego tokenu i czas całkowity.
+
+    question - samo pytanie albo wynik prepare_turn.
+    """
+    t0 = time.perf_counter()
+    first = True
+    for token in chain.stream(question):
+        if first and stats is not None:
+            stats["ttft_s"] = time.perf_counter() - t0
+        first = False
+        yield token
+    if stats is not None:
+        stats["total_s"] = time.perf_counter() - t0
+
+
 def get_all_user_files(user):
     try:
-        conn = db_utils.get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT DISTINCT cmetadata ->> 'source_file' FROM langchain_pg_embedding WHERE cmetadata ->> 'username' = %s",
-            (user,))
-        res = [r[0] for r in cur.fetchall()]
-        conn.close()
-        return res
+        # Lista z tabeli documents zamiast DISTINCT po wszystkich wektorach użytkownika
+        return db_utils.get_owner_documents(user)
     except Exception as e:
         print(f"Błąd pobierania plików: {e}")
         return []
@@ -96,15 +1133,12 @@ def get_all_user_files(user):
 
 def delete_file_from_storage(user, filename):
     try:
-        conn = db_utils.get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "DELETE FROM langchain_pg_embedding WHERE cmetadata ->> 'source_file' = %s AND cmetadata ->> 'username' = %s",
-            (filename, user)
-        )
-        conn.commit()
-        conn.close()
+        document_id = db_utils.delete_document(user, filename)
+        if document_id:
+            delete_document_vectors(user, [document_id])
+        # Bez odcisku ponowne wgranie tego pliku zostanie normalnie zaindeksowane
+        db_utils.delete_file_fingerprint(user, filename)
         return True
     except Exception as e:
         print(f"Błąd usuwania pliku: {e}")
-        return False
\ No newline at end of file
+        return False
@@ -0,0 +1,78 @@
+import threading
+import rag_core
+
+
+def _messages(n):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"m{i}", "seq": i} for i in range(n)]
+
+
+def test_summary_refresh_runs_in_background_once_per_chat(monkeypatch):
+    started, release, calls = threading.Event(), threading.Event(), []
+
+    def slow_refresh(cid, user, messages):
+        calls.append((cid, user, len(messages)))
+        started.set()
+        release.wait(5)
+
+    monkeypatch.setattr(rag_core, "refresh_chat_summary", slow_refresh)
+    msgs = _messages(2 * rag_core.config.CHAT_MEMORY_TURNS + 2)
+    rag_core.refresh_chat_summary_async(1, "ala", msgs)  # wraca od razu, model liczy w tle
+    assert started.wait(5)
+    rag_core.refresh_chat_summary_async(1, "ala", msgs)  # ta sama rozmowa w toku - pomijamy
+    release.set()
+    for t in threading.enumerate():
+        if t.name == "chat-summary":
+            t.join(5)
+    assert calls == [(1, "ala", len(msgs))]
+    assert not rag_core._summary_jobs
+
+
+def test_short_chat_skips_summary(monkeypatch):
+    calls = []
+    monkeypatch.setattr(rag_core, "refresh_chat_summary", lambda *a: calls.append(a))
+    rag_core.refresh_chat_summary_async(1, "ala", _messages(2 * rag_core.config.CHAT_MEMORY_TURNS))
+    assert not rag_core._summary_jobs and not calls
+
+
+def test_follow_up_without_rewrite_is_not_cached(monkeypatch):
+    monkeypatch.setattr(rag_core.db_utils, "get_chat_summary", lambda cid, user: ("", -1))
+    monkeypatch.setattr(rag_core.config, "CONDENSE_QUESTIONS", False)
+    history = _messages(2)
+    assert rag_core.prepare_turn(1, "ala", "a ile to w euro?", history)["cacheable"] is False
+    assert rag_core.prepare_turn(1, "ala", "Jaka jest kwota brutto?", [])["cacheable"] is True
+
+    monkeypatch.setattr(rag_core, "condense_question", lambda q, h, s="": "Ile wynosi kwota faktury FV/12 w euro?")
+    assert rag_core.prepare_turn(1, "ala", "a ile to w euro?", history)["cacheable"] is True
+
+
+def test_follow_up_heuristic():
+    assert rag_core.looks_like_follow_up("a ile to w euro?")
+    assert rag_core.looks_like_follow_up("Kto jest jej sprzedawcą według dokumentu?")
+    assert rag_core.looks_like_follow_up("A co z kolejnym rokiem rozliczeniowym...")
+    assert not rag_core.looks_like_follow_up("Jaki jest numer VIN samochodu z oferty?")
+
+
+class _SlowLLM:
+    def __init__(self, delay, answer="Ile wynosi kwota faktury FV/12 w euro?"):
+        self.delay, self.answer, self.calls = delay, answer, 0
+
+    def invoke(self, prompt, stop=None):
+        self.calls += 1
+        threading.Event().wait(self.delay)
+        return self.answer + "\nDodatkowe wyjaśnienie"
+
+
+def test_condense_only_follow_ups_and_respects_timeout(monkeypatch):
+    monkeypatch.setattr(rag_core.config, "CONDENSE_QUESTIONS", True)
+    monkeypatch.setattr(rag_core.config, "CONDENSE_TIMEOUT", 0.2)
+    history = _messages(2)
+
+    fast = _SlowLLM(0)
+    monkeypatch.setattr(rag_core, "llm", fast)
+    assert rag_core.condense_question("a ile to w euro?", history) == fast.answer
+    assert rag_core.condense_question("Jaki jest numer VIN samochodu z oferty?", history) == \
+        "Jaki jest numer VIN samochodu z oferty?"
+    assert fast.calls == 1
+
+    monkeypatch.setattr(rag_core, "llm", _SlowLLM(1.0))
+    assert rag_core.condense_question("a ile to w euro?", history) == "a ile to w euro?"
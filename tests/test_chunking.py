@@ -0,0 +1,57 @@
+from langchain_core.documents import Document
+import chunking, rag_core
+
+
+def _invoice_page(rows=59):
+    lines = ["FAKTURA VAT NR FV/2024/05/59", "Sprzedawca: Hurtownia Sp. z o.o.", "Lp Nazwa Ilość Cena Wartość"]
+    lines += [f"{i} Produkt_{i} {i % 7 + 1} {i * 3},50 {(i % 7 + 1) * i * 3},50" for i in range(1, rows + 1)]
+    lines.append("Razem do zapłaty: 12345,00 PLN")
+    return Document(page_content="\n".join(lines), metadata={"source": "Faktura_59.pdf", "page": 0})
+
+
+def _row(i):
+    return f"{i} Produkt_{i} "
+
+
+def test_profile_by_file_name():
+    assert chunking.get_profile("temp/Faktura_8_Leasing.pdf") == "faktura"
+    assert chunking.get_profile("Wynik_2_Cukrzyca.pdf") == "raport"
+    assert chunking.get_profile("notatki.txt") == "default"
+
+
+def test_table_row_detection_ignores_dates():
+    assert chunking._is_table_row("12 Produkt 3 10,50 31,50")
+    assert not chunking._is_table_row("Data wystawienia 2024-06-15 Warszawa")
+
+
+def test_large_table_pieces_keep_header_and_real_offsets():
+    page = _invoice_page()
+    chunks = chunking.Chunker("faktura").split(page)
+    pieces = [c for c in chunks if "Produkt_" in c.page_content]
+    assert len(pieces) > 1
+    for c in pieces:
+        assert "Lp Nazwa Ilość Cena Wartość" in c.page_content
+        first_row = next(line for line in c.page_content.splitlines() if "Produkt_" in line)
+        assert page.page_content.index(first_row) == c.metadata["start_index"]
+    starts = [c.metadata["start_index"] for c in pieces]
+    assert starts == sorted(set(starts))
+    text = "\n".join(c.page_content for c in chunks)
+    assert all(_row(i) in text for i in range(1, 60))
+
+
+def test_chunks_never_cross_pages():
+    pages = [Document(page_content="WSTĘP\n" + "Zdanie o niczym. " * 40, metadata={"page": p}) for p in range(3)]
+    chunks = list(chunking.split_pages(pages, "Raport_1.pdf"))
+    assert {c.metadata["page"] for c in chunks} == {0, 1, 2}
+    assert all(len(c.page_content) <= chunking.PROFILES["raport"]["chunk_size"] for c in chunks)
+
+
+def test_split_table_survives_context_assembly():
+    # Regresja: wszystkie kawałki tabeli miały ten sam start_index i _merge_overlapping gubił wiersze
+    docs = []
+    for c in chunking.Chunker("faktura").split(_invoice_page()):
+        docs.append(Document(page_content=c.page_content,
+                             metadata={"source_file": "Faktura_59.pdf", "page": 0,
+                                       "start_index": c.metadata["start_index"]}))
+    context = "\n".join(d.page_content for d in rag_core.assemble_context(docs, budget=100000))
+    assert all(_row(i) in context for i in range(1, 60))
@@ -0,0 +1,96 @@
+import json, os
+import pytest
+import config, db_utils, ingest_worker
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+    for name in ("complete_ingest_job", "fail_ingest_job", "add_file_to_collection", "update_ingest_progress"):
+        monkeypatch.setattr(db_utils, name, lambda *a, _name=name, **kw: calls.append((_name, a, kw)))
+    monkeypatch.setattr(ingest_worker.upload_staging, "release", lambda path: calls.append(("release", (path,), {})))
+    return calls
+
+
+def _job(**kw):
+    return dict({"id": 7, "owner_username": "ala", "collection_id": 3, "file_path": "staging/x.pdf",
+                 "file_name": "x.pdf"}, **kw)
+
+
+def _ingest(error=None):
+    def ingest_file(path, name, user, embed_fn=None, progress_cb=None):
+        if error:
+            raise error
+        progress_cb(1.0)
+        return {"chunks": 1}
+    return ingest_file
+
+
+def test_run_job_success_links_file_and_completes(monkeypatch, calls):
+    monkeypatch.setattr(ingest_worker.rag_core, "ingest_file", _ingest())
+    assert ingest_worker.run_job(_job()) is True
+    assert [c[0] for c in calls] == ["update_ingest_progress", "add_file_to_collection", "complete_ingest_job", "release"]
+    assert calls[1][1] == (3, "x.pdf")
+
+
+@pytest.mark.parametrize("error, retry", [(ingest_worker.rag_core.PermanentIngestError("pusty plik"), False),
+                                          (json.JSONDecodeError("ucięta odpowiedź", "{", 1), True),
+                                          (ConnectionError("ollama"), True)])
+def test_run_job_failure_retries_only_transient_errors(monkeypatch, calls, error, retry):
+    monkeypatch.setattr(ingest_worker.rag_core, "ingest_file", _ingest(error))
+    assert ingest_worker.run_job(_job()) is False
+    fail = [c for c in calls if c[0] == "fail_ingest_job"]
+    assert fail and fail[0][1][0] == 7
+    assert fail[0][2].get("retry", True) is retry
+    assert calls[-1] == ("release", ("staging/x.pdf",), {})
+
+
+# --- Przejmowanie zadań: wymaga osobnej, pustej bazy (zadania innych użytkowników też byłyby przejmowane) ---
+@pytest.fixture
+def job_db(monkeypatch):
+    url = os.environ.get("RAG_TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("RAG_TEST_DATABASE_URL nie ustawiony - testy kolejki na Postgresie pominięte")
+    monkeypatch.setattr(config, "DATABASE_URL", url)
+    db_utils.init_db()
+    with db_utils.db_conn() as conn:
+        conn.cursor().execute("DELETE FROM ingest_jobs")
+    yield
+    with db_utils.db_conn() as conn:
+        conn.cursor().execute("DELETE FROM ingest_jobs")
+
+
+def test_claim_respects_per_user_limit_and_order(job_db):
+    a1 = db_utils.enqueue_ingest_job("ala", "ala", None, "a1", "a1.pdf")
+    db_utils.enqueue_ingest_job("ala", "ala", None, "a2", "a2.pdf")
+    b1 = db_utils.enqueue_ingest_job("ola", "ola", None, "b1", "b1.pdf")
+
+    assert db_utils.claim_ingest_job(1)["id"] == a1
+    # Drugie zadanie "ala" czeka, bo jedno już działa - przechodzi zadanie innego użytkownika
+    assert db_utils.claim_ingest_job(1)["id"] == b1
+    assert db_utils.claim_ingest_job(1) is None
+
+
+def test_failed_job_backs_off_then_fails_for_good(job_db, monkeypatch):
+    monkeypatch.setattr(config, "INGEST_MAX_ATTEMPTS", 2)
+    job_id = db_utils.enqueue_ingest_job("ala", "ala", None, "a1", "a1.pdf")
+    job = db_utils.claim_ingest_job(1)
+    assert job["attempts"] == 1
+
+    db_utils.fail_ingest_job(job_id, "timeout")
+    assert db_utils.claim_ingest_job(1) is None  # run_after przesunięte o INGEST_RETRY_BACKOFF
+    with db_utils.db_conn() as conn:
+        conn.cursor().execute("UPDATE ingest_jobs SET run_after = CURRENT_TIMESTAMP WHERE id = %s", (job_id,))
+    assert db_utils.claim_ingest_job(1)["attempts"] == 2
+
+    db_utils.fail_ingest_job(job_id, "timeout")
+    assert db_utils.get_user_jobs("ala")[0]["status"] == "failed"
+
+
+def test_broken_files_raise_permanent_error(tmp_path):
+    broken = tmp_path / "zly.pdf"
+    broken.write_bytes(b"to nie jest PDF")
+    with pytest.raises(ingest_worker.rag_core.PermanentIngestError):
+        ingest_worker.rag_core.pdf_extract.count_pages(str(broken))
+    with pytest.raises(ingest_worker.rag_core.PermanentIngestError):
+        ingest_worker.rag_core.ingest_file(str(tmp_path / "brak.pdf"), "brak.pdf", "ala", embed_fn=lambda texts: texts)
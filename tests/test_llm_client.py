@@ -0,0 +1,60 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import llm_client, ollama_stub
+
+
+@pytest.fixture
+def stub():
+    server = ollama_stub.serve(delay=0.2)
+    yield server
+    server.shutdown()
+
+
+def test_identical_embeds_in_flight_are_sent_once(stub):
+    client = llm_client.OllamaClient(base_url=stub.url, max_concurrency=4)
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda _: client.embed("m", ["ala ma kota"]), range(4)))
+    assert stub.requests["embed"] == 1
+    assert client.stats["coalesced"] == 3
+    assert all(r == results[0] for r in results)
+
+
+def test_identical_generations_share_one_stream(stub):
+    stub.delay = 0.05
+    client = llm_client.OllamaClient(base_url=stub.url)
+    with ThreadPoolExecutor(2) as pool:
+        answers = list(pool.map(lambda _: "".join(client.generate_stream("m", "pytanie")), range(2)))
+    assert stub.requests["generate"] == 1
+    assert answers[0] == answers[1] and answers[0].strip() == stub.answer
+
+
+def test_concurrency_limit(stub):
+    client = llm_client.OllamaClient(base_url=stub.url, max_concurrency=2)
+    with ThreadPoolExecutor(6) as pool:
+        list(pool.map(lambda i: client.embed("m", [f"tekst {i}"]), range(6)))
+    assert stub.requests["embed"] == 6
+    assert stub.max_active == 2
+    assert client.stats["queued"] == 4
+
+
+def test_interactive_requests_jump_the_queue():
+    client = llm_client.OllamaClient(base_url="http://unused", max_concurrency=1)
+    order = []
+
+    async def take(priority, name):
+        await client._acquire(priority)
+        order.append(name)
+
+    async def scenario():
+        await client._acquire(llm_client.INTERACTIVE)  # jedyny slot zajęty
+        tasks = [asyncio.ensure_future(take(llm_client.BACKGROUND, "indeksowanie")),
+                 asyncio.ensure_future(take(llm_client.INTERACTIVE, "czat"))]
+        await asyncio.sleep(0)
+        client._release()
+        await asyncio.sleep(0)
+        client._release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert order == ["czat", "indeksowanie"]
@@ -0,0 +1,56 @@
+from langchain_core.documents import Document
+import rag_core
+
+
+def _doc(text, document_id=1, **metadata):
+    return Document(page_content=text, metadata=dict(metadata, document_id=document_id))
+
+
+def test_rrf_prefers_documents_found_by_both_searches():
+    a, b, c = _doc("a"), _doc("b"), _doc("c")
+    fused = rag_core._rrf([[a, b], [c, b]], k=3)
+    assert fused[0].page_content == "b"
+    assert {d.page_content for d in fused} == {"a", "b", "c"}
+
+
+def test_rrf_keeps_same_text_from_different_documents():
+    fused = rag_core._rrf([[_doc("x", 1)], [_doc("x", 2)]], k=5)
+    assert len(fused) == 2
+
+
+def test_merge_overlapping_joins_matching_overlap_only():
+    page = "Ala ma kota. Kot ma Alę. Ala lubi kota."
+    first = _doc(page[:20], source_file="a.pdf", page=0, start_index=0)
+    second = _doc(page[15:], source_file="a.pdf", page=0, start_index=15)
+    merged = rag_core._merge_overlapping([(1, second), (0, first)])
+    assert [(r, d.page_content) for r, d in merged] == [(0, page)]
+
+    # Ten sam zakres strony, ale inny tekst (np. kawałek tabeli z nagłówkiem) - nie sklejamy
+    other = _doc("Lp Nazwa\n" + page[15:], source_file="a.pdf", page=0, start_index=15)
+    assert len(rag_core._merge_overlapping([(0, first), (1, other)])) == 2
+
+
+def test_assemble_context_drops_near_duplicates():
+    text = "Faktura numer 12 na kwotę 300 zł dla firmy Kowalski z terminem płatności 14 dni"
+    docs = [_doc(text, 1, source_file="a.pdf"), _doc(text + " .", 2, source_file="b.pdf")]
+    context = rag_core.assemble_context(docs, budget=10_000)
+    assert len(context) == 1
+
+
+def test_rerank_blend_keeps_vector_only_hit():
+    question = "termin płatności faktury"
+    docs = [_doc("Należność uregulować w ciągu dwóch tygodni."),  # trafienie wektorowe, zero wspólnych słów
+            _doc("Faktura korygująca do zamówienia"),
+            _doc("Faktura: termin płatności 14 dni."),
+            _doc("Sprzedawca: Hurtownia")]
+    pure = rag_core.rerank(question, docs, top_n=2, scorer=rag_core.lexical_overlap_scores, weight=1.0)
+    assert pure == [docs[2], docs[1]]
+
+    blended = rag_core.rerank(question, docs, top_n=2, scorer=rag_core.lexical_overlap_scores, weight=0.5)
+    assert blended == [docs[2], docs[0]]
+
+
+def test_rerank_without_scorer_keeps_retrieval_order(monkeypatch):
+    monkeypatch.setattr(rag_core.config, "RERANKER", None)
+    docs = [_doc(str(i)) for i in range(5)]
+    assert rag_core.rerank("pytanie", docs, top_n=3) == docs[:3]
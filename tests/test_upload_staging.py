@@ -0,0 +1,65 @@
+import contextlib, io, os, threading
+import pytest
+import upload_staging
+
+
+class _Upload(io.BytesIO):
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+
+@pytest.fixture
+def staging(tmp_path, monkeypatch):
+    """Magazyn w katalogu tymczasowym; kolejka zadań i blokada doradcza zastąpione stanem w pamięci."""
+    monkeypatch.setattr(upload_staging.config, "UPLOAD_STAGING_DIR", str(tmp_path))
+    monkeypatch.setattr(upload_staging.config, "UPLOAD_RETAIN", False)
+    monkeypatch.setattr(upload_staging.config, "UPLOAD_QUOTA_MB", 1024)
+    state = {"pending": set(), "lock": threading.Lock(), "enqueued": threading.Event(), "hold": None}
+
+    @contextlib.contextmanager
+    def staged_file_lock(path):
+        with state["lock"]:
+            yield None
+
+    def enqueue_ingest_job(user, owner, cid, path, filename, cur=None):
+        state["enqueued"].set()
+        if state["hold"]:
+            state["hold"].wait(5)
+        state["pending"].add(path)
+        return len(state["pending"])
+
+    monkeypatch.setattr(upload_staging.db_utils, "staged_file_lock", staged_file_lock)
+    monkeypatch.setattr(upload_staging.db_utils, "enqueue_ingest_job", enqueue_ingest_job)
+    monkeypatch.setattr(upload_staging.db_utils, "get_pending_job_paths", lambda cur=None: set(state["pending"]))
+    return state
+
+
+def test_same_content_is_stored_once(staging, tmp_path):
+    upload_staging.enqueue_upload(_Upload(b"%PDF tresc", "a.pdf"), "ala", "ala", 1)
+    upload_staging.enqueue_upload(_Upload(b"%PDF tresc", "faktura.PDF"), "ola", "ola", 2)
+    assert [p.suffix for p in tmp_path.iterdir()] == [".pdf"]
+    assert len(staging["pending"]) == 1
+
+
+def test_release_waits_for_job_being_enqueued(staging, tmp_path):
+    upload_staging.enqueue_upload(_Upload(b"%PDF tresc", "a.pdf"), "ala", "ala", 1)
+    (path,) = staging["pending"]
+    staging["pending"].clear()  # pierwsze zadanie skończone
+
+    # Ta sama treść wgrana ponownie; zadanie jeszcze nie zapisane, gdy worker woła release
+    staging["enqueued"].clear()
+    staging["hold"] = threading.Event()
+    t = threading.Thread(target=upload_staging.enqueue_upload, args=(_Upload(b"%PDF tresc", "a.pdf"), "ala", "ala", 1))
+    t.start()
+    assert staging["enqueued"].wait(5)
+    releaser = threading.Thread(target=upload_staging.release, args=(path,))
+    releaser.start()
+    staging["hold"].set()
+    t.join(5)
+    releaser.join(5)
+    assert os.path.exists(path)
+
+    staging["pending"].clear()
+    upload_staging.release(path)
+    assert not os.path.exists(path)
@@ -0,0 +1,116 @@
+"""Magazyn plików wgrywanych przez aplikację, zanim worker je zaindeksuje.
+
+Plik jest zapisywany na dysk kawałkami (bez kopii całości w pamięci) pod nazwą z hasha treści
+w UPLOAD_STAGING_DIR, więc dwóch użytkowników z plikiem "faktura.pdf" nie nadpisuje sobie nawzajem,
+a ten sam plik wgrany drugi raz nie zajmuje miejsca. Oryginalna nazwa idzie osobno do ingest_jobs.
+Z UPLOAD_RETAIN=False plik znika po zakończeniu zadania; inaczej zostaje, dopóki magazyn nie
+przekroczy UPLOAD_QUOTA_MB - wtedy wypierane są najdawniej używane pliki, na które nie czeka
+żadne zadanie. Wstawienie pliku z zadaniem i jego usunięcie idą pod db_utils.staged_file_lock.
+"""
+import hashlib, os, tempfile, threading, time
+import config, db_utils
+
+_PART_MAX_AGE = 3600  # niedokończony zapis (.part) starszy niż godzina to pozostałość po awarii
+_quota_lock = threading.Lock()
+
+
+def _is_staged(path):
+    return os.path.dirname(os.path.abspath(path)) == os.path.abspath(config.UPLOAD_STAGING_DIR)
+
+
+def _lock_key(path):
+    return os.path.abspath(path)
+
+
+def _remove_unless_pending(cur, path):
+    # Wywoływane pod staged_file_lock(path) - zadanie nie może się pojawić między sprawdzeniem a usunięciem
+    if _lock_key(path) in {_lock_key(p) for p in db_utils.get_pending_job_paths(cur)}:
+        return False
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return True
+
+
+def enqueue_upload(uploaded, user, owner, cid):
+    """Zapisuje plik ze st.file_uploader (lub dowolny obiekt z read()) i dodaje zadanie indeksowania; zwraca id zadania."""
+    os.makedirs(config.UPLOAD_STAGING_DIR, exist_ok=True)
+    ext = os.path.splitext(uploaded.name)[1].lower()
+    digest = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=config.UPLOAD_STAGING_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if hasattr(uploaded, "seek"):
+                uploaded.seek(0)
+            while True:
+                block = uploaded.read(config.UPLOAD_CHUNK_SIZE)
+                if not block:
+                    break
+                digest.update(block)
+                f.write(block)
+        path = os.path.join(config.UPLOAD_STAGING_DIR, digest.hexdigest() + ext)
+        # Worker kończący wcześniejsze zadanie z tą samą treścią nie usunie pliku, zanim nowe zadanie trafi do kolejki
+        with db_utils.staged_file_lock(_lock_key(path)) as cur:
+            if os.path.exists(path):
+                # Ta sama treść już jest - odświeżamy tylko czas użycia (kolejność wypierania)
+                os.remove(tmp)
+                os.utime(path)
+            else:
+                os.replace(tmp, path)
+            job_id = db_utils.enqueue_ingest_job(user, owner, cid, path, uploaded.name, cur)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    enforce_quota()
+    return job_id
+
+
+def release(path):
+    """Wywoływane przez worker po zadaniu: bez UPLOAD_RETAIN usuwa plik, jeśli nikt już na niego nie czeka."""
+    if config.UPLOAD_RETAIN or not _is_staged(path):
+        return
+    try:
+        with db_utils.staged_file_lock(_lock_key(path)) as cur:
+            _remove_unless_pending(cur, path)
+    except Exception as e:
+        print(f"Błąd usuwania pliku tymczasowego {path}: {e}")
+
+
+def enforce_quota(quota_mb=None):
+    """Wypiera najdawniej używane pliki ponad limit; zwraca {"files", "bytes"} usuniętych."""
+    quota = (config.UPLOAD_QUOTA_MB if quota_mb is None else quota_mb) * 1024 * 1024
+    stats = {"files": 0, "bytes": 0}
+    if not os.path.isdir(config.UPLOAD_STAGING_DIR):
+        return stats
+    with _quota_lock:
+        now, entries, total = time.time(), [], 0
+        for entry in os.scandir(config.UPLOAD_STAGING_DIR):
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            if entry.name.endswith(".part"):
+                if now - st.st_mtime > _PART_MAX_AGE:
+                    os.remove(entry.path)
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        if total <= quota:
+            return stats
+        pending = {os.path.abspath(p) for p in db_utils.get_pending_job_paths()}
+        for _, size, path in sorted(entries):
+            if total <= quota:
+                break
+            if os.path.abspath(path) in pending:
+                continue
+            # Ponowne sprawdzenie pod blokadą - plik mógł właśnie dostać nowe zadanie
+            with db_utils.staged_file_lock(_lock_key(path)) as cur:
+                if not _remove_unless_pending(cur, path):
+                    continue
+            total -= size
+            stats["files"] += 1
+            stats["bytes"] += size
+    if stats["files"]:
+        print(f"Magazyn uploadów: wyparto {stats['files']} plików ({stats['bytes'] / 2**20:.1f} MB).")
+    return stats